@@ -1,5 +1,11 @@
 import pyrox.filtering as filtering
 
+from pyrox.server.routing import resolve_route
+
+
+# Resolving the target once saves parsing its URL on every request
+_GOOGLE = resolve_route('http://google.com:80')
+
 
 class RoutingFilter(filtering.HttpFilter):
     """
@@ -9,4 +15,4 @@ class RoutingFilter(filtering.HttpFilter):
 
     @filtering.handles_request_head
     def on_request_head(self, request_message):
-        return filtering.route('http://google.com:80')
+        return filtering.route(_GOOGLE)
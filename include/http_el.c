@@ -237,7 +237,7 @@ int copy_into_pbuffer(const char *source, pbuffer *dest, size_t length) {
     int retval = 0;
 
     if (dest->position + length < dest->size) {
-        memcpy(dest->bytes, source, length);
+        memcpy(dest->bytes + dest->position, source, length);
         dest->position += length;
     } else {
         retval = ELERR_PBUFFER_OVERFLOW;
@@ -258,6 +258,170 @@ int store_byte(char byte, http_parser *parser) {
     return store_byte_in_pbuffer(byte, parser->buffer);
 }
 
+// Offset of the byte being processed within the captured message head
+#define HEAD_OFFSET(parser) ((parser)->head->position - 1)
+
+#define SPAN_UNSET ((size_t) -1)
+
+int in_message_head(http_parser *parser, char next_byte) {
+    switch (parser->state) {
+        case s_req_start:
+        case s_resp_start:
+            // Leading line breaks are skipped and not part of the head
+            return next_byte != CR && next_byte != LF;
+
+        case s_body:
+        case s_chunk_size:
+        case s_chunk_parameters:
+        case s_chunk_data:
+        case s_chunk_complete:
+        case s_body_complete:
+        case s_message_end:
+            return 0;
+
+        default:
+            return 1;
+    }
+}
+
+void begin_header_span(http_parser *parser) {
+    http_header_span *span;
+
+    // Overflow of the span table is reported when the header completes
+    if (parser->header_count < HTTP_MAX_HEADERS) {
+        span = &parser->header_spans[parser->header_count];
+        span->field_offset = HEAD_OFFSET(parser);
+        span->field_length = 0;
+        span->value_offset = SPAN_UNSET;
+        span->value_length = 0;
+    }
+}
+
+int end_header_field_span(http_parser *parser) {
+    if (parser->header_count >= HTTP_MAX_HEADERS) {
+        return ELERR_TOO_MANY_HEADERS;
+    }
+
+    http_header_span *span = &parser->header_spans[parser->header_count];
+    span->field_length = HEAD_OFFSET(parser) - span->field_offset;
+
+    return 0;
+}
+
+void mark_header_value_span(http_parser *parser) {
+    http_header_span *span = &parser->header_spans[parser->header_count];
+
+    if (span->value_offset == SPAN_UNSET) {
+        span->value_offset = HEAD_OFFSET(parser);
+    }
+}
+
+void end_header_value_span(http_parser *parser) {
+    http_header_span *span = &parser->header_spans[parser->header_count];
+    size_t value_end = HEAD_OFFSET(parser);
+
+    if (span->value_offset == SPAN_UNSET) {
+        // Empty header value
+        span->value_offset = value_end;
+    } else if (value_end > span->value_offset &&
+            parser->head->bytes[value_end - 1] == CR) {
+        value_end -= 1;
+    }
+
+    span->value_length = value_end - span->value_offset;
+    parser->header_count += 1;
+}
+
+// Bulk scanning of long tokens
+
+const char * find_url_end(const char *start, const char *end) {
+    const char *next = start;
+
+    while (next < end && IS_URL_CHAR(*next)) {
+        next++;
+    }
+
+    return next;
+}
+
+const char * find_line_end(const char *start, const char *end) {
+    const char *line_end = memchr(start, LF, end - start);
+    const char *cr;
+
+    if (line_end == NULL) {
+        line_end = end;
+    }
+
+    cr = memchr(start, CR, line_end - start);
+    return cr != NULL ? cr : line_end;
+}
+
+/*
+ * Consumes the run of bytes following the byte just processed when the
+ * parser is in the middle of a long token (request path, header value or
+ * reason phrase). The run ends at the first byte that needs the state
+ * machine's attention and is copied in bulk rather than dispatched byte by
+ * byte. The number of bytes consumed is written to consumed.
+ */
+int scan_token_run(http_parser *parser, const char *data, size_t offset, size_t length, size_t *consumed) {
+    int retval = 0;
+    const char *start = data + offset;
+    const char *end = data + length;
+    const char *run_end;
+    size_t run;
+
+    *consumed = 0;
+
+    if (start >= end) {
+        return 0;
+    }
+
+    switch (parser->state) {
+        case s_req_path:
+            run_end = find_url_end(start, end);
+            break;
+
+        case s_header_value:
+            // Special headers and leading whitespace go byte by byte
+            if (parser->header_state != h_general || parser->bytes_read == 0) {
+                return 0;
+            }
+
+            run_end = find_line_end(start, end);
+            break;
+
+        case s_resp_rphrase:
+            // The reason phrase is skipped - only look for the line end
+            run_end = memchr(start, LF, end - start);
+            run = (run_end != NULL ? run_end : end) - start;
+
+            if (parser->options & O_BATCH_HEADERS) {
+                retval = copy_into_pbuffer(start, parser->head, run);
+            }
+
+            *consumed = run;
+            return retval;
+
+        default:
+            return 0;
+    }
+
+    run = run_end - start;
+
+    if (run > 0) {
+        retval = copy_into_pbuffer(start, parser->buffer, run);
+        parser->bytes_read += run;
+
+        if (!retval && parser->options & O_BATCH_HEADERS) {
+            retval = copy_into_pbuffer(start, parser->head, run);
+        }
+
+        *consumed = run;
+    }
+
+    return retval;
+}
+
 int on_cb(http_parser *parser, http_cb cb) {
     return cb(parser);
 }
@@ -381,6 +545,32 @@ void reset_http_parser(http_parser *parser) {
     set_header_state(parser, h_general);
     set_http_state(parser,
         parser->type == HTTP_REQUEST ? s_req_start : s_resp_start);
+
+    if (parser->head != NULL) {
+        reset_pbuffer(parser->head);
+        parser->header_count = 0;
+    }
+}
+
+/*
+ * True when chunk framing is being passed through as-is. Bytes read in
+ * these states are handed to on_body in runs by http_parser_exec instead.
+ */
+int in_raw_chunks(const http_parser *parser) {
+    if (!(parser->options & O_RAW_CHUNKS)) {
+        return 0;
+    }
+
+    switch (parser->state) {
+        case s_chunk_size:
+        case s_chunk_parameters:
+        case s_chunk_data:
+        case s_chunk_complete:
+            return 1;
+
+        default:
+            return 0;
+    }
 }
 
 int read_body(http_parser *parser, const http_parser_settings *settings, const char *data, size_t offset, size_t length) {
@@ -388,13 +578,15 @@ int read_body(http_parser *parser, const http_parser_settings *settings, const c
     size_t read = 0;
 
     if (parser->content_length >= real_length) {
-        retval = settings->on_body(parser, data + offset, real_length);
         read = real_length;
     } else {
-        retval = settings->on_body(parser, data + offset, parser->content_length);
         read = parser->content_length;
     }
 
+    if (!in_raw_chunks(parser)) {
+        retval = settings->on_body(parser, data + offset, read);
+    }
+
     parser->content_length -= read;
     parser->bytes_read += read;
 
@@ -593,7 +785,12 @@ int read_header_value(http_parser *parser, const http_parser_settings *settings,
             break;
 
         case LF:
-            retval = on_data_cb(parser, settings->on_header_value);
+            if (parser->options & O_BATCH_HEADERS) {
+                end_header_value_span(parser);
+            } else {
+                retval = on_data_cb(parser, settings->on_header_value);
+            }
+
             reset_buffer(parser);
             set_http_state(parser, s_header_field_start);
             set_header_state(parser, h_general);
@@ -607,6 +804,10 @@ int read_header_value(http_parser *parser, const http_parser_settings *settings,
             }
 
         default:
+            if (parser->options & O_BATCH_HEADERS) {
+                mark_header_value_span(parser);
+            }
+
             retval = process_header_by_state(parser, settings, next_byte);
     }
 
@@ -707,7 +908,12 @@ int read_header_field(http_parser *parser, const http_parser_settings *settings,
             break;
 
         case ':':
-            retval = on_data_cb(parser, settings->on_header_field);
+            if (parser->options & O_BATCH_HEADERS) {
+                retval = end_header_field_span(parser);
+            } else {
+                retval = on_data_cb(parser, settings->on_header_field);
+            }
+
             reset_buffer(parser);
             set_http_state(parser, s_header_value);
             break;
@@ -722,6 +928,10 @@ int read_header_field(http_parser *parser, const http_parser_settings *settings,
 int read_header_field_start(http_parser *parser, const http_parser_settings *settings, char next_byte, char lower) {
     int retval = 0;
 
+    if (parser->options & O_BATCH_HEADERS) {
+        begin_header_span(parser);
+    }
+
     switch (lower) {
         case 'c':
             // potentially connection or content-length
@@ -943,18 +1153,67 @@ int start_response(http_parser *parser, const http_parser_settings *settings, ch
     return retval;
 }
 
+int complete_message(http_parser *parser, const http_parser_settings *settings) {
+    int retval = on_cb(parser, settings->on_message_complete);
+
+    reset_http_parser(parser);
+    return retval;
+}
+
 // Big state switch
-int http_parser_exec(http_parser *parser, const http_parser_settings *settings, const char *data, size_t length) {
-    int retval = 0, d_index;
+/*
+ * Runs the parser over the data given. The number of bytes consumed is
+ * written to consumed. This is less than length only when a callback pauses
+ * the parser, in which case parsing stops at the first unconsumed byte and
+ * the caller is expected to hand the rest back once the parser is resumed.
+ *
+ * A message that ends while the parser is paused is completed the next time
+ * the parser is run, even if it is run with no data.
+ */
+int http_parser_exec(http_parser *parser, const http_parser_settings *settings, const char *data, size_t length, size_t *consumed) {
+    int retval = 0, d_index, raw_index = -1;
+    size_t run;
+
+    // Complete a message that ended while we were paused
+    if (!parser->paused && parser->state == s_body_complete) {
+        retval = complete_message(parser, settings);
+
+        if (retval) {
+            *consumed = 0;
+            return retval;
+        }
+    }
 
     for (d_index = 0; d_index < length; d_index++) {
-        char next_byte = data[d_index];
+        char next_byte;
+
+        // Stop short if a callback asked us to pause
+        if (parser->paused) {
+            break;
+        }
+
+        next_byte = data[d_index];
+
+        // Mark where a run of raw chunk framing starts
+        if (raw_index < 0 && in_raw_chunks(parser)) {
+            raw_index = d_index;
+        }
 
 #if DEBUG_OUTPUT
         // Get the next character being processed during debug
         printf("Next: %c\n", next_byte);
 #endif
 
+        // Capture the head as-is so header spans can point into it
+        if (parser->options & O_BATCH_HEADERS && in_message_head(parser, next_byte)) {
+            retval = store_byte_in_pbuffer(next_byte, parser->head);
+
+            if (retval) {
+                reset_http_parser(parser);
+                break;
+            }
+        }
+
         switch (parser->state) {
             case s_req_start:
                 retval = start_request(parser, settings, next_byte);
@@ -1014,8 +1273,10 @@ int http_parser_exec(http_parser *parser, const http_parser_settings *settings,
 
             case s_body:
             case s_chunk_data:
-                read_body(parser, settings, data, d_index, length);
-                d_index += parser->bytes_read;
+                retval = read_body(parser, settings, data, d_index, length);
+
+                // The loop steps past the last byte of the body read
+                d_index += parser->bytes_read - 1;
                 reset_buffer(parser);
                 break;
 
@@ -1027,9 +1288,23 @@ int http_parser_exec(http_parser *parser, const http_parser_settings *settings,
                 retval = ELERR_BAD_STATE;
         }
 
+        // Take the rest of a long token in one go if we're inside one
+        if (!retval) {
+            retval = scan_token_run(parser, data, d_index + 1, length, &run);
+            d_index += run;
+        }
+
         if (!retval && parser->state == s_body_complete) {
-            retval = on_cb(parser, settings->on_message_complete);
-            reset_http_parser(parser);
+            // Flush the raw framing up to and including the last chunk
+            if (raw_index >= 0) {
+                retval = settings->on_body(parser, data + raw_index, d_index + 1 - raw_index);
+                raw_index = -1;
+            }
+
+            // Hold the message open if a callback paused us
+            if (!retval && !parser->paused) {
+                retval = complete_message(parser, settings);
+            }
         }
 
         if (retval) {
@@ -1038,6 +1313,17 @@ int http_parser_exec(http_parser *parser, const http_parser_settings *settings,
         }
     }
 
+    // Flush whatever raw framing was read before running out of data or
+    // being paused
+    if (!retval && raw_index >= 0 && d_index > raw_index) {
+        retval = settings->on_body(parser, data + raw_index, d_index - raw_index);
+
+        if (retval) {
+            reset_http_parser(parser);
+        }
+    }
+
+    *consumed = d_index;
     return retval;
 }
 
@@ -1056,8 +1342,32 @@ void http_parser_init(http_parser *parser, enum http_parser_type parser_type) {
     reset_http_parser(parser);
 }
 
+void http_parser_set_options(http_parser *parser, unsigned char options) {
+    parser->options = options;
+
+    if (options & O_BATCH_HEADERS && parser->head == NULL) {
+        parser->head = init_pbuffer(HTTP_MAX_HEADER_SIZE);
+        parser->header_spans = malloc(sizeof(http_header_span) * HTTP_MAX_HEADERS);
+        parser->header_count = 0;
+    }
+}
+
+void http_parser_pause(http_parser *parser, int paused) {
+    parser->paused = paused ? 1 : 0;
+}
+
+int http_parser_is_paused(const http_parser *parser) {
+    return parser->paused;
+}
+
 void free_http_parser(http_parser *parser) {
     free_pbuffer(parser->buffer);
+
+    if (parser->head != NULL) {
+        free_pbuffer(parser->head);
+        free(parser->header_spans);
+    }
+
     free(parser);
 }
 
@@ -12,10 +12,12 @@ extern "C" {
 #define HTTP_EL_VERSION_MINOR 1
 
 #define HTTP_MAX_HEADER_SIZE (80 * 1024)
+#define HTTP_MAX_HEADERS 256
 
 
 // Type defs
 typedef struct pbuffer pbuffer;
+typedef struct http_header_span http_header_span;
 typedef struct http_parser http_parser;
 typedef struct http_parser_settings http_parser_settings;
 
@@ -37,6 +39,11 @@ enum flags {
     F_TRAILING              = 1 << 4
 };
 
+enum options {
+    O_BATCH_HEADERS         = 1 << 0,
+    O_RAW_CHUNKS            = 1 << 1
+};
+
 enum HTTP_EL_ERROR {
     ELERR_UNCAUGHT = 1,
     ELERR_BAD_PARSER_TYPE = 2,
@@ -50,6 +57,7 @@ enum HTTP_EL_ERROR {
     ELERR_BAD_CHUNK_SIZE = 10,
     ELERR_BAD_DATA_AFTER_CHUNK = 11,
     ELERR_BAD_STATUS_CODE = 12,
+    ELERR_TOO_MANY_HEADERS = 13,
 
     ELERR_BAD_METHOD = 100,
 
@@ -64,6 +72,14 @@ struct pbuffer {
     size_t size;
 };
 
+// Location of a header's field and value within the captured message head
+struct http_header_span {
+    size_t field_offset;
+    size_t field_length;
+    size_t value_offset;
+    size_t value_length;
+};
+
 struct http_parser_settings {
     http_cb           on_message_begin;
     http_data_cb      on_req_method;
@@ -84,6 +100,8 @@ struct http_parser {
     unsigned char header_state;
     unsigned char type;
     unsigned char index;
+    unsigned char options;
+    unsigned char paused;
 
     // Reserved fields
     unsigned long content_length;
@@ -100,6 +118,11 @@ struct http_parser {
     // Buffer
     pbuffer *buffer;
 
+    // Message head capture - only used when O_BATCH_HEADERS is set
+    pbuffer *head;
+    http_header_span *header_spans;
+    size_t header_count;
+
     // Optionally settable application data pointer
     void *app_data;
 };
@@ -108,8 +131,11 @@ struct http_parser {
 // Functions
 void http_parser_init(http_parser *parser, enum http_parser_type parser_type);
 void free_http_parser(http_parser *parser);
+void http_parser_set_options(http_parser *parser, unsigned char options);
+void http_parser_pause(http_parser *parser, int paused);
+int http_parser_is_paused(const http_parser *parser);
 
-int http_parser_exec(http_parser *parser, const http_parser_settings *settings, const char *data, size_t len);
+int http_parser_exec(http_parser *parser, const http_parser_settings *settings, const char *data, size_t len, size_t *consumed);
 int http_should_keep_alive(const http_parser *parser);
 int http_transfer_encoding_chunked(const http_parser *parser);
 
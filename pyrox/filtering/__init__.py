@@ -1,4 +1,12 @@
 from .pipeline import (handles_request_head, handles_request_body,
                        handles_response_head, handles_response_body,
-                       HttpFilter, HttpFilterPipeline, consume, reject,
-                       route, reply, next)
+                       handles_aggregated_request_body,
+                       handles_aggregated_response_body,
+                       stateless, selects, HttpFilter, HttpFilterPipeline,
+                       PipelineTemplate, consume, reject, route, reply, next)
+from .offload import offload, configure_offload
+from .output import BodyBuffer
+from .aggregate import configure_aggregation
+from .cache import (memoize, header_key, DecisionCache,
+                    configure_shared_cache)
+from .stats import FilterStats
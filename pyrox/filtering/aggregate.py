@@ -0,0 +1,168 @@
+import mmap
+import tempfile
+
+from pyrox.log import get_logger
+
+_LOG = get_logger(__name__)
+
+
+"""
+Default memory limits for aggregated bodies. See configure_aggregation.
+"""
+DEFAULT_MESSAGE_BUDGET = 1024 * 1024
+DEFAULT_WORKER_BUDGET = 64 * 1024 * 1024
+
+
+class MemoryBudget(object):
+    """
+    Tracks how many bytes of aggregated bodies a worker holds in memory.
+
+    Must be used from the IOLoop's thread.
+
+    :param limit: The most bytes that may be held at once.
+    """
+    def __init__(self, limit=DEFAULT_WORKER_BUDGET):
+        self._limit = limit
+        self._in_use = 0
+
+    def in_use(self):
+        return self._in_use
+
+    def reserve(self, size):
+        """
+        Returns True and counts size bytes against the budget if they fit,
+        otherwise returns False.
+        """
+        if self._in_use + size > self._limit:
+            return False
+
+        self._in_use += size
+        return True
+
+    def release(self, size):
+        self._in_use -= size
+
+
+class BodyAggregator(object):
+    """
+    Collects the parts of a message body so that aggregated body hooks may
+    be handed all of it at once. Parts are kept in memory until the body
+    outgrows message_budget or the worker's MemoryBudget runs out, at which
+    point everything is moved to a temporary file and later parts are
+    appended to it.
+
+    close must be called once the body is no longer needed so that the
+    memory is given back to the worker's budget and any file is removed.
+
+    :param budget: The worker's MemoryBudget.
+    :param message_budget: The most bytes of this body kept in memory.
+    :param spill_dir: The directory to write temporary files to. Defaults
+                      to the system's temporary directory.
+    """
+    def __init__(self, budget, message_budget=DEFAULT_MESSAGE_BUDGET,
+                 spill_dir=None):
+        self._budget = budget
+        self._message_budget = message_budget
+        self._spill_dir = spill_dir
+        self._data = bytearray()
+        self._file = None
+        self._map = None
+        self._size = 0
+
+    def size(self):
+        return self._size
+
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, data):
+        length = len(data)
+
+        if self._file is None:
+            if (self._size + length <= self._message_budget and
+                    self._budget.reserve(length)):
+                # Slice assignment takes memoryviews, which extend does not
+                self._data[self._size:] = data
+                self._size += length
+                return
+
+            self._spill()
+
+        self._file.write(data)
+        self._size += length
+
+    def _spill(self):
+        _LOG.debug('Spilling aggregated body of {} bytes to disk'.format(
+            self._size))
+
+        self._file = tempfile.TemporaryFile(dir=self._spill_dir)
+        self._file.write(self._data)
+
+        self._budget.release(len(self._data))
+        self._data = None
+
+    def view(self):
+        """
+        Returns the whole body. Bodies held in memory are returned as a
+        memoryview and spilled ones as a read-only mmap of the file. Both
+        support len, slicing and the buffer protocol. The view is only
+        valid until close is called.
+        """
+        if self._file is None:
+            return memoryview(self._data)
+
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._map
+
+    def close(self):
+        if self._file is not None:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+            self._file.close()
+            self._file = None
+
+        elif self._data is not None:
+            self._budget.release(len(self._data))
+
+        self._data = None
+        self._size = 0
+
+
+"""
+Settings shared by the aggregators a worker creates. Replaced by
+configure_aggregation.
+"""
+_budget = MemoryBudget()
+_message_budget = DEFAULT_MESSAGE_BUDGET
+_spill_dir = None
+
+
+def configure_aggregation(message_budget=DEFAULT_MESSAGE_BUDGET,
+                          worker_budget=DEFAULT_WORKER_BUDGET,
+                          spill_dir=None):
+    """
+    Sets the memory limits for aggregated bodies.
+
+    :param message_budget: The most bytes of a single body kept in memory.
+    :param worker_budget: The most bytes of all bodies being aggregated by
+                          this process kept in memory.
+    :param spill_dir: The directory bodies over either limit are written to.
+    """
+    global _budget, _message_budget, _spill_dir
+
+    _budget = MemoryBudget(worker_budget)
+    _message_budget = message_budget
+    _spill_dir = spill_dir
+
+
+def new_aggregator():
+    """
+    Returns a BodyAggregator using the configured limits.
+    """
+    return BodyAggregator(_budget, _message_budget, _spill_dir)
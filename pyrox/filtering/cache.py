@@ -0,0 +1,372 @@
+import mmap
+import time
+import struct
+import pickle
+import hashlib
+import functools
+import collections
+import multiprocessing
+
+from tornado.concurrent import Future, is_future
+from tornado.ioloop import IOLoop
+
+from pyrox.log import get_logger
+
+_LOG = get_logger(__name__)
+
+
+"""
+Default sizing for decision caches. See DecisionCache.
+"""
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL = 60
+
+"""
+Default sizing for the shared decision store. See SharedDecisionStore.
+"""
+DEFAULT_SHARED_SLOTS = 4096
+DEFAULT_SHARED_SLOT_SIZE = 1024
+
+"""
+Clock used for expiring entries. Wall clock time is used since entries in
+the shared store are read by other processes.
+"""
+clock = time.time
+
+_MISSING = object()
+
+"""
+Each shared store slot starts with the key's digest, the time the entry
+expires and the length of the pickled value that follows.
+"""
+_SLOT_HEADER = struct.Struct('<16sdI')
+
+
+def is_negative(action):
+    """
+    Returns True if a filter decision turns the request away.
+    """
+    return action is not None and not action.should_connect_upstream()
+
+
+def is_cacheable(action):
+    """
+    Returns False for replies with a body source. Writing such a reply
+    consumes its source and changes its response's headers so it can only
+    be used once.
+    """
+    return not (action is not None and action.is_replying() and
+                action.payload[1] is not None)
+
+
+class DecisionCache(object):
+    """
+    A bounded cache of filter decisions. Entries expire after a time to
+    live and once the cache is full, the least recently used entry is
+    evicted to make room for a new one.
+
+    Must be used from the IOLoop's thread.
+
+    :param max_size: The most entries kept.
+    :param ttl: Seconds that decisions letting a request through are kept.
+    :param negative_ttl: Seconds that decisions turning a request away are
+                         kept. Defaults to ttl. A value of 0 stops them from
+                         being cached at all.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL,
+                 negative_ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl_for(self, action):
+        return self._negative_ttl if is_negative(action) else self._ttl
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if entry[0] <= clock():
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        # Reinserting moves the entry to the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, action, ttl=None):
+        if ttl is None:
+            ttl = self.ttl_for(action)
+
+        if ttl <= 0:
+            return
+
+        self._entries.pop(key, None)
+
+        while len(self._entries) >= self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        self._entries[key] = (clock() + ttl, action)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class SharedDecisionStore(object):
+    """
+    A fixed size table of filter decisions in memory shared by the worker
+    processes forked after it is created. Keys are hashed to a single slot
+    and a new entry simply replaces whatever was in its slot. Decisions are
+    pickled into the slot and those that don't fit, such as replies with a
+    body, are not shared.
+
+    Slots are read and written under a process-shared lock. The work done
+    under it is a copy of one slot.
+
+    :param slots: The number of slots in the table.
+    :param slot_size: The size of each slot in bytes.
+    """
+    def __init__(self, slots=DEFAULT_SHARED_SLOTS,
+                 slot_size=DEFAULT_SHARED_SLOT_SIZE):
+        self._slots = slots
+        self._slot_size = slot_size
+        self._max_value = slot_size - _SLOT_HEADER.size
+        self._map = mmap.mmap(-1, slots * slot_size)
+        self._lock = multiprocessing.Lock()
+
+    def _locate(self, key):
+        digest = hashlib.md5(repr(key)).digest()
+        slot = struct.unpack_from('<Q', digest)[0] % self._slots
+        return digest, slot * self._slot_size
+
+    def get(self, key, default=None):
+        entry = self.entry(key)
+        return entry[1] if entry is not None else default
+
+    def entry(self, key):
+        """
+        Returns a tuple of the time the entry for key expires and its value
+        or None if there is no live entry for key.
+        """
+        digest, offset = self._locate(key)
+
+        with self._lock:
+            found, expires, length = _SLOT_HEADER.unpack_from(
+                self._map, offset)
+
+            if found != digest or expires <= clock():
+                return None
+
+            start = offset + _SLOT_HEADER.size
+            value = self._map[start:start + length]
+
+        return expires, pickle.loads(value)
+
+    def put(self, key, action, ttl):
+        try:
+            value = pickle.dumps(action, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return False
+
+        if len(value) > self._max_value:
+            return False
+
+        digest, offset = self._locate(key)
+        start = offset + _SLOT_HEADER.size
+
+        with self._lock:
+            _SLOT_HEADER.pack_into(
+                self._map, offset, digest, clock() + ttl, len(value))
+            self._map[start:start + len(value)] = value
+
+        return True
+
+
+"""
+The store shared between workers. Created by configure_shared_cache in the
+parent process before the workers are forked.
+"""
+_shared_store = None
+
+
+def configure_shared_cache(slots=DEFAULT_SHARED_SLOTS,
+                           slot_size=DEFAULT_SHARED_SLOT_SIZE):
+    """
+    Creates the store that memoized hooks marked as shared use. This must
+    be called before the worker processes are forked.
+    """
+    global _shared_store
+
+    _shared_store = SharedDecisionStore(slots, slot_size)
+    return _shared_store
+
+
+def shared_store():
+    return _shared_store
+
+
+def header_key(name):
+    """
+    Returns a key function for memoize that keys on the first value of the
+    named request header. Requests without the header are not cached.
+    """
+    def key(request_head):
+        header = request_head.get_header(name)
+
+        if header is not None and len(header.values) > 0:
+            return header.values[0]
+        return None
+
+    return key
+
+
+def memoize(key, ttl=DEFAULT_TTL, negative_ttl=None,
+            max_size=DEFAULT_MAX_SIZE, shared=False, namespace=None):
+    """
+    This function decorator may be used on a request head hook to cache the
+    FilterAction it returns by a key taken from the request head. Later
+    requests with the same key get the cached action without the hook
+    being called. Hooks that return a Future have the action cached once it
+    resolves and requests with the same key that arrive in the meantime
+    share the Future rather than calling the hook again. Hooks that raise
+    are not cached, nor are replies with a body source since those may
+    only be sent once.
+
+    Each decorated hook has its own DecisionCache, available as its cache
+    attribute, that is shared by every instance of the filter in the worker.
+    Decisions are kept under the hook's namespace so that subclasses
+    inheriting the hook do not share them. Within a class the key must
+    capture everything the decision depends on.
+    ::
+        class AuthFilter(HttpFilter):
+
+            @handles_request_head
+            @memoize(header_key('X-Auth-Token'), ttl=300, negative_ttl=5)
+            def on_request_head(self, request_head):
+                ...
+
+    :param key: A callable that takes the request head and returns a
+                hashable key, or None if the request should not be cached.
+    :param ttl: See DecisionCache.
+    :param negative_ttl: See DecisionCache.
+    :param max_size: See DecisionCache.
+    :param shared: If True, decisions are also looked up in and written to
+                   the store shared between workers when one has been set
+                   up with configure_shared_cache.
+    :param namespace: The name the hook's keys are kept under. Defaults to
+                      the module, class and name of the hook, taking the
+                      class from the filter instance. Filters given the same
+                      namespace share their decisions.
+    """
+    def decorate(hook):
+        cache = DecisionCache(max_size, ttl, negative_ttl)
+        pending = dict()
+        namespaces = dict()
+
+        def namespace_of(instance):
+            if namespace is not None:
+                return namespace
+
+            cls = type(instance)
+            found = namespaces.get(cls)
+
+            if found is None:
+                found = '{}.{}.{}'.format(
+                    cls.__module__, cls.__name__, hook.__name__)
+                namespaces[cls] = found
+
+            return found
+
+        def remember(scoped_key, action):
+            if not is_cacheable(action):
+                return
+
+            ttl = cache.ttl_for(action)
+            cache.put(scoped_key, action, ttl)
+
+            store = _shared_store
+            if shared and store is not None and ttl > 0:
+                store.put(scoped_key, action, ttl)
+
+        def on_done(scoped_key, future):
+            del pending[scoped_key]
+
+            if future.exception() is None:
+                remember(scoped_key, future.result())
+
+        @functools.wraps(hook)
+        def memoized(self, request_head, *args):
+            cache_key = key(request_head)
+
+            if cache_key is None:
+                return hook(self, request_head, *args)
+
+            scoped_key = (namespace_of(self), cache_key)
+
+            action = cache.get(scoped_key, _MISSING)
+            if action is not _MISSING:
+                return action
+
+            action = pending.get(scoped_key)
+            if action is not None:
+                return action
+
+            store = _shared_store
+            if shared and store is not None:
+                entry = store.entry(scoped_key)
+
+                if entry is not None:
+                    # Keep it only for as long as it has left
+                    expires, action = entry
+                    cache.put(scoped_key, action, expires - clock())
+                    return action
+
+            action = hook(self, request_head, *args)
+
+            if is_future(action):
+                pending[scoped_key] = action
+                callback = functools.partial(on_done, scoped_key)
+
+                if isinstance(action, Future):
+                    action.add_done_callback(callback)
+                else:
+                    # Futures from other sources may complete on another
+                    # thread
+                    IOLoop.current().add_future(action, callback)
+            else:
+                remember(scoped_key, action)
+
+            return action
+
+        memoized.__wrapped__ = hook
+        memoized.cache = cache
+        return memoized
+
+    return decorate
@@ -0,0 +1,131 @@
+import sys
+import functools
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from pyrox.http import retain
+from pyrox.log import get_logger
+
+_LOG = get_logger(__name__)
+
+
+"""
+Default sizing for the offload pool. See configure_offload.
+"""
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 64
+
+
+class OffloadPool(object):
+    """
+    Runs filter hooks on an executor with no more than max_pending of them
+    submitted to it at a time. Calls past that limit wait in line without
+    being submitted. Each call holds up the connection that made it, so
+    clients over the limit are pushed back on by having their reads paused
+    instead of having their data buffered.
+
+    Must be used from the IOLoop's thread.
+
+    :param executor: A concurrent.futures executor to run hooks with.
+    :param max_pending: The most hooks that may be submitted at once.
+    """
+    def __init__(self, executor, max_pending=DEFAULT_MAX_PENDING):
+        self._executor = executor
+        self._max_pending = max_pending
+        self._pending = 0
+        self._waiting = collections.deque()
+
+    def pending(self):
+        return self._pending
+
+    def waiting(self):
+        return len(self._waiting)
+
+    def submit(self, fn, *args):
+        """
+        Schedules fn to be called with args and returns a tornado Future for
+        its result.
+        """
+        future = Future()
+
+        if self._pending < self._max_pending:
+            self._start(future, fn, args)
+        else:
+            self._waiting.append((future, fn, args))
+
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def _start(self, future, fn, args):
+        self._pending += 1
+        work = self._executor.submit(fn, *args)
+        IOLoop.current().add_future(
+            work, functools.partial(self._finished, future))
+
+    def _finished(self, future, work):
+        self._pending -= 1
+
+        # Hand the free slot on before resolving so that the call we resolve
+        # can't jump the line
+        if len(self._waiting) > 0:
+            self._start(*self._waiting.popleft())
+
+        try:
+            future.set_result(work.result())
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+
+
+"""
+The pool used by offloaded hooks. Created on first use so that a worker
+process starts its threads after it has been forked.
+"""
+_pool = None
+
+
+def configure_offload(workers=DEFAULT_WORKERS,
+                      max_pending=DEFAULT_MAX_PENDING):
+    """
+    Sets up the pool offloaded hooks run on, replacing any existing pool.
+
+    :param workers: The number of threads to run hooks on.
+    :param max_pending: The most hooks that may be submitted at once.
+    """
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(False)
+
+    _pool = OffloadPool(ThreadPoolExecutor(workers), max_pending)
+    return _pool
+
+
+def offload_pool():
+    if _pool is None:
+        configure_offload()
+    return _pool
+
+
+def offload(hook):
+    """
+    This function decorator may be used on a filter hook to run it on the
+    offload pool instead of on the IOLoop. It is meant for hooks that spend
+    a long time on the CPU. The connection is held until the hook returns,
+    so body chunks are still seen in order.
+
+    Body parts are copied before the hook is called. Hooks run on threads
+    and so must not touch shared filter state without locking it. Note that
+    a stateless filter is shared by every connection in the worker.
+    """
+    @functools.wraps(hook)
+    def run_offloaded(*args):
+        # Zero-copy body parts are only valid during the call
+        return offload_pool().submit(hook, *[retain(arg) for arg in args])
+
+    run_offloaded.__wrapped__ = hook
+    return run_offloaded
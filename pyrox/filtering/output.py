@@ -0,0 +1,132 @@
+import collections
+
+
+"""
+Starting capacity of a body buffer. This matches the size of the proxy's
+read buffer so that rewriting a whole body part rarely has to grow it.
+"""
+DEFAULT_BUFFER_SIZE = 16384
+
+"""
+The most buffers a pool keeps for reuse.
+"""
+DEFAULT_MAX_POOLED = 256
+
+"""
+Buffers that have grown past this many bytes are dropped rather than
+returned to their pool so that one large rewrite doesn't pin the memory.
+"""
+DEFAULT_MAX_POOLED_SIZE = DEFAULT_BUFFER_SIZE * 4
+
+
+class BodyBuffer(object):
+    """
+    The output given to body filter hooks. Whatever a hook writes is sent on
+    in place of the body part it was given. If nothing is written, or the
+    hook calls pass_through, the body part is sent on as it is without being
+    copied.
+
+    Written bytes are copied into a preallocated bytearray that is reused
+    from one body part to the next. view hands the written bytes to the
+    stream as a memoryview so they're not copied again on the way out.
+    """
+    def __init__(self, size=DEFAULT_BUFFER_SIZE):
+        self._buffer = bytearray(size)
+        self._length = 0
+        self._written = False
+
+    def write(self, data):
+        end = self._length + len(data)
+
+        if end > len(self._buffer):
+            self._grow(end)
+
+        self._buffer[self._length:end] = data
+        self._length = end
+        self._written = True
+
+    def pass_through(self):
+        """
+        Drops anything written so far so that the body part being filtered
+        is sent on unchanged.
+        """
+        self._length = 0
+        self._written = False
+
+    def reset(self):
+        self.pass_through()
+
+    def modified(self):
+        """
+        Returns True if the body part being filtered is to be replaced by
+        what was written, even if that was nothing at all.
+        """
+        return self._written
+
+    def size(self):
+        return self._length
+
+    def capacity(self):
+        return len(self._buffer)
+
+    def view(self):
+        """
+        Returns a memoryview of the written bytes. The view is only valid
+        until the buffer is next written to or reset.
+        """
+        return memoryview(self._buffer)[:self._length]
+
+    def _grow(self, needed):
+        # Views handed out earlier may still be in a stream's write queue
+        # and a bytearray can't be resized while they exist, so a new
+        # buffer is allocated instead
+        grown = bytearray(max(needed, len(self._buffer) * 2))
+        grown[:self._length] = memoryview(self._buffer)[:self._length]
+        self._buffer = grown
+
+
+class BufferPool(object):
+    """
+    Keeps released body buffers for reuse so that each message being
+    filtered doesn't allocate its own.
+
+    Must be used from the IOLoop's thread.
+
+    :param buffer_size: The starting capacity of new buffers.
+    :param max_pooled: The most buffers kept for reuse.
+    :param max_pooled_size: The largest capacity a buffer may have grown to
+                            and still be kept.
+    """
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE,
+                 max_pooled=DEFAULT_MAX_POOLED,
+                 max_pooled_size=DEFAULT_MAX_POOLED_SIZE):
+        self._buffer_size = buffer_size
+        self._max_pooled = max_pooled
+        self._max_pooled_size = max_pooled_size
+        self._free = collections.deque()
+
+    def pooled(self):
+        return len(self._free)
+
+    def acquire(self):
+        if len(self._free) > 0:
+            return self._free.pop()
+        return BodyBuffer(self._buffer_size)
+
+    def release(self, body_buffer):
+        """
+        Returns a buffer to the pool. The buffer must not be used again by
+        the caller and nothing it handed out from view may still be in use.
+        """
+        body_buffer.reset()
+
+        if (len(self._free) < self._max_pooled and
+                body_buffer.capacity() <= self._max_pooled_size):
+            self._free.append(body_buffer)
+
+
+_pool = BufferPool()
+
+
+def buffer_pool():
+    return _pool
@@ -1,8 +1,14 @@
 import inspect
 
-from pyrox.http import HttpResponse
+from tornado.concurrent import Future, chain_future, is_future
+from tornado.ioloop import IOLoop
+
+from pyrox.http import HttpResponse, HttpMessageSelector, SelectorIndex
+from pyrox.http.selection import status_code
 from pyrox.log import get_logger
 
+from . import stats as filter_stats
+
 _LOG = get_logger(__name__)
 
 
@@ -14,6 +20,90 @@ _HANDLES_REQ_HEAD = 'Function instance {} handles request head'
 _HANDLES_REQ_BODY = 'Function instance {} handles request body'
 _HANDLES_RES_HEAD = 'Function instance {} handles response head'
 _HANDLES_RES_BODY = 'Function instance {} handles response body'
+_HANDLES_AGG_REQ_BODY = 'Function instance {} handles aggregated request body'
+_HANDLES_AGG_RES_BODY = (
+    'Function instance {} handles aggregated response body')
+
+
+"""
+Filter hooks. Each entry is the attribute the hook decorator sets, the
+pipeline chain the hook belongs to and the number of arguments, self
+included, that mark a hook as taking only the leading event arguments.
+"""
+_HOOKS = (
+    ('_handles_request_head', '_req_head_chain', 2),
+    ('_handles_request_body', '_req_body_chain', 3),
+    ('_handles_response_head', '_resp_head_chain', 2),
+    ('_handles_response_body', '_resp_body_chain', 3),
+    ('_handles_aggregated_request_body', '_req_agg_chain', 3),
+    ('_handles_aggregated_response_body', '_resp_agg_chain', 3))
+
+_HOOK_LOG_MSGS = {
+    '_handles_request_head': _HANDLES_REQ_HEAD,
+    '_handles_request_body': _HANDLES_REQ_BODY,
+    '_handles_response_head': _HANDLES_RES_HEAD,
+    '_handles_response_body': _HANDLES_RES_BODY,
+    '_handles_aggregated_request_body': _HANDLES_AGG_REQ_BODY,
+    '_handles_aggregated_response_body': _HANDLES_AGG_RES_BODY
+}
+
+"""
+Dispatch plans by filter class. See _dispatch_plan.
+"""
+_DISPATCH_PLANS = dict()
+
+
+def _dispatch_plan(filter_cls):
+    """
+    Returns the dispatch plan for a filter class, building it the first time
+    the class is seen. A plan is a tuple of (chain name, method name, argc,
+    stats key) entries, one per hook the class implements, where argc is
+    the number of event arguments the hook is called with or None if it
+    takes them all.
+    """
+    plan = _DISPATCH_PLANS.get(filter_cls)
+
+    if plan is None:
+        entries = list()
+
+        for name, func in inspect.getmembers(filter_cls, inspect.ismethod):
+            _LOG.debug(_CHECKING_DECORATORS.format(func))
+            # Look through decorators such as gen.coroutine
+            target = getattr(func, '__wrapped__', func)
+            nargs = len(inspect.getargspec(target).args)
+
+            # Assume that if an attribute exists then it is decorated
+            for hook_attr, chain_name, short_nargs in _HOOKS:
+                if hasattr(func, hook_attr):
+                    _LOG.debug(_HOOK_LOG_MSGS[hook_attr].format(func))
+                    argc = short_nargs - 1 if nargs == short_nargs else None
+                    entries.append((chain_name, name, argc, '{}.{}.{}'.format(
+                        filter_cls.__module__, filter_cls.__name__, name)))
+
+        plan = tuple(entries)
+        _DISPATCH_PLANS[filter_cls] = plan
+
+    return plan
+
+
+"""
+Selector indexes by the tuple of selectors they were built from. Pipelines
+built from the same template share selectors and so share an index.
+"""
+_SELECTOR_INDEXES = dict()
+_MAX_SELECTOR_INDEXES = 256
+
+
+def _selector_index(selectors):
+    index = _SELECTOR_INDEXES.get(selectors)
+
+    if index is None:
+        index = SelectorIndex(selectors)
+
+        if len(_SELECTOR_INDEXES) < _MAX_SELECTOR_INDEXES:
+            _SELECTOR_INDEXES[selectors] = index
+
+    return index
 
 
 """
@@ -83,6 +173,11 @@ def handles_request_head(request_func):
     handles_request_head will accept an HttpRequest object and implement
     the logic that will define the FilterActions to be applied
     to the request
+
+    A method that needs to wait on I/O may return a tornado Future, such as
+    the one returned by a gen.coroutine, that resolves to the FilterAction.
+    The connection is suspended until the Future resolves. Other
+    connections are not held up.
     """
     request_func._handles_request_head = True
     return request_func
@@ -96,6 +191,14 @@ def handles_request_body(request_func):
     handles_request_body will intercept the HTTP content in chunks as it
     arrives. This method, like others in the filter class may return a
     FilterAction.
+
+    When running inside the proxy, body chunks are memoryview slices of the
+    proxy's read buffer and are only valid for the duration of the call.
+    Filters that need to keep a chunk must copy it with pyrox.http.retain.
+
+    The output passed alongside the chunk is a BodyBuffer. Anything written
+    to it is sent on in place of the chunk. Chunks that nothing is written
+    for are sent on unchanged without being copied.
     """
     request_func._handles_request_body = True
     return request_func
@@ -109,6 +212,8 @@ def handles_response_head(request_func):
     handles_response_head will accept an HttpResponse object and implement
     the logic that will define the FilterActions to be applied
     to the request
+
+    As with handles_request_head, the method may return a Future.
     """
     request_func._handles_response_head = True
     return request_func
@@ -122,11 +227,92 @@ def handles_response_body(request_func):
     handles_response_body will intercept the HTTP content in chunks as they
     arrives. This method, like others in the filter class, may return a
     FilterAction.
+
+    As with handles_request_body, body chunks are only valid for the
+    duration of the call. Use pyrox.http.retain to keep them. Rewritten
+    chunks are written to the BodyBuffer output.
     """
     request_func._handles_response_body = True
     return request_func
 
 
+def handles_aggregated_request_body(request_func):
+    """
+    This function decorator may be used to mark a method as usable for
+    intercepting the whole of a request body at once. It is meant for
+    filters, such as validators, that can't work on the body a chunk at a
+    time.
+
+    The method is called once the request has been read, after any
+    handles_request_body methods have seen each chunk, with the body and a
+    BodyBuffer output. The body is a memoryview, or an mmap if it grew past
+    the configured memory budget, and is only valid for the duration of the
+    call. Anything written to the output replaces the body. This method,
+    like others in the filter class, may return a FilterAction or a Future.
+
+    The request is not sent upstream until the body has been aggregated, so
+    a rejection here stops the request from ever reaching the origin.
+    """
+    request_func._handles_aggregated_request_body = True
+    return request_func
+
+
+def handles_aggregated_response_body(request_func):
+    """
+    This function decorator may be used to mark a method as usable for
+    intercepting the whole of a response body at once. The method is
+    called with the body, a BodyBuffer output and optionally the request
+    head, as with handles_aggregated_request_body.
+
+    The response head is held back until the body has been aggregated, so
+    the method may still reject the response.
+    """
+    request_func._handles_aggregated_response_body = True
+    return request_func
+
+
+def stateless(filter_cls):
+    """
+    This class decorator may be used to mark a filter class as keeping no
+    per-connection state. Pipeline templates create a single instance of a
+    stateless filter and share it between every pipeline they build, so the
+    filter must be safe to use from many connections at once.
+    """
+    filter_cls._stateless = True
+    return filter_cls
+
+
+def is_stateless(http_filter):
+    """
+    Returns True if the given filter, or its class, was marked with the
+    stateless decorator.
+    """
+    return getattr(http_filter, '_stateless', False) is True
+
+
+def selects(**criteria):
+    """
+    This class decorator may be used to limit the messages a filter sees.
+    It takes the same keyword arguments as HttpMessageSelector. The
+    pipeline only passes a filter the requests it selects and, for
+    response hooks, the responses to them that it selects.
+    ::
+        @selects(path_prefix='/v1/', interested_methods=('PUT', 'POST'))
+        class MyFilter(HttpFilter):
+            ...
+
+    Filters may also set a _selector attribute to an HttpMessageSelector
+    themselves.
+    """
+    selector = HttpMessageSelector(**criteria)
+
+    def decorate(filter_cls):
+        filter_cls._selector = selector
+        return filter_cls
+
+    return decorate
+
+
 class HttpFilter(object):
     """
     HttpFilter is a marker class that may be utilized for dynamic gathering
@@ -194,7 +380,8 @@ def route(upstream_target):
     upstream response.
 
     :param upstream_target: the URI string of the upstream target to route
-                            to.
+                            to or a target resolved ahead of time with
+                            pyrox.server.routing.resolve_route.
     """
     return FilterAction(ROUTE, upstream_target)
 
@@ -207,75 +394,169 @@ def next():
     return _DEFAULT_PASS_ACTION
 
 
+def _action_name(action):
+    return _ACTION_NAMES[action.kind] if action else 'NEXT_FILTER'
+
+
+def _timed_call(stats, key, method, args):
+    started = filter_stats.clock()
+
+    try:
+        action = method(*args)
+    except Exception as ex:
+        _LOG.exception(ex)
+        action = reject()
+        stats.record(key, filter_stats.clock() - started,
+                     _action_name(action), True)
+        return action
+
+    if is_future(action):
+        # Time the hook until it has decided
+        def on_done(future):
+            try:
+                name, raised = _action_name(future.result()), False
+            except Exception:
+                name, raised = _action_name(reject()), True
+
+            stats.record(key, filter_stats.clock() - started, name, raised)
+
+        if isinstance(action, Future):
+            action.add_done_callback(on_done)
+        else:
+            IOLoop.current().add_future(action, on_done)
+    else:
+        stats.record(key, filter_stats.clock() - started,
+                     _action_name(action))
+
+    return action
+
+
 class HttpFilterPipeline(object):
     """
     The filter pipeline represents a series of filters. This pipeline currently
     serves bidirectional filtering (request and response). This chain will have
     the request head and response head events passed through it during the
-    lifecycle of a client request. Each request is assigned a new copy of the
-    chain, meaning that state may not be shared between requests during the
-    lifetime of the filter chain or its filters.
+    lifecycle of a client request. Each connection is assigned a new copy of
+    the chain, meaning that state may not be shared between connections
+    during the lifetime of the filter chain or its filters. The exception is
+    filters marked stateless, which a PipelineTemplate shares between every
+    pipeline it builds.
 
 
     :param chain: A list of HttpFilter objects organized to act as a pipeline
                   with element 0 being the first to receive events.
+    :param stats: An optional FilterStats object to record the time each
+                  filter hook takes and the actions it returns.
     """
-    def __init__(self):
-        self._req_head_chain = list()
-        self._req_body_chain = list()
-        self._resp_head_chain = list()
-        self._resp_body_chain = list()
+    def __init__(self, stats=None):
+        # Stats collection is skipped entirely when this is None
+        self.stats = stats
+
+        # Chains are tuples so that pipelines built from a template may share
+        # them. Adding a filter builds a new tuple and never touches the
+        # shared one.
+        self._req_head_chain = ()
+        self._req_body_chain = ()
+        self._resp_head_chain = ()
+        self._resp_body_chain = ()
+        self._req_agg_chain = ()
+        self._resp_agg_chain = ()
+
+        # Selectors of the filters in the pipeline and the selections made
+        # for the message currently in each direction. A selection of None
+        # lets every filter see the message.
+        self._selectors = ()
+        self._index = None
+        self._req_selection = None
+        self._resp_selection = None
 
     def intercepts_req_body(self):
-        return len(self._req_body_chain) > 0
+        return len(self._req_body_chain) > 0 or self.aggregates_req_body()
 
     def intercepts_resp_body(self):
-        return len(self._resp_body_chain) > 0
+        return len(self._resp_body_chain) > 0 or self.aggregates_resp_body()
 
-    def add_filter(self, http_filter):
-        filter_methods = inspect.getmembers(http_filter, inspect.ismethod)
+    def aggregates_req_body(self):
+        return len(self._req_agg_chain) > 0
 
-        for method in filter_methods:
-            if len(method) < 1:
-                continue
+    def aggregates_resp_body(self):
+        return len(self._resp_agg_chain) > 0
 
-            finst = method[1]
-            _LOG.debug(_CHECKING_DECORATORS.format(finst))
-
-            # Assume that if an attribute exists then it is decorated
-            if hasattr(finst, '_handles_request_head'):
-                _LOG.debug(_HANDLES_REQ_HEAD.format(finst))
-                self._req_head_chain.append((http_filter, finst))
-
-            if hasattr(finst, '_handles_request_body'):
-                _LOG.debug(_HANDLES_REQ_BODY.format(finst))
-                self._req_body_chain.append((http_filter, finst))
-
-            if hasattr(finst, '_handles_response_head'):
-                _LOG.debug(_HANDLES_RES_HEAD.format(finst))
-                self._resp_head_chain.append((http_filter, finst))
-
-            if hasattr(finst, '_handles_response_body'):
-                _LOG.debug(_HANDLES_RES_BODY.format(finst))
-                self._resp_body_chain.append((http_filter, finst))
-
-    def _on_head(self, chain, *args):
-        last_action = next()
-
-        for http_filter, method in chain:
-            try:
-                argspec = inspect.getargspec(method)
+    def add_filter(self, http_filter):
+        selector = getattr(http_filter, '_selector', None)
+        self._add_selectors((selector,))
+
+        for chain_name, method_name, argc, key in _dispatch_plan(
+                http_filter.__class__):
+            entry = (http_filter, getattr(http_filter, method_name), argc,
+                     selector, key)
+            setattr(self, chain_name, getattr(self, chain_name) + (entry,))
+
+    def extend(self, pipeline):
+        """
+        Appends the filters of another pipeline to this one.
+        """
+        self._add_selectors(pipeline._selectors)
+        self._req_head_chain += pipeline._req_head_chain
+        self._req_body_chain += pipeline._req_body_chain
+        self._resp_head_chain += pipeline._resp_head_chain
+        self._resp_body_chain += pipeline._resp_body_chain
+        self._req_agg_chain += pipeline._req_agg_chain
+        self._resp_agg_chain += pipeline._resp_agg_chain
+
+    def copy(self):
+        """
+        Returns a new pipeline with the same filters as this one. The filter
+        chains are shared until either pipeline has a filter added to it.
+        """
+        pipeline = HttpFilterPipeline(self.stats)
+        pipeline.extend(self)
+        return pipeline
+
+    def _add_selectors(self, selectors):
+        for selector in selectors:
+            if selector is not None and selector not in self._selectors:
+                self._selectors += (selector,)
+                self._index = None
+
+    def _select(self, method=None, path=None, status=None):
+        if len(self._selectors) == 0:
+            return None
+
+        if self._index is None:
+            self._index = _selector_index(self._selectors)
+
+        return self._index.select(method, path, status)
+
+    def _run_chain(self, chain, selection, *args):
+        return self._run_from(chain, 0, next(), args, selection)
+
+    def _run_from(self, chain, start, last_action, args, selection=None):
+        stats = self.stats
+
+        for index in range(start, len(chain)):
+            http_filter, method, argc, selector, key = chain[index]
+
+            # Skip filters that did not select this message
+            if (selection is not None and selector is not None and
+                    selector not in selection):
+                continue
 
-                if len(argspec.args) == 2:
-                    action = method(*args[0:1])
-                else:
-                    action = method(*args)
+            if stats is not None:
+                action = _timed_call(stats, key, method, args[:argc])
+            else:
+                try:
+                    action = method(*args[:argc])
+                except Exception as ex:
+                    _LOG.exception(ex)
+                    action = reject()
 
-            except Exception as ex:
-                _LOG.exception(ex)
-                action = reject()
+            if is_future(action):
+                # The rest of the chain runs once the filter has decided
+                return self._await_action(
+                    action, chain, index + 1, last_action, args, selection)
 
-            if action is not None:
+            if action:
                 last_action = action
 
                 if action.breaks_pipeline():
@@ -283,35 +564,160 @@ class HttpFilterPipeline(object):
 
         return last_action
 
-    def _on_body(self, chain, *args):
-        last_action = next()
+    def _await_action(self, pending, chain, start, last_action, args,
+                      selection):
+        result = Future()
 
-        for http_filter, method in chain:
+        def on_done(pending):
             try:
-                argspec = inspect.getargspec(method)
-                if len(argspec.args) == 3:
-                    action = method(*args[0:2])
-                else:
-                    action = method(*args)
+                action = pending.result()
             except Exception as ex:
                 _LOG.exception(ex)
                 action = reject()
 
-            if action:
-                last_action = action
-                if action.breaks_pipeline():
-                    break
+            if not action:
+                action = last_action
+            elif action.breaks_pipeline():
+                result.set_result(action)
+                return
 
-        return last_action
+            rest = self._run_from(chain, start, action, args, selection)
+
+            if is_future(rest):
+                chain_future(rest, result)
+            else:
+                result.set_result(rest)
+
+        if isinstance(pending, Future):
+            pending.add_done_callback(on_done)
+        else:
+            # Futures from other sources may complete on another thread
+            IOLoop.current().add_future(pending, on_done)
+
+        return result
 
     def on_request_head(self, request_head):
-        return self._on_head(self._req_head_chain, request_head)
+        """
+        Passes the request head through the request head filters. Returns
+        the resulting FilterAction or, if a filter returned a Future, a
+        Future that resolves to it once the rest of the chain has run.
+        """
+        self._req_selection = self._select(
+            request_head.method, request_head.url)
+        return self._run_chain(
+            self._req_head_chain, self._req_selection, request_head)
 
     def on_request_body(self, body_part, output):
-        return self._on_body(self._req_body_chain, body_part, output)
+        """
+        Passes a request body part through the request body filters. As
+        with on_request_head this returns either a FilterAction or a Future.
+        """
+        return self._run_chain(
+            self._req_body_chain, self._req_selection, body_part, output)
 
     def on_response_head(self, *args):
-        return self._on_head(self._resp_head_chain, *args)
+        """
+        Passes the response head through the response head filters. As with
+        on_request_head this returns either a FilterAction or a Future.
+        """
+        if len(self._selectors) > 0:
+            response_head = args[0]
+            request_head = args[1] if len(args) > 1 else None
+            status = status_code(response_head.status)
+
+            if request_head is not None:
+                self._resp_selection = self._select(
+                    request_head.method, request_head.url, status)
+            else:
+                self._resp_selection = self._select(status=status)
+
+        return self._run_chain(
+            self._resp_head_chain, self._resp_selection, *args)
 
     def on_response_body(self, *args):
-        return self._on_body(self._resp_body_chain, *args)
+        """
+        Passes a response body part through the response body filters. As
+        with on_request_head this returns either a FilterAction or a Future.
+        """
+        return self._run_chain(
+            self._resp_body_chain, self._resp_selection, *args)
+
+    def on_aggregated_request_body(self, body, output):
+        """
+        Passes a whole request body through the aggregated request body
+        filters. As with on_request_head this returns either a FilterAction
+        or a Future.
+        """
+        return self._run_chain(
+            self._req_agg_chain, self._req_selection, body, output)
+
+    def on_aggregated_response_body(self, *args):
+        """
+        Passes a whole response body through the aggregated response body
+        filters. As with on_request_head this returns either a FilterAction
+        or a Future.
+        """
+        return self._run_chain(
+            self._resp_agg_chain, self._resp_selection, *args)
+
+
+class PipelineTemplate(object):
+    """
+    A pipeline template builds HttpFilterPipeline objects from a list of
+    filter factories. The template is meant to be created once per worker.
+    Filters marked with the stateless decorator are created once, when the
+    template is, and shared by every pipeline the template builds. All other
+    filters are created anew for each pipeline. Filter order is preserved.
+
+    :param filter_factories: A list of callables that each return a filter
+                             instance. A factory is taken to make stateless
+                             filters if it is, or is a functools.partial of,
+                             a class marked stateless.
+    :param share_all: If True, every filter is created once and shared
+                      regardless of whether it is marked stateless.
+    :param stats: An optional FilterStats object given to every pipeline
+                  the template builds.
+    """
+    def __init__(self, filter_factories, share_all=False, stats=None):
+        self._stats = stats
+        self._segments = list()
+        shared = None
+
+        for factory in filter_factories:
+            # Stateful filters are only created when a pipeline is built
+            if share_all or is_stateless(getattr(factory, 'func', factory)):
+                # Consecutive shared filters are bound into one segment
+                if shared is None:
+                    shared = HttpFilterPipeline(stats)
+                    self._segments.append(shared)
+                shared.add_filter(factory())
+            else:
+                self._segments.append(factory)
+                shared = None
+
+        # A template made entirely of shared filters hands out copies of a
+        # single prebuilt pipeline
+        if len(self._segments) == 0:
+            self._prototype = HttpFilterPipeline(stats)
+        elif len(self._segments) == 1 and shared is not None:
+            self._prototype = shared
+        else:
+            self._prototype = None
+
+    def build(self):
+        """
+        Returns a new HttpFilterPipeline. This method may be used directly as
+        a pipeline factory.
+        """
+        if self._prototype is not None:
+            return self._prototype.copy()
+
+        pipeline = HttpFilterPipeline(self._stats)
+
+        for segment in self._segments:
+            if isinstance(segment, HttpFilterPipeline):
+                pipeline.extend(segment)
+            else:
+                pipeline.add_filter(segment())
+
+        return pipeline
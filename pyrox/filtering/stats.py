@@ -0,0 +1,148 @@
+import time
+
+from pyrox.log import get_logger
+
+_LOG = get_logger(__name__)
+
+
+"""
+Latency histograms have a bucket per power of two microseconds. Bucket n
+counts calls that took less than 2 ** n microseconds and the last bucket
+takes everything slower.
+"""
+HISTOGRAM_BUCKETS = 24
+
+"""
+Clock used for timing hooks.
+"""
+clock = time.time
+
+
+class HookStats(object):
+    """
+    Numbers kept for a single filter hook.
+
+    Attributes:
+        calls       The number of times the hook was called.
+        total_time  The total time spent in the hook in seconds. For hooks
+                    that return a Future this is the time until it resolved.
+        histogram   A list of call counts by latency. See HISTOGRAM_BUCKETS.
+        actions     A dict of call counts by the name of the FilterAction
+                    kind the hook returned.
+        exceptions  The number of calls that raised.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+        self.actions = dict()
+        self.exceptions = 0
+
+    def mean(self):
+        return self.total_time / self.calls if self.calls > 0 else 0.0
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound, in seconds, of the histogram bucket that
+        the given percentile of calls falls in.
+        """
+        wanted = self.calls * percent / 100.0
+        seen = 0
+
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+
+            if count > 0 and seen >= wanted:
+                return (1 << bucket) / 1000000.0
+
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'total_time': self.total_time,
+            'histogram': list(self.histogram),
+            'actions': dict(self.actions),
+            'exceptions': self.exceptions
+        }
+
+
+class FilterStats(object):
+    """
+    Collects per filter, per hook numbers from the pipelines it is given
+    to. Hooks are keyed by '<module>.<class>.<method>' of the filter.
+
+    Pipelines without a FilterStats object skip all of this.
+    """
+    def __init__(self):
+        self._hooks = dict()
+
+    def _hook(self, key):
+        hook_stats = self._hooks.get(key)
+
+        if hook_stats is None:
+            hook_stats = HookStats()
+            self._hooks[key] = hook_stats
+
+        return hook_stats
+
+    def record(self, key, elapsed, action_name, raised=False):
+        hook_stats = self._hook(key)
+        hook_stats.calls += 1
+        hook_stats.total_time += elapsed
+
+        bucket = int(elapsed * 1000000).bit_length()
+        hook_stats.histogram[min(bucket, HISTOGRAM_BUCKETS - 1)] += 1
+
+        hook_stats.actions[action_name] = (
+            hook_stats.actions.get(action_name, 0) + 1)
+
+        if raised:
+            hook_stats.exceptions += 1
+
+    def get(self, key):
+        """
+        Returns the HookStats for a hook or None if it hasn't been called.
+        """
+        return self._hooks.get(key)
+
+    def snapshot(self):
+        """
+        Returns a dict of hook keys to dicts of their numbers.
+        """
+        return dict(
+            (key, hook_stats.as_dict())
+            for key, hook_stats in self._hooks.items())
+
+    def reset(self):
+        self._hooks.clear()
+
+    def format(self):
+        """
+        Returns the numbers as lines of text, slowest hooks first.
+        """
+        lines = list()
+        by_total = sorted(
+            self._hooks.items(), key=lambda item: -item[1].total_time)
+
+        for key, hook_stats in by_total:
+            lines.append(
+                '{}: calls={} total={:.3f}ms mean={:.1f}us p50<{:.1f}us '
+                'p99<{:.1f}us exceptions={} actions={}'.format(
+                    key,
+                    hook_stats.calls,
+                    hook_stats.total_time * 1000,
+                    hook_stats.mean() * 1000000,
+                    hook_stats.percentile(50) * 1000000,
+                    hook_stats.percentile(99) * 1000000,
+                    hook_stats.exceptions,
+                    ', '.join('{}={}'.format(name, count) for name, count
+                              in sorted(hook_stats.actions.items()))))
+
+        return '\n'.join(lines)
+
+    def dump(self):
+        """
+        Writes the numbers to the log at INFO.
+        """
+        _LOG.info('Filter stats:\n{}'.format(self.format()))
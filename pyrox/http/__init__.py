@@ -1,2 +1,4 @@
-from .parser import RequestParser, ResponseParser, ParserDelegate
+from .parser import (RequestParser, ResponseParser, ParserDelegate, RawHead,
+                     retain)
 from .model import HttpHeader, HttpMessage, HttpRequest, HttpResponse
+from .selection import HttpMessageSelector, SelectorIndex
@@ -1,8 +1,29 @@
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern as a builtin
+    pass
+
 from .model_util import request_to_bytes, response_to_bytes
+from .parser import KNOWN_HEADER_NAMES
 
 
 _EMPTY_HEADER_VALUES = ()
 
+"""
+Header dictionary keys for the header names the parser interns. Reusing the
+same interned key objects lets header lookups hit on identity.
+"""
+_HEADER_KEYS = dict(
+    (name, intern(name.lower())) for name in KNOWN_HEADER_NAMES)
+
+
+def _header_key(name):
+    key = _HEADER_KEYS.get(name)
+    if key is None:
+        key = name.lower()
+    return key
+
 
 class HttpHeader(object):
     """
@@ -33,12 +54,27 @@ class HttpMessage(object):
                     used as a holding place for data that other filters
                     may then access and utilize. Setting entries in this
                     dictionary does not modify the HTTP model in anyway.
+
+    A message may be backed by the RawHead the parser read it from. When it
+    is, headers are only turned into HttpHeader objects when they are looked
+    up by name. Accessing the headers attribute materializes every header
+    that has not been looked up yet.
+
+    A message that is backed by a RawHead and has not been modified is
+    serialized by handing back the raw head as-is. Adding or removing
+    headers, changing the values of a header or changing the start line
+    marks the message as modified. Accessing the headers attribute does as
+    well since the message can no longer tell what was done to them.
     """
     def __init__(self, version='1.1'):
         self.version = version
         self.local_data = dict()
 
         self._headers = dict()
+        self._raw_head = None
+        self._raw_removed = None
+        self._raw_line = None
+        self._dirty = False
         self.set_default_headers()
 
     def set_default_headers(self):
@@ -50,8 +86,84 @@ class HttpMessage(object):
 
     @property
     def headers(self):
+        if self._raw_head is not None:
+            self._materialize_raw_head()
         return self._headers
 
+    def load_raw_head(self, raw_head):
+        """
+        Backs the headers of this message with the given RawHead. Headers
+        already set on the message take precedence over raw headers of the
+        same name.
+        """
+        self._raw_head = raw_head
+        self._raw_removed = set()
+        self._raw_line = self._start_line()
+
+    def _start_line(self):
+        return (self.version,)
+
+    def is_modified(self):
+        """
+        Returns False if this message is backed by a RawHead and nothing has
+        been changed since it was loaded. Returns True otherwise.
+        """
+        raw_head = self._raw_head
+
+        if raw_head is None or self._dirty:
+            return True
+
+        if self._start_line() != self._raw_line:
+            return True
+
+        for nameval, header in self._headers.items():
+            found = raw_head.get(nameval)
+
+            if found is None or found[0] != header.name:
+                return True
+
+            if found[1] != header.values:
+                return True
+
+        return False
+
+    def _raw_header(self, nameval):
+        if nameval in self._raw_removed:
+            return None
+
+        found = self._raw_head.get(nameval)
+        if found is None:
+            return None
+
+        header = HttpHeader(found[0])
+        header.values = found[1]
+        self._headers[nameval] = header
+        return header
+
+    def _materialize_raw_head(self):
+        headers = self._headers
+        skip = self._raw_removed.union(headers)
+
+        for name, value in self._raw_head.items():
+            nameval = _header_key(name)
+            if nameval in skip:
+                continue
+
+            header = headers.get(nameval, None)
+            if not header:
+                header = HttpHeader(name)
+                headers[nameval] = header
+            header.values.append(value)
+
+        self._raw_head = None
+        self._raw_removed = None
+
+    def _find_header(self, nameval):
+        header = self._headers.get(nameval, None)
+        if not header and self._raw_head is not None:
+            header = self._raw_header(nameval)
+        return header
+
     def header(self, name):
         """
         Returns the header that matches the name via case-insensitive matching.
@@ -59,13 +171,50 @@ class HttpMessage(object):
         message and returned. If the header already exists, then it is
         returned.
         """
-        nameval = name.lower()
-        header = self._headers.get(nameval, None)
+        nameval = _header_key(name)
+        header = self._find_header(nameval)
         if not header:
             header = HttpHeader(name)
             self._headers[nameval] = header
+            self._dirty = True
         return header
 
+    def set_header(self, name, value):
+        """
+        Sets the header that matches the name via case-insensitive matching
+        to a single value. If the message has not been modified, the value
+        is spliced into its RawHead instead so that the message may still be
+        serialized as-is.
+        """
+        if not self.is_modified():
+            raw_head = self._raw_head.replace_value(name, value)
+
+            if raw_head is not None:
+                self._raw_head = raw_head
+
+                header = self._headers.get(_header_key(name), None)
+                if header:
+                    header.values = [value]
+                return
+
+        self.replace_header(name).values.append(value)
+
+    def add_headers(self, headers):
+        """
+        Adds a sequence of (name, value) tuples to the message in one pass.
+        Values for names that match via case-insensitive matching are
+        appended to the same header in the order given.
+        """
+        for name, value in headers:
+            nameval = _header_key(name)
+            header = self._find_header(nameval)
+            if not header:
+                header = HttpHeader(name)
+                self._headers[nameval] = header
+            header.values.append(value)
+
+        self._dirty = True
+
     def replace_header(self, name):
         """
         Returns a new header with a field set to name. If the header exists
@@ -80,7 +229,7 @@ class HttpMessage(object):
         Unlike the header function, if the header does not exist then a None
         result is returned.
         """
-        return self._headers.get(name.lower(), None)
+        return self._find_header(_header_key(name))
 
     def remove_header(self, name):
         """
@@ -88,11 +237,17 @@ class HttpMessage(object):
         If the header exists, it is removed and a result of True is returned.
         If the header does not exist then a result of False is returned.
         """
-        nameval = name.lower()
-        if nameval in self._headers:
-            del self._headers[nameval]
-            return True
-        return False
+        nameval = _header_key(name)
+        removed = self._headers.pop(nameval, None) is not None
+
+        if self._raw_head is not None and nameval not in self._raw_removed:
+            if nameval in self._raw_head:
+                self._raw_removed.add(nameval)
+                removed = True
+
+        if removed:
+            self._dirty = True
+        return removed
 
 
 class HttpRequest(HttpMessage):
@@ -111,7 +266,12 @@ class HttpRequest(HttpMessage):
         self.method = None
         self.url = None
 
+    def _start_line(self):
+        return (self.method, self.url, self.version)
+
     def to_bytes(self):
+        if not self.is_modified():
+            return self._raw_head.data
         return request_to_bytes(self)
 
 
@@ -129,5 +289,10 @@ class HttpResponse(HttpMessage):
         super(HttpResponse, self).__init__()
         self.status = None
 
+    def _start_line(self):
+        return (self.status, self.version)
+
     def to_bytes(self):
+        if not self.is_modified():
+            return self._raw_head.data
         return response_to_bytes(self)
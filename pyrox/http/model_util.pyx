@@ -1,43 +1,72 @@
-from cpython.version cimport PY_MAJOR_VERSION
-from libc.string cimport strlen
+from cpython.bytes cimport (PyBytes_FromStringAndSize, PyBytes_AS_STRING,
+                            PyBytes_GET_SIZE)
+from libc.string cimport memcpy
 
 
-cdef unicode _ustring(s):
-    if type(s) is unicode:
-        return <unicode>s
+cdef bytes _CRLF = b'\r\n'
+cdef bytes _SP = b' '
+cdef bytes _HTTP_VERSION_PREFIX = b'HTTP/'
+cdef bytes _VALUE_DELIMITER = b', '
+cdef bytes _DEFAULT_CONTENT_LENGTH = b'Content-Length: 0\r\n'
 
-    elif PY_MAJOR_VERSION < 3 and isinstance(s, bytes):
-        return (<bytes>s).decode('ascii')
+"""
+Cache of encoded 'Name: ' prefixes keyed by header name. Common names are
+seeded here and others are added as they are seen, up to a bound so that
+arbitrary client supplied names can not grow the cache without limit.
+"""
+cdef dict _HEADER_PREFIXES = dict()
+cdef size_t _MAX_HEADER_PREFIXES = 512
+
+
+cdef bytes _bytes(object s):
+    if type(s) is bytes:
+        return <bytes>s
 
     elif isinstance(s, unicode):
-        return unicode(s)
+        return (<unicode>s).encode('utf8')
+
+    elif isinstance(s, memoryview):
+        return s.tobytes()
 
     else:
-        raise TypeError('Unable to marshal string')
+        return bytes(s)
+
 
+cdef bytes _header_prefix(object name):
+    cdef object prefix = _HEADER_PREFIXES.get(name)
 
-cdef char * _cstr(s):
-    cdef unicode ustr = _ustring(s)
-    return ustr.encode('utf8')
+    if prefix is None:
+        prefix = _bytes(name) + b': '
 
+        if len(_HEADER_PREFIXES) < _MAX_HEADER_PREFIXES:
+            _HEADER_PREFIXES[name] = prefix
 
-cdef header_to_bytes(char *name, object values, object bytes):
-    bytes.extend(name)
-    bytes.extend(b': ')
+    return <bytes>prefix
 
-    if len(values) > 0:
-        bytes.extend(values[0])
 
-    for value in values[1:]:
-        bytes.extend(b', ')
-        bytes.extend(value)
+for _name in (
+        'Accept', 'Accept-Encoding', 'Accept-Language', 'Authorization',
+        'Cache-Control', 'Connection', 'Content-Encoding', 'Content-Length',
+        'Content-Type', 'Cookie', 'Date', 'ETag', 'Expect', 'Expires',
+        'Host', 'Keep-Alive', 'Last-Modified', 'Location', 'Pragma',
+        'Server', 'Set-Cookie', 'Transfer-Encoding', 'User-Agent', 'Vary',
+        'Via', 'X-Forwarded-For'):
+    _HEADER_PREFIXES[_name] = _bytes(_name) + b': '
+    _HEADER_PREFIXES[_name.lower()] = _bytes(_name.lower()) + b': '
 
-    bytes.extend(b'\r\n')
 
+cdef inline char *_put(char *dest, bytes part):
+    cdef Py_ssize_t length = PyBytes_GET_SIZE(part)
+    memcpy(dest, PyBytes_AS_STRING(part), length)
+    return dest + length
 
-cdef headers_to_bytes(object headers, object bytes):
-    cdef int needs_content_length = True
-    cdef int has_transfer_encoding = False
+
+cdef Py_ssize_t _headers_size(object headers,
+                              bint *add_content_length) except -1:
+    cdef bint needs_content_length = True
+    cdef bint has_transfer_encoding = False
+    cdef Py_ssize_t size = 0
+    cdef Py_ssize_t values
 
     for name, header in headers.items():
         if needs_content_length and name == 'content-length':
@@ -46,32 +75,94 @@ cdef headers_to_bytes(object headers, object bytes):
         if not has_transfer_encoding and name == 'transfer-encoding':
             has_transfer_encoding = True
 
-        header_to_bytes(header.name, header.values, bytes)
+        size += PyBytes_GET_SIZE(_header_prefix(header.name))
+
+        values = 0
+        for value in header.values:
+            size += PyBytes_GET_SIZE(_bytes(value))
+            values += 1
+
+        if values > 1:
+            size += (values - 1) * PyBytes_GET_SIZE(_VALUE_DELIMITER)
+
+        size += PyBytes_GET_SIZE(_CRLF)
+
+    add_content_length[0] = (needs_content_length and
+                             not has_transfer_encoding)
+    if add_content_length[0]:
+        size += PyBytes_GET_SIZE(_DEFAULT_CONTENT_LENGTH)
+
+    return size + PyBytes_GET_SIZE(_CRLF)
+
+
+cdef char *_write_headers(object headers, char *dest,
+                          bint add_content_length):
+    cdef bint first
+
+    for name, header in headers.items():
+        dest = _put(dest, _header_prefix(header.name))
+
+        first = True
+        for value in header.values:
+            if not first:
+                dest = _put(dest, _VALUE_DELIMITER)
+            dest = _put(dest, _bytes(value))
+            first = False
+
+        dest = _put(dest, _CRLF)
 
-    if needs_content_length and not has_transfer_encoding:
-        header_to_bytes('Content-Length', '0', bytes)
+    if add_content_length:
+        dest = _put(dest, _DEFAULT_CONTENT_LENGTH)
 
-    bytes.extend(b'\r\n')
+    return _put(dest, _CRLF)
 
 
 def request_to_bytes(object http_request):
-    bytes = bytearray()
-    bytes.extend(http_request.method)
-    bytes.extend(b' ')
-    bytes.extend(http_request.url)
-    bytes.extend(b' HTTP/')
-    bytes.extend(http_request.version)
-    bytes.extend(b'\r\n')
-    headers_to_bytes(http_request.headers, bytes)
-    return str(bytes)
+    cdef bytes method = _bytes(http_request.method)
+    cdef bytes url = _bytes(http_request.url)
+    cdef bytes version = _bytes(http_request.version)
+    cdef bint add_content_length
+    cdef Py_ssize_t size = (
+        PyBytes_GET_SIZE(method) + PyBytes_GET_SIZE(url) +
+        PyBytes_GET_SIZE(version) + 2 * PyBytes_GET_SIZE(_SP) +
+        PyBytes_GET_SIZE(_HTTP_VERSION_PREFIX) + PyBytes_GET_SIZE(_CRLF))
+
+    size += _headers_size(http_request.headers, &add_content_length)
+
+    # The head is written straight into a buffer of exactly its size
+    cdef bytes head = PyBytes_FromStringAndSize(NULL, size)
+    cdef char *dest = PyBytes_AS_STRING(head)
+
+    dest = _put(dest, method)
+    dest = _put(dest, _SP)
+    dest = _put(dest, url)
+    dest = _put(dest, _SP)
+    dest = _put(dest, _HTTP_VERSION_PREFIX)
+    dest = _put(dest, version)
+    dest = _put(dest, _CRLF)
+    _write_headers(http_request.headers, dest, add_content_length)
+    return head
 
 
 def response_to_bytes(object http_response):
-    bytes = bytearray()
-    bytes.extend(b'HTTP/')
-    bytes.extend(http_response.version)
-    bytes.extend(b' ')
-    bytes.extend(http_response.status)
-    bytes.extend(b'\r\n')
-    headers_to_bytes(http_response.headers, bytes)
-    return str(bytes)
+    cdef bytes version = _bytes(http_response.version)
+    cdef bytes status = _bytes(http_response.status)
+    cdef bint add_content_length
+    cdef Py_ssize_t size = (
+        PyBytes_GET_SIZE(_HTTP_VERSION_PREFIX) + PyBytes_GET_SIZE(version) +
+        PyBytes_GET_SIZE(_SP) + PyBytes_GET_SIZE(status) +
+        PyBytes_GET_SIZE(_CRLF))
+
+    size += _headers_size(http_response.headers, &add_content_length)
+
+    # The head is written straight into a buffer of exactly its size
+    cdef bytes head = PyBytes_FromStringAndSize(NULL, size)
+    cdef char *dest = PyBytes_AS_STRING(head)
+
+    dest = _put(dest, _HTTP_VERSION_PREFIX)
+    dest = _put(dest, version)
+    dest = _put(dest, _SP)
+    dest = _put(dest, status)
+    dest = _put(dest, _CRLF)
+    _write_headers(http_response.headers, dest, add_content_length)
+    return head
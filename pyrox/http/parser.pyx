@@ -1,25 +1,99 @@
-from libc.string cimport strlen
+from libc.string cimport strlen, memcpy, memcmp, strncasecmp
 from libc.stdlib cimport malloc, free
 
 from cpython cimport bool, PyBytes_FromStringAndSize, PyBytes_FromString
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
 
-from parser cimport http_parser_type, http_parser, http_parser_settings, http_parser_init, free_http_parser, http_parser_exec, http_should_keep_alive, http_transfer_encoding_chunked
+from parser cimport http_parser_type, http_parser, http_parser_settings, http_header_span, http_parser_init, free_http_parser, http_parser_set_options, http_parser_pause, http_parser_is_paused, http_parser_exec, http_should_keep_alive, http_transfer_encoding_chunked, O_BATCH_HEADERS, O_RAW_CHUNKS
 
 import traceback
 
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern as a builtin
+    pass
+
 _REQUEST_PARSER = 0
 _RESPONSE_PARSER = 1
 
-def RequestParser(parser_delegate):
-    return HttpEventParser(parser_delegate, _REQUEST_PARSER)
+"""
+Methods and header names common enough that the parser hands out shared,
+interned objects for them instead of allocating new strings every time
+they are read. Header names are matched as they appear on the wire, in
+either their canonical or all lowercase form.
+"""
+KNOWN_METHODS = tuple(intern(m) for m in (
+    'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH', 'TRACE',
+    'CONNECT'))
+
+KNOWN_HEADER_NAMES = tuple(intern(n) for name in (
+    'Accept', 'Accept-Charset', 'Accept-Encoding', 'Accept-Language',
+    'Accept-Ranges', 'Age', 'Allow', 'Authorization', 'Cache-Control',
+    'Connection', 'Content-Encoding', 'Content-Language', 'Content-Length',
+    'Content-Range', 'Content-Type', 'Cookie', 'Date', 'ETag', 'Expect',
+    'Expires', 'Host', 'If-Match', 'If-Modified-Since', 'If-None-Match',
+    'Keep-Alive', 'Last-Modified', 'Location', 'Origin', 'Pragma', 'Range',
+    'Referer', 'Server', 'Set-Cookie', 'Transfer-Encoding', 'Upgrade',
+    'User-Agent', 'Vary', 'Via', 'WWW-Authenticate', 'X-Auth-Token',
+    'X-Forwarded-For', 'X-Forwarded-Host', 'X-Forwarded-Proto',
+    'X-Request-Id') for n in (name, name.lower()))
+
+cdef size_t _MAX_INTERNED_LENGTH = 32
+
+
+cdef list _interned_by_length(tuple names):
+    cdef list buckets = [list() for _ in range(_MAX_INTERNED_LENGTH)]
+
+    for name in names:
+        buckets[len(name)].append(name)
+
+    return [tuple(bucket) for bucket in buckets]
+
+
+cdef list _METHODS_BY_LENGTH = _interned_by_length(KNOWN_METHODS)
+cdef list _HEADER_NAMES_BY_LENGTH = _interned_by_length(KNOWN_HEADER_NAMES)
 
-def ResponseParser(parser_delegate):
-    return HttpEventParser(parser_delegate, _RESPONSE_PARSER)
+
+cdef bytes _interned(list by_length, const char *data, size_t length):
+    cdef tuple candidates
+    cdef bytes candidate
+
+    if 0 < length < _MAX_INTERNED_LENGTH:
+        candidates = <tuple>by_length[length]
+
+        for candidate in candidates:
+            if (PyBytes_AS_STRING(candidate)[0] == data[0] and
+                    memcmp(PyBytes_AS_STRING(candidate), data, length) == 0):
+                return candidate
+
+    return PyBytes_FromStringAndSize(data, length)
+
+def RequestParser(parser_delegate, **options):
+    return HttpEventParser(parser_delegate, _REQUEST_PARSER, **options)
+
+def ResponseParser(parser_delegate, **options):
+    return HttpEventParser(parser_delegate, _RESPONSE_PARSER, **options)
+
+
+def retain(object body_part):
+    """
+    Returns a copy of a body part that is safe to keep after the on_body
+    callback that received it returns. Parsers running in zero-copy mode
+    hand out memoryview slices of the buffer being parsed; these slices are
+    only valid for the duration of the callback since the buffer is reused
+    for the next read. Body parts that are already owned by the caller are
+    returned as-is.
+    """
+    if isinstance(body_part, memoryview):
+        return body_part.tobytes()
+    return body_part
 
 
 cdef int on_req_method(http_parser *parser, char *data, size_t length) except -1:
     cdef object app_data = <object> parser.app_data
-    cdef object method_str = PyBytes_FromStringAndSize(data, length)
+    cdef object method_str = _interned(_METHODS_BY_LENGTH, data, length)
     app_data.delegate.on_req_method(method_str)
     return 0
 
@@ -41,7 +115,8 @@ cdef int on_http_version(http_parser *parser) except -1:
 
 cdef int on_header_field(http_parser *parser, char *data, size_t length) except -1:
     cdef object app_data = <object> parser.app_data
-    cdef object header_field = PyBytes_FromStringAndSize(data, length)
+    cdef object header_field = _interned(
+        _HEADER_NAMES_BY_LENGTH, data, length)
     app_data.delegate.on_header_field(header_field)
     return 0
 
@@ -51,14 +126,61 @@ cdef int on_header_value(http_parser *parser, char *data, size_t length) except
     app_data.delegate.on_header_value(header_value)
     return 0
 
+cdef list header_list(http_parser *parser):
+    cdef list headers = list()
+    cdef char *head = parser.head.bytes
+    cdef http_header_span *span
+    cdef size_t idx
+
+    for idx in range(parser.header_count):
+        span = &parser.header_spans[idx]
+        headers.append((
+            _interned(_HEADER_NAMES_BY_LENGTH,
+                head + span.field_offset, span.field_length),
+            PyBytes_FromStringAndSize(
+                head + span.value_offset, span.value_length)))
+
+    return headers
+
+cdef bytes _ascii(object s):
+    return s if isinstance(s, bytes) else s.encode('ascii')
+
+cdef RawHead raw_head(http_parser *parser):
+    cdef RawHead head = RawHead.__new__(RawHead)
+    cdef size_t spans_size = sizeof(http_header_span) * parser.header_count
+
+    head.data = PyBytes_FromStringAndSize(
+        parser.head.bytes, parser.head.position)
+    head.count = parser.header_count
+    head.spans = <http_header_span *> malloc(spans_size)
+    memcpy(head.spans, parser.header_spans, spans_size)
+
+    return head
+
 cdef int on_headers_complete(http_parser *parser) except -1:
-    cdef object app_data = <object> parser.app_data
-    app_data.delegate.on_headers_complete()
+    cdef ParserData app_data = <ParserData> parser.app_data
+
+    if parser.options & O_BATCH_HEADERS:
+        if app_data.lazy_headers:
+            app_data.delegate.on_headers_complete(raw_head(parser))
+        else:
+            app_data.delegate.on_headers_complete(header_list(parser))
+    else:
+        app_data.delegate.on_headers_complete()
     return 0
 
 cdef int on_body(http_parser *parser, char *data, size_t length) except -1:
-    cdef object app_data = <object> parser.app_data
-    cdef object body_value = PyBytes_FromStringAndSize(data, length)
+    cdef ParserData app_data = <ParserData> parser.app_data
+    cdef object body_value
+    cdef size_t offset
+
+    if app_data.body_view is not None:
+        # Zero-copy mode - slice the view of the buffer being parsed
+        offset = data - app_data.body_base
+        body_value = app_data.body_view[offset:offset + length]
+    else:
+        body_value = PyBytes_FromStringAndSize(data, length)
+
     app_data.delegate.on_body(
         body_value,
         length,
@@ -93,7 +215,7 @@ class ParserDelegate(object):
     def on_header_value(self, value):
         pass
 
-    def on_headers_complete(self):
+    def on_headers_complete(self, headers=None):
         pass
 
     def on_body(self, bytes, length, is_chunked):
@@ -103,21 +225,230 @@ class ParserDelegate(object):
         pass
 
 
+cdef class RawHead(object):
+    """
+    The head of a HTTP message as it was read off the wire along with an
+    index of where each header's field and value sit within it. Header
+    strings are only created when a header is looked up.
+
+    Attributes:
+        data        The raw bytes of the message head, starting at the
+                    request or status line and ending with the blank line
+                    that terminates the head.
+    """
+
+    cdef readonly bytes data
+    cdef http_header_span *spans
+    cdef size_t count
+
+    def __dealloc__(self):
+        if self.spans != NULL:
+            free(self.spans)
+            self.spans = NULL
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        return self._find(name, 0) >= 0
+
+    cdef long _find(self, object name, size_t start):
+        cdef bytes bname = _ascii(name)
+        cdef char *cname = bname
+        cdef size_t length = len(bname)
+        cdef char *data = self.data
+        cdef http_header_span *span
+        cdef size_t idx
+
+        for idx in range(start, self.count):
+            span = &self.spans[idx]
+
+            if span.field_length == length and strncasecmp(
+                    data + span.field_offset, cname, length) == 0:
+                return idx
+
+        return -1
+
+    def get(self, name):
+        """
+        Returns a tuple of the header's field name as it appears in the head
+        and a list of its values for the header that matches the name via
+        case-insensitive matching. If the header does not exist then a None
+        result is returned.
+        """
+        cdef char *data = self.data
+        cdef http_header_span *span
+        cdef list values
+        cdef long idx = self._find(name, 0)
+
+        if idx < 0:
+            return None
+
+        span = &self.spans[idx]
+        field = _interned(_HEADER_NAMES_BY_LENGTH,
+            data + span.field_offset, span.field_length)
+        values = list()
+
+        while idx >= 0:
+            span = &self.spans[idx]
+            values.append(PyBytes_FromStringAndSize(
+                data + span.value_offset, span.value_length))
+            idx = self._find(name, idx + 1)
+
+        return (field, values)
+
+    def replace_value(self, name, value):
+        """
+        Returns a new RawHead with the value of the header that matches the
+        name via case-insensitive matching replaced. If the header does not
+        exist then it is added directly after the start line. If the header
+        appears more than once then a None result is returned.
+        """
+        cdef bytes bname = _ascii(name)
+        cdef bytes bvalue = _ascii(value)
+        cdef long idx = self._find(bname, 0)
+        cdef RawHead head
+        cdef http_header_span *span
+        cdef size_t start, end, shift_from, count
+        cdef long delta
+
+        if idx >= 0 and self._find(bname, idx + 1) >= 0:
+            return None
+
+        head = RawHead.__new__(RawHead)
+
+        if idx >= 0:
+            count = self.count
+            head.spans = <http_header_span *> malloc(
+                sizeof(http_header_span) * count)
+            memcpy(head.spans, self.spans, sizeof(http_header_span) * count)
+
+            span = &head.spans[idx]
+            start = span.value_offset
+            end = start + span.value_length
+            delta = len(bvalue) - <long> span.value_length
+
+            head.data = self.data[:start] + bvalue + self.data[end:]
+            span.value_length = len(bvalue)
+            shift_from = idx + 1
+        else:
+            count = self.count + 1
+            head.spans = <http_header_span *> malloc(
+                sizeof(http_header_span) * count)
+            memcpy(&head.spans[1], self.spans,
+                sizeof(http_header_span) * self.count)
+
+            # Insert after the start line, before the first header or the
+            # blank line that terminates the head
+            if self.count > 0:
+                start = self.spans[0].field_offset
+            else:
+                start = len(self.data) - 2
+
+            line = bname + b': ' + bvalue + b'\r\n'
+            delta = len(line)
+
+            head.data = self.data[:start] + line + self.data[start:]
+            span = &head.spans[0]
+            span.field_offset = start
+            span.field_length = len(bname)
+            span.value_offset = start + len(bname) + 2
+            span.value_length = len(bvalue)
+            shift_from = 1
+
+        head.count = count
+
+        for idx in range(shift_from, count):
+            span = &head.spans[idx]
+            span.field_offset += delta
+            span.value_offset += delta
+
+        return head
+
+    def items(self):
+        """
+        Returns a list of (name, value) tuples for every header in the order
+        they were read.
+        """
+        cdef char *data = self.data
+        cdef http_header_span *span
+        cdef list headers = list()
+        cdef size_t idx
+
+        for idx in range(self.count):
+            span = &self.spans[idx]
+            headers.append((
+                _interned(_HEADER_NAMES_BY_LENGTH,
+                    data + span.field_offset, span.field_length),
+                PyBytes_FromStringAndSize(
+                    data + span.value_offset, span.value_length)))
+
+        return headers
+
+
 cdef class ParserData(object):
 
     cdef public object delegate
+    cdef public bint zero_copy_body
+    cdef public bint lazy_headers
+    cdef object body_view
+    cdef const char *body_base
 
-    def __init__(self, object delegate):
+    def __init__(self, object delegate, bint zero_copy_body=False,
+                 bint lazy_headers=False):
         self.delegate = delegate
+        self.zero_copy_body = zero_copy_body
+        self.lazy_headers = lazy_headers
+        self.body_view = None
+        self.body_base = NULL
 
 
 cdef class HttpEventParser(object):
+    """
+    Event driven HTTP parser. Parsed elements of the message are passed to
+    the delegate as they are read.
+
+    When zero_copy_body is set, body content is passed to the delegate's
+    on_body method as a memoryview slice of the data handed to execute
+    instead of a copy. The slice is only valid until on_body returns; see
+    retain for keeping body content past that point.
+
+    When batch_headers is set, the delegate's on_header_field and
+    on_header_value methods are not called. Instead, the header offsets
+    are collected while parsing and the whole header block is passed to
+    on_headers_complete as a list of (name, value) tuples in the order
+    they were read.
+
+    When lazy_headers is set, headers are collected as with batch_headers
+    but on_headers_complete is passed a RawHead instead of a list. No
+    header strings are created until they are looked up.
+
+    When raw_chunks is set, chunked bodies are passed to on_body as they
+    were read, chunk framing included, instead of as decoded chunk data.
+    The parser still follows the framing to find the end of the message,
+    which comes at the end of the last-chunk line. The blank line that
+    follows it is left to be skipped as the next message starts.
+
+    A delegate may call pause from within a callback to stop the parser
+    right after the element being delivered. Whatever remains of the data
+    passed to execute is kept by the parser and parsed when resume is
+    called. Data passed to execute while paused is kept as well. If the
+    element delivered was the last of a message, on_message_complete is
+    only called once the parser is resumed.
+    """
 
     cdef http_parser *_parser
     cdef http_parser_settings _settings
-    cdef object app_data
+    cdef ParserData app_data
+    cdef bytes _remainder
+    cdef bint _executing
+    cdef bint _destroyed
+
+    def __init__(self, object delegate, kind=_REQUEST_PARSER,
+                 zero_copy_body=False, batch_headers=False,
+                 lazy_headers=False, raw_chunks=False):
+        cdef unsigned char options = 0
 
-    def __init__(self, object delegate, kind=_REQUEST_PARSER):
         # set parser type
         if kind == _REQUEST_PARSER:
             parser_type = HTTP_REQUEST
@@ -130,7 +461,15 @@ cdef class HttpEventParser(object):
         self._parser = <http_parser *> malloc(sizeof(http_parser))
         http_parser_init(self._parser, parser_type)
 
-        self.app_data = ParserData(delegate)
+        if batch_headers or lazy_headers:
+            options |= O_BATCH_HEADERS
+
+        if raw_chunks:
+            options |= O_RAW_CHUNKS
+
+        http_parser_set_options(self._parser, options)
+
+        self.app_data = ParserData(delegate, zero_copy_body, lazy_headers)
         self._parser.app_data = <void *>self.app_data
 
         # set callbacks
@@ -145,35 +484,117 @@ cdef class HttpEventParser(object):
         self._settings.on_message_complete = <http_cb>on_message_complete
 
     def destroy(self):
-        if self._parser != NULL:
+        self._remainder = None
+
+        if self._parser == NULL:
+            return
+
+        if self._executing:
+            # A callback is destroying the parser mid-execute. Stop parsing
+            # and leave freeing it to _execute once the C parser is done.
+            http_parser_pause(self._parser, 1)
+            self._destroyed = True
+        else:
             free_http_parser(self._parser)
             self._parser = NULL
 
+    def pause(self):
+        """
+        Stops the parser once the callback currently running returns. Does
+        nothing if the parser has been destroyed.
+        """
+        if self._parser != NULL:
+            http_parser_pause(self._parser, 1)
+
+    def resume(self):
+        """
+        Unpauses the parser and parses any data that was held while it was
+        paused. Callbacks may pause the parser again while this happens.
+        """
+        cdef bytes remainder
+
+        if self._parser == NULL:
+            return
+
+        http_parser_pause(self._parser, 0)
+
+        # Called from a callback the parser simply carries on once the
+        # callback returns
+        if self._executing:
+            return
+
+        # Run even without held data so that a message that ended while
+        # paused is completed
+        remainder = self._remainder if self._remainder is not None else b''
+        self._remainder = None
+        self.execute(remainder)
+
+    def is_paused(self):
+        return self._parser != NULL and http_parser_is_paused(self._parser)
+
     def __dealloc__(self):
         self.destroy()
 
     def execute(self, object data):
-        cdef object strval
+        cdef Py_buffer buffer
+        cdef size_t consumed = 0
 
-        if isinstance(data, str) or isinstance(data, bytes):
-            strval = data
-        else:
-            if isinstance(data, list) or isinstance(data, bytearray):
-                strval = str(data)
-            else:
-                raise Exception('Can not coerce type: {} into str.'.format(
-                    type(data)))
+        # Read straight out of anything that exposes a buffer (str, bytes,
+        # bytearray, memoryview) without copying it first
+        try:
+            PyObject_GetBuffer(data, &buffer, PyBUF_SIMPLE)
+        except TypeError:
+            raise Exception('Can not coerce type: {} into str.'.format(
+                type(data)))
 
-        self._execute(strval, len(data))
+        try:
+            if self._parser != NULL and http_parser_is_paused(self._parser):
+                self._hold(<char *>buffer.buf, buffer.len)
+                return
+
+            if self.app_data.zero_copy_body:
+                self.app_data.body_base = <const char *>buffer.buf
+                self.app_data.body_view = (
+                    data if isinstance(data, memoryview)
+                    else memoryview(data))
+
+            self._execute(<char *>buffer.buf, buffer.len, &consumed)
+
+            # The buffer may be reused once we return so anything left
+            # over from a pause must be copied
+            if self._parser != NULL and consumed < <size_t> buffer.len:
+                self._hold(<char *>buffer.buf + consumed,
+                           buffer.len - consumed)
+        finally:
+            self.app_data.body_view = None
+            self.app_data.body_base = NULL
+            PyBuffer_Release(&buffer)
+
+    cdef _hold(self, char *data, size_t length):
+        cdef bytes held = PyBytes_FromStringAndSize(data, length)
+
+        if self._remainder is None:
+            self._remainder = held
+        else:
+            self._remainder += held
 
-    cdef int _execute(self, char *data, size_t length) except -1:
+    cdef int _execute(self, char *data, size_t length,
+                      size_t *consumed) except -1:
         cdef int retval
         try:
             if self._parser == NULL:
                 raise Exception('Parser destroyed or not initialized!')
 
-            retval = http_parser_exec(
-                self._parser, &self._settings, data, length)
+            self._executing = True
+            try:
+                retval = http_parser_exec(
+                    self._parser, &self._settings, data, length, consumed)
+            finally:
+                self._executing = False
+
+                if self._destroyed:
+                    self.destroy()
+
             if retval:
                 raise Exception('Failed with errno: {}'.format(retval))
         except Exception as ex:
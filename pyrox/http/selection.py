@@ -1,59 +1,217 @@
-class HttpMessageSelector(object):
+import re
+
+
+"""
+Python 2 caps a regular expression at 100 groups so path expressions are
+combined in batches of this many.
+"""
+_PATH_RES_PER_BATCH = 40
+
+_DEFAULT_RE_FLAGS = re.compile('').flags
+
+
+def status_code(status):
+    """
+    Returns the integer status code of a status such as 200, '200' or
+    '200 OK', or None if it can't be read.
+    """
+    try:
+        return int(str(status)[:3])
+    except ValueError:
+        return None
 
+
+class HttpMessageSelector(object):
+    """
+    Describes the HTTP messages a filter is interested in. Every criterion
+    is optional and a criterion left unset matches everything.
+
+    :param path_re: A regular expression that request URLs must match
+                    from their start.
+    :param interested_codes: Response status codes of interest.
+    :param interested_methods: Request methods of interest.
+    :param path_prefix: A prefix that request URLs must start with.
+    """
     def __init__(
             self,
-            path_re,
+            path_re=None,
             interested_codes=None,
-            interested_methods=None):
-        self.interested_codes =\
-            interested_codes if interested_codes else list()
-        self.interested_methods =\
-            interested_methods if interested_codes else list()
-        self.path_re = re.compile(path_re)
+            interested_methods=None,
+            path_prefix=None):
+        self.interested_codes = frozenset(
+            int(code) for code in interested_codes or ())
+        self.interested_methods = frozenset(
+            method.upper() for method in interested_methods or ())
+        self.path_re = re.compile(path_re) if path_re is not None else None
+        self.path_prefix = path_prefix or None
 
     def wants_status(self, status_code):
-        return status_code in self.interested_codes
+        return (len(self.interested_codes) == 0 or
+                int(status_code) in self.interested_codes)
 
     def wants_path(self, path):
-        return self.path_re.matches(path)
-
-    def wants_method(self, method):
-        return method.lower() in self.interested_methods
-
+        if self.path_prefix is not None and not path.startswith(
+                self.path_prefix):
+            return False
 
-class FilterOptions(object):
+        return self.path_re is None or self.path_re.match(path) is not None
 
-    def __init__(self, selector):
-        self.selector = selector
+    def wants_method(self, method):
+        return (len(self.interested_methods) == 0 or
+                method.upper() in self.interested_methods)
+
+
+class SelectorIndex(object):
+    """
+    Works out which of a group of selectors want a message. Rather than
+    asking each selector in turn, the index looks the method up in a map,
+    walks the URL down a trie of path prefixes and matches it once against
+    a regular expression combined from every selector's path_re.
+
+    Each selector is given a bit and the lookups above each produce a mask
+    of the selectors they pass. Selectors without a given criterion have
+    their bit set in that criterion's mask regardless of the message.
+    """
+    def __init__(self, selectors):
+        self.selectors = tuple(selectors)
+        self._all = (1 << len(self.selectors)) - 1
+
+        self._methods = dict()
+        self._any_method = 0
+        self._prefixes = dict()
+        self._any_prefix = 0
+        self._codes = dict()
+        self._any_code = 0
+        self._path_res = list()
+        self._any_path_re = 0
+        self._selections = dict()
+
+        path_res = list()
+
+        for index, selector in enumerate(self.selectors):
+            bit = 1 << index
+
+            if selector.interested_methods:
+                for method in selector.interested_methods:
+                    self._methods[method] = self._methods.get(method, 0) | bit
+            else:
+                self._any_method |= bit
+
+            if selector.interested_codes:
+                for code in selector.interested_codes:
+                    self._codes[code] = self._codes.get(code, 0) | bit
+            else:
+                self._any_code |= bit
+
+            if selector.path_prefix is not None:
+                self._add_prefix(selector.path_prefix, bit)
+            else:
+                self._any_prefix |= bit
+
+            if selector.path_re is not None:
+                path_res.append((selector.path_re, bit))
+            else:
+                self._any_path_re |= bit
+
+        for start in range(0, len(path_res), _PATH_RES_PER_BATCH):
+            self._combine(path_res[start:start + _PATH_RES_PER_BATCH])
+
+    def _add_prefix(self, prefix, bit):
+        # Each trie node is a dict of next characters. The mask of the
+        # prefixes ending at a node is kept under None.
+        node = self._prefixes
+
+        for char in prefix:
+            node = node.setdefault(char, dict())
+
+        node[None] = node.get(None, 0) | bit
+
+    def _combine(self, path_res):
+        combinable = list()
+
+        for regex, bit in path_res:
+            # Expressions with groups of their own would have them, and
+            # any backreferences to them, renumbered by the combined
+            # pattern's groups so they're matched on their own
+            if regex.flags == _DEFAULT_RE_FLAGS and regex.groups == 0:
+                combinable.append((regex, bit))
+            else:
+                self._path_res.append((regex, ((0, bit),)))
+
+        if len(combinable) == 0:
+            return
+
+        # Every expression becomes an optional lookahead at the start of
+        # the URL so that one match tells us all of the ones that matched
+        pattern = ''.join(
+            '(?:(?=(?P<_s{}>{}))|)'.format(index, regex.pattern)
+            for index, (regex, bit) in enumerate(combinable))
+
+        try:
+            combined = re.compile(pattern)
+        except re.error:
+            for regex, bit in combinable:
+                self._path_res.append((regex, ((0, bit),)))
+            return
+
+        self._path_res.append((combined, tuple(
+            ('_s{}'.format(index), bit)
+            for index, (regex, bit) in enumerate(combinable))))
+
+    def _match_prefixes(self, path):
+        mask = self._any_prefix
+        node = self._prefixes
+
+        for char in path:
+            node = node.get(char)
+
+            if node is None:
+                break
+
+            mask |= node.get(None, 0)
+
+        return mask
+
+    def _match_path_res(self, path):
+        mask = self._any_path_re
+
+        for regex, groups in self._path_res:
+            match = regex.match(path)
+
+            if match is not None:
+                for group, bit in groups:
+                    if match.group(group) is not None:
+                        mask |= bit
 
+        return mask
 
-class FilterHandler(http.ParserDelegate):
+    def select(self, method=None, path=None, status=None):
+        """
+        Returns the frozenset of selectors that want a message with the
+        given method, request URL and status code. Criteria passed as None
+        are not checked.
+        """
+        mask = self._all
 
-    def __init__(self, filter_chain, options):
-        self.filter_chain = filter_chain
-        self.options = options
-        self.is_interested = False
-        self.current_header_field = None
+        if method is not None:
+            mask &= (self._methods.get(method.upper(), 0) |
+                     self._any_method)
 
-    def on_status(self, status_code):
-        if self.options.selector.wants_status(status_code):
-            self.is_interested = True
+        if mask and path is not None:
+            mask &= self._match_prefixes(path)
 
-    def on_req_method(self, method):
-        if self.options.selector.wants_method(method):
-            self.is_interested = True
+            if mask:
+                mask &= self._match_path_res(path)
 
-    def on_req_path(self, url):
-        if self.is_interested and not self.options.selector.wants_path(url):
-            self.is_interested = False
+        if mask and status is not None:
+            mask &= self._codes.get(status, 0) | self._any_code
 
-    def on_header_field(self, field):
-        if self.is_interested:
-            self.current_header_field = field
+        selection = self._selections.get(mask)
 
-    def on_header_value(self, value):
-        if self.is_interested:
-            self.filter_chain.on_header(self.current_header_field, value)
+        if selection is None:
+            selection = frozenset(
+                selector for index, selector in enumerate(self.selectors)
+                if mask >> index & 1)
+            self._selections[mask] = selection
 
-    def on_message_complete(self):
-        self.is_interested = False
+        return selection
@@ -13,10 +13,25 @@ _DEFAULTS = {
         'key_file': None
     },
     'routing': {
-        'upstream_hosts': None
+        'upstream_hosts': None,
+        'balancer': 'round_robin',
+        'hash_key': 'path',
+        'failure_backoff': 1.0,
+        'max_failure_backoff': 30.0,
+        'health_check_path': None,
+        'health_check_interval': 5.0,
+        'health_check_timeout': 2.0
     },
     'pipeline': {
-        'use_singletons': False
+        'use_singletons': False,
+        'offload_workers': 4,
+        'offload_max_pending': 64,
+        'collect_stats': False,
+        'aggregate_message_budget': 1048576,
+        'aggregate_worker_budget': 67108864,
+        'aggregate_spill_dir': None,
+        'shared_cache_slots': 0,
+        'shared_cache_slot_size': 1024
     },
     'templates': {
         'pyrox_error_sc': 502,
@@ -30,6 +45,16 @@ _DEFAULTS = {
 }
 
 
+"""
+Options in the pipeline section that are not filter aliases.
+"""
+_PIPELINE_OPTIONS = ('upstream', 'downstream', 'use_singletons',
+                     'offload_workers', 'offload_max_pending',
+                     'collect_stats', 'aggregate_message_budget',
+                     'aggregate_worker_budget', 'aggregate_spill_dir',
+                     'shared_cache_slots', 'shared_cache_slot_size')
+
+
 def _split_and_strip(values_str, split_on):
     if split_on in values_str:
         return (value.strip() for value in values_str.split(split_on))
@@ -48,6 +73,24 @@ def _host_tuple(host_str):
         raise ConfigurationError('Malformed host: {}'.format(host_str))
 
 
+def _weighted_host(host_str):
+    parts = host_str.split()
+
+    if len(parts) == 1:
+        return (parts[0], 1)
+
+    if len(parts) == 2 and parts[1].startswith('weight='):
+        try:
+            weight = int(parts[1][len('weight='):])
+        except ValueError:
+            weight = -1
+
+        if weight >= 0:
+            return (parts[0], weight)
+
+    raise ConfigurationError('Malformed upstream host: {}'.format(host_str))
+
+
 def load_pyrox_config(location):
     if location is None:
         location = '/etc/pyrox/pyrox.conf'
@@ -229,6 +272,99 @@ class PipelineConfiguration(ConfigurationPart):
         """
         return self.getboolean('use_singletons')
 
+    @property
+    def collect_stats(self):
+        """
+        Returns a boolean value representing whether or not Pyrox should
+        record the time each filter hook takes and the actions it returns.
+        Each Pyrox process writes what it has recorded to the log at INFO
+        when sent SIGUSR1. If left unset this option defaults to false.
+        ::
+            collect_stats = True
+        """
+        return self.getboolean('collect_stats')
+
+    @property
+    def offload_workers(self):
+        """
+        Returns the number of threads each Pyrox process runs filter hooks
+        marked with the offload decorator on. If left unset this option
+        defaults to 4.
+        ::
+            offload_workers = 4
+        """
+        return self.getint('offload_workers')
+
+    @property
+    def offload_max_pending(self):
+        """
+        Returns the number of offloaded filter hooks each Pyrox process may
+        have running or queued on its threads at once. Connections past this
+        limit stop being read from until their turn comes up. If left unset
+        this option defaults to 64.
+        ::
+            offload_max_pending = 64
+        """
+        return self.getint('offload_max_pending')
+
+    @property
+    def aggregate_message_budget(self):
+        """
+        Returns the number of bytes of a single message body that filters
+        handling aggregated bodies may have held in memory. Larger bodies
+        are written to a temporary file. If left unset this option defaults
+        to 1048576 (1MB).
+        ::
+            aggregate_message_budget = 1048576
+        """
+        return self.getint('aggregate_message_budget')
+
+    @property
+    def aggregate_worker_budget(self):
+        """
+        Returns the number of bytes of all the message bodies being
+        aggregated that each Pyrox process may hold in memory. Bodies that
+        don't fit are written to a temporary file. If left unset this option
+        defaults to 67108864 (64MB).
+        ::
+            aggregate_worker_budget = 67108864
+        """
+        return self.getint('aggregate_worker_budget')
+
+    @property
+    def aggregate_spill_dir(self):
+        """
+        Returns the directory that aggregated message bodies over budget
+        are written to. If left unset the system's temporary directory is
+        used.
+        ::
+            aggregate_spill_dir = /var/tmp/pyrox
+        """
+        return self.get('aggregate_spill_dir')
+
+    @property
+    def shared_cache_slots(self):
+        """
+        Returns the number of slots in the table of filter decisions that
+        Pyrox processes share. Filter hooks memoized with shared set look
+        decisions up in it. If left unset this option defaults to 0, which
+        disables the shared table.
+        ::
+            shared_cache_slots = 4096
+        """
+        return self.getint('shared_cache_slots')
+
+    @property
+    def shared_cache_slot_size(self):
+        """
+        Returns the size in bytes of each slot in the shared table of filter
+        decisions. Decisions too large for a slot are only cached by the
+        process that made them. If left unset this option defaults to 1024.
+        ::
+            shared_cache_slot_size = 1024
+        """
+        return self.getint('shared_cache_slot_size')
+
     @property
     def upstream(self):
         """
@@ -266,7 +402,7 @@ class PipelineConfiguration(ConfigurationPart):
     def _filter_dict(self):
         filters = dict()
         for key in self.options():
-            if key == 'downstream' or key == 'upstream':
+            if key in _PIPELINE_OPTIONS:
                 continue
 
             value = self.get(key)
@@ -329,13 +465,108 @@ class RoutingConfiguration(ConfigurationPart):
         """
         Returns a list of downstream hosts to proxy requests to. This may be
         set to either a single valid URL string or a comma delimited list of
-        valid URI strings. This option defaults to http://localhost:80 if
-        left unset.
+        valid URI strings. Each URL may be followed by a weight for the
+        weighted_round_robin balancer. Hosts without one have a weight of 1.
+        This option defaults to http://localhost:80 if left unset.
         ::
-            upstream_hosts = http://host:port, https://host:port
+            upstream_hosts = http://host:port weight=3, https://host:port
+        """
+        weights = self.upstream_weights
+
+        if weights is not None:
+            return [url for url, weight in weights]
+        return None
+
+    @property
+    def upstream_weights(self):
+        """
+        Returns a list of (URL, weight) tuples for the hosts set in
+        upstream_hosts.
         """
         hosts = self.get('upstream_hosts')
 
         if hosts is not None:
-            return [host for host in _split_and_strip(hosts, ',')]
+            return [_weighted_host(host.strip())
+                    for host in _split_and_strip(hosts, ',')]
         return None
+
+    @property
+    def balancer(self):
+        """
+        Returns the name of the way requests are spread over the upstream
+        hosts. This may be round_robin, which takes each host in turn,
+        least_outstanding, which picks the host with the fewest requests
+        in flight, peak_ewma, which weighs requests in flight by each
+        host's recent latency, consistent_hash, which sends requests with
+        the same hash_key to the same host, or weighted_round_robin, which
+        takes hosts in turn in proportion to their weights. If left unset
+        this option defaults to round_robin.
+        ::
+            balancer = least_outstanding
+        """
+        return self.get('balancer')
+
+    @property
+    def hash_key(self):
+        """
+        Returns what the consistent_hash balancer keys requests on. This may
+        be path for the URL path, url_with_query for the whole URL, client
+        for the client's IP address, or header:<name> for the value of a
+        request header. If left unset this option defaults to path.
+        ::
+            hash_key = header:X-Tenant-Id
+        """
+        return self.get('hash_key')
+
+    @property
+    def failure_backoff(self):
+        """
+        Returns the number of seconds an upstream host is passed over for
+        after a connection to it fails. Each further failure in a row
+        doubles this. If left unset this option defaults to 1.
+        ::
+            failure_backoff = 1
+        """
+        return self.getfloat('failure_backoff')
+
+    @property
+    def max_failure_backoff(self):
+        """
+        Returns the most seconds an upstream host is passed over for after
+        failing. If left unset this option defaults to 30.
+        ::
+            max_failure_backoff = 30
+        """
+        return self.getfloat('max_failure_backoff')
+
+    @property
+    def health_check_path(self):
+        """
+        Returns the path each Pyrox process sends a GET to on every upstream
+        host to check its health. Hosts that don't reply with a 2xx or 3xx
+        status are passed over as if a connection to them had failed. If
+        left unset, hosts are not actively checked.
+        ::
+            health_check_path = /health
+        """
+        return self.get('health_check_path')
+
+    @property
+    def health_check_interval(self):
+        """
+        Returns the number of seconds between health checks. If left unset
+        this option defaults to 5.
+        ::
+            health_check_interval = 5
+        """
+        return self.getfloat('health_check_interval')
+
+    @property
+    def health_check_timeout(self):
+        """
+        Returns the number of seconds a health check waits for a reply. If
+        left unset this option defaults to 2.
+        ::
+            health_check_timeout = 2
+        """
+        return self.getfloat('health_check_timeout')
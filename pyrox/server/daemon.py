@@ -13,10 +13,14 @@ from tornado.netutil import bind_sockets
 from tornado.process import cpu_count
 
 from pyrox.log import get_logger, get_log_manager
-from pyrox.filtering import HttpFilterPipeline
+from pyrox.filtering import (PipelineTemplate, FilterStats,
+                             configure_offload, configure_aggregation,
+                             configure_shared_cache)
 from pyrox.util.config import ConfigurationError
 from pyrox.server.config import load_pyrox_config
 from pyrox.server.proxyng import TornadoHttpProxy
+from pyrox.server.routing import (BALANCERS, UpstreamHealth, HealthChecker,
+                                  parse_hash_key)
 
 
 _LOG = get_logger(__name__)
@@ -26,7 +30,7 @@ _active_children_pids = list()
 class FunctionWrapper(object):
 
     def __init__(self, func, attrs):
-        self._func = functools.partial(attrs, **attrs)
+        self._func = functools.partial(func, **attrs)
 
     def on_request(self, request):
         return self._func(request)
@@ -40,6 +44,10 @@ def stop_child(signum, frame):
         lambda: IOLoop.current().stop())
 
 
+def dump_stats(stats, signum, frame):
+    IOLoop.instance().add_callback_from_signal(stats.dump)
+
+
 def stop_parent(signum, frame):
     for pid in _active_children_pids:
         os.kill(pid, signal.SIGTERM)
@@ -63,17 +71,13 @@ def _resolve_filter_classes(cls_list):
         try:
             cls = getattr(module, cdef[cdef.rfind('.') + 1:])
 
+            # Partials bind cls and attrs now rather than when called
             if inspect.isclass(cls):
-                def create():
-                    return cls(**attrs)
-
-                filter_cls_list.append(create)
+                filter_cls_list.append(functools.partial(cls, **attrs))
 
             elif inspect.isfunction(cls):
-                def create():
-                    return FunctionWrapper(cls)
-
-                filter_cls_list.append(create)
+                filter_cls_list.append(
+                    functools.partial(FunctionWrapper, cls, attrs))
 
             else:
                 raise TypeError(
@@ -87,51 +91,41 @@ def _resolve_filter_classes(cls_list):
     return filter_cls_list
 
 
-def _build_plfactory_closure(filter_cls_list):
-    # Closure for creation of new pipelines
-    def new_filter_pipeline():
-        pipeline = HttpFilterPipeline()
-        for cls in filter_cls_list:
-            pipeline.add_filter(cls())
-        return pipeline
-    return new_filter_pipeline
+def _singleton_factories(cls_list, filter_instances):
+    factories = list()
 
+    for fdef, create in zip(cls_list, _resolve_filter_classes(cls_list)):
+        name = fdef['class']
 
-def _build_singleton_plfactory_closure(filter_classes, filter_instances):
-    # Closure for creation of new singleton pipelines
-    def new_filter_pipeline():
-        pipeline = HttpFilterPipeline()
-        for cls in filter_classes:
-            pipeline.add_filter(filter_instances[cls.__name__])
-        return pipeline
-    return new_filter_pipeline
+        if name not in filter_instances:
+            filter_instances[name] = create()
 
+        factories.append(functools.partial(dict.get, filter_instances, name))
 
-def _build_singleton_plfactories(config):
-    all_classes = list()
-    filter_instances = dict()
+    return factories
 
-    # Gather all the classes
-    all_classes.extend(_resolve_filter_classes(config.pipeline.upstream))
-    all_classes.extend(_resolve_filter_classes(config.pipeline.downstream))
 
-    for cls in all_classes:
-        filter_instances[cls.__name__] = cls()
+def _build_singleton_plfactories(config, stats=None):
+    # Filters named in both pipelines share the same instance
+    filter_instances = dict()
+
+    upstream = PipelineTemplate(
+        _singleton_factories(config.pipeline.upstream, filter_instances),
+        share_all=True, stats=stats)
+    downstream = PipelineTemplate(
+        _singleton_factories(config.pipeline.downstream, filter_instances),
+        share_all=True, stats=stats)
 
-    upstream = _build_singleton_plfactory_closure(
-        _resolve_filter_classes(config.pipeline.upstream), filter_instances)
-    downstream = _build_singleton_plfactory_closure(
-        _resolve_filter_classes(config.pipeline.downstream), filter_instances)
-    return upstream, downstream
+    return upstream.build, downstream.build
 
 
-def _build_plfactories(config):
-    upstream = _build_plfactory_closure(
-        _resolve_filter_classes(config.pipeline.upstream))
-    downstream = _build_plfactory_closure(
-        _resolve_filter_classes(config.pipeline.downstream))
+def _build_plfactories(config, stats=None):
+    upstream = PipelineTemplate(
+        _resolve_filter_classes(config.pipeline.upstream), stats=stats)
+    downstream = PipelineTemplate(
+        _resolve_filter_classes(config.pipeline.downstream), stats=stats)
 
-    return upstream, downstream
+    return upstream.build, downstream.build
 
 
 def start_proxy(sockets, config):
@@ -144,12 +138,32 @@ def start_proxy(sockets, config):
     for path in config.core.plugin_paths:
         plugin_manager.plug_into(path)
 
-    # Resolve our filter chains
+    # Collect filter stats if asked to and dump them on SIGUSR1
+    stats = None
+
+    if config.pipeline.collect_stats:
+        stats = FilterStats()
+        signal.signal(signal.SIGUSR1, functools.partial(dump_stats, stats))
+
+    # Size the thread pool for offloaded filter hooks
+    configure_offload(
+        config.pipeline.offload_workers,
+        config.pipeline.offload_max_pending)
+
+    # Set how much memory bodies aggregated for filters may take up
+    configure_aggregation(
+        config.pipeline.aggregate_message_budget,
+        config.pipeline.aggregate_worker_budget,
+        config.pipeline.aggregate_spill_dir)
+
+    # Resolve our filter chains. The pipeline templates are built once here
+    # in the worker and then stamp out a pipeline per connection.
     try:
         if config.pipeline.use_singletons:
-            filter_pipeline_factories = _build_singleton_plfactories(config)
+            filter_pipeline_factories = _build_singleton_plfactories(
+                config, stats)
         else:
-            filter_pipeline_factories = _build_plfactories(config)
+            filter_pipeline_factories = _build_plfactories(config, stats)
     except Exception as ex:
         _LOG.exception(ex)
         return -1
@@ -167,11 +181,37 @@ def start_proxy(sockets, config):
 
         _LOG.debug('SSL enabled: {}'.format(ssl_options))
 
+    router_options = dict()
+
+    if config.routing.balancer == 'consistent_hash':
+        router_options['key'] = parse_hash_key(config.routing.hash_key)
+
+    elif config.routing.balancer == 'weighted_round_robin':
+        router_options['weights'] = dict(
+            config.routing.upstream_weights or ())
+
+    # Upstream hosts that fail are passed over until they recover
+    router = BALANCERS[config.routing.balancer](
+        config.routing.upstream_hosts,
+        UpstreamHealth(
+            config.routing.failure_backoff,
+            config.routing.max_failure_backoff),
+        **router_options)
+
+    if config.routing.health_check_path is not None:
+        health_checker = HealthChecker(
+            router,
+            config.routing.health_check_path,
+            config.routing.health_check_interval,
+            config.routing.health_check_timeout)
+        health_checker.start()
+
     # Create proxy server ref
     http_proxy = TornadoHttpProxy(
         filter_pipeline_factories,
         config.routing.upstream_hosts,
-        ssl_options)
+        ssl_options,
+        router)
 
     # Add our sockets for watching
     http_proxy.add_sockets(sockets)
@@ -194,6 +234,15 @@ def start_pyrox(config):
     if len(bind_host) != 2:
         raise ConfigurationError('bind_host must have a port specified')
 
+    if config.routing.balancer not in BALANCERS:
+        raise ConfigurationError('Unknown balancer: {}'.format(
+            config.routing.balancer))
+
+    try:
+        parse_hash_key(config.routing.hash_key)
+    except ValueError as ex:
+        raise ConfigurationError(str(ex))
+
     # Bind the sockets in the main process
     sockets = None
 
@@ -207,6 +256,12 @@ def start_pyrox(config):
     _LOG.info('Pyrox listening on: http://{0}:{1}'.format(
         bind_host[0], bind_host[1]))
 
+    # The shared decision table must exist before the workers are forked
+    if config.pipeline.shared_cache_slots > 0:
+        configure_shared_cache(
+            config.pipeline.shared_cache_slots,
+            config.pipeline.shared_cache_slot_size)
+
     # Are we trying to profile Pyrox?
     if config.core.enable_profiling:
         _LOG.warning("""
@@ -1,9 +1,13 @@
+import time
 import socket
+import functools
 
 import tornado
 import tornado.ioloop
 import tornado.process
 
+from tornado.concurrent import is_future
+
 from .routing import RoundRobinRouter, PROTOCOL_HTTP, PROTOCOL_HTTPS
 
 from pyrox.tstream.iostream import (SSLSocketIOHandler, SocketIOHandler,
@@ -12,12 +16,20 @@ from pyrox.tstream.tcpserver import TCPServer
 
 from pyrox.log import get_logger
 from pyrox.about import VERSION
+from pyrox.filtering.output import buffer_pool
+from pyrox.filtering.aggregate import new_aggregator
 from pyrox.http import (HttpRequest, HttpResponse, RequestParser,
-                        ResponseParser, ParserDelegate)
+                        ResponseParser, ParserDelegate, RawHead, retain)
+from pyrox.http.selection import status_code
 import traceback
 
 _LOG = get_logger(__name__)
 
+"""
+Clock used to time upstream requests for the router.
+"""
+clock = time.time
+
 """
 100 Continue intermediate response
 """
@@ -29,62 +41,97 @@ String representing a 0 length HTTP chunked encoding chunk.
 """
 _CHUNK_CLOSE = b'0\r\n\r\n'
 
+"""
+When chunk framing is passed through as-is, the parser ends the message
+after the last-chunk line. Only the blank line that ends the body is left
+to send.
+"""
+_RAW_CHUNK_CLOSE = b'\r\n'
+
+
+def _frozen_response(status):
+    response = HttpResponse()
+    response.version = b'1.1'
+    response.status = status
+    response.header('Server').values.append('pyrox/{}'.format(VERSION))
+    response.header('Content-Length').values.append('0')
+    return response.to_bytes()
+
 
 """
-Default return object on error. This should be configurable.
+Default return object on error, serialized once at import. This should be
+configurable.
 """
-_BAD_GATEWAY_RESP = HttpResponse()
-_BAD_GATEWAY_RESP.version = b'1.1'
-_BAD_GATEWAY_RESP.status = '502 Bad Gateway'
-_BAD_GATEWAY_RESP.header('Server').values.append('pyrox/{}'.format(VERSION))
-_BAD_GATEWAY_RESP.header('Content-Length').values.append('0')
+_BAD_GATEWAY_RESP = _frozen_response('502 Bad Gateway')
 
 """
-Default return object on no route or upstream not responding. This should
-be configurable.
+Default return object on no route or upstream not responding, serialized
+once at import. This should be configurable.
 """
-_UPSTREAM_UNAVAILABLE = HttpResponse()
-_UPSTREAM_UNAVAILABLE.version = b'1.1'
-_UPSTREAM_UNAVAILABLE.status = '503 Service Unavailable'
-_UPSTREAM_UNAVAILABLE.header(
-    'Server').values.append('pyrox/{}'.format(VERSION))
-_UPSTREAM_UNAVAILABLE.header('Content-Length').values.append('0')
+_UPSTREAM_UNAVAILABLE = _frozen_response('503 Service Unavailable')
 
 _MAX_CHUNK_SIZE = 16384
 
 
 def _write_chunk_to_stream(stream, data, callback=None):
-    # Format and write this chunk
-    chunk = bytearray()
-    chunk.extend(hex(len(data))[2:])
-    chunk.extend('\r\n')
-    chunk.extend(data)
-    chunk.extend('\r\n')
+    # Format and write this chunk with a single allocation. Slice
+    # assignment also takes memoryviews, which extend does not.
+    size_line = '{:x}\r\n'.format(len(data))
+    start = len(size_line)
+    end = start + len(data)
+
+    chunk = bytearray(end + 2)
+    chunk[:start] = size_line
+    chunk[start:end] = data
+    chunk[end:] = '\r\n'
 
     stream.write(chunk, callback)
 
 
 def _write_to_stream(stream, data, is_chunked, callback=None):
-    if is_chunked:
+    if len(data) == 0:
+        # Filters may drop a body part entirely but an empty chunk would
+        # end a chunked body
+        if callback is not None:
+            callback()
+    elif is_chunked:
         _write_chunk_to_stream(stream, data, callback)
     else:
         stream.write(data, callback)
 
 
-class AccumulationStream(object):
+class FlowControl(object):
+    """
+    Pairs a stream with the parser consuming it. Pausing stops the parser,
+    mid-buffer if need be, and stops reading from the stream. Resuming lets
+    the parser work through what it was holding before the stream is read
+    from again so that at most one read's worth of data is ever held.
+    """
+    def __init__(self, stream, parser=None):
+        self.stream = stream
+        self.parser = parser
 
-    def __init__(self):
-        self.data = None
-        self.reset()
+    def pause(self):
+        if self.parser is not None:
+            self.parser.pause()
+        self.stream.handle.disable_reading()
 
-    def reset(self):
-        self.data = bytearray()
+    def resume(self):
+        if self.parser is not None:
+            try:
+                self.parser.resume()
+            except StreamClosedError:
+                pass
+            except Exception as ex:
+                _LOG.exception(ex)
+                return
 
-    def write(self, data):
-        self.data.extend(data)
+            # A callback may have paused the parser again
+            if self.parser.is_paused():
+                return
 
-    def size(self):
-        return len(self.data)
+        if not self.stream.closed():
+            self.stream.handle.resume_reading()
 
 
 class ProxyHandler(ParserDelegate):
@@ -93,10 +140,19 @@ class ProxyHandler(ParserDelegate):
     following:
 
     - Handling of header field names.
+    - Loading of batched header blocks.
     - Tracking rejection of message sessions.
+
+    Handlers whose body is not filtered set raw_chunks. Their parser should
+    then be created with raw_chunks set so that chunked bodies are passed
+    along with their original framing.
     """
     def __init__(self, filter_pl, http_msg):
         self._filter_pl = filter_pl
+        self.raw_chunks = False
+        self._reset_message(http_msg)
+
+    def _reset_message(self, http_msg):
         self._http_msg = http_msg
         self._expect = None
         self._chunked = False
@@ -119,23 +175,119 @@ class ProxyHandler(ParserDelegate):
 
         self._last_header_field = None
 
+    def _chunk_close(self):
+        return _RAW_CHUNK_CLOSE if self.raw_chunks else _CHUNK_CLOSE
+
+    def _set_body_length(self, length):
+        # Aggregated bodies are sent whole so their length is known
+        self._http_msg.remove_header('content-length')
+        self._http_msg.remove_header('transfer-encoding')
+        self._http_msg.header('content-length').values.append(str(length))
+
+    def _aggregate_body(self, *args):
+        """
+        Runs the aggregated body filters over the body read into
+        self._aggregate, passing them args after the body and output.
+        """
+        self._output = buffer_pool().acquire()
+        action = self._run_aggregate_chain(
+            self._aggregate.view(), self._output, *args)
+
+        if is_future(action):
+            tornado.ioloop.IOLoop.current().add_future(
+                action, self._on_aggregate_action_ready)
+        else:
+            self._on_aggregate_action(action)
+
+    def _on_aggregate_action_ready(self, future):
+        if self._downstream.closed():
+            return
+
+        try:
+            action = future.result()
+        except Exception as ex:
+            _LOG.exception(ex)
+            self._downstream.close()
+            return
+
+        self._on_aggregate_action(action)
+
+    def _aggregated_body(self):
+        if self._output.modified():
+            return self._output.view()
+        return self._aggregate.view()
+
+    def _release_aggregate(self):
+        if self._aggregate is not None:
+            self._aggregate.close()
+            self._aggregate = None
+
+        if self._output is not None:
+            buffer_pool().release(self._output)
+            self._output = None
+
+    def destroy(self):
+        """
+        Gives back anything held for the message being handled. Called once
+        the connection has closed.
+        """
+        # A view of the output may still be queued on the other stream,
+        # which sends what it has before it closes, so the buffer is
+        # dropped rather than pooled for another connection to write into
+        self._output = None
+        self._release_aggregate()
+
+    def _load_headers(self, headers):
+        if isinstance(headers, RawHead):
+            self._http_msg.load_raw_head(headers)
+        else:
+            self._http_msg.add_headers(headers)
+
+        # This is useful for handling 100 continue situations
+        expect = self._http_msg.get_header('expect')
+        if expect and len(expect.values) > 0:
+            self._expect = expect.values[0].lower()
+        else:
+            self._expect = None
+
 
 class DownstreamHandler(ProxyHandler):
     """
     This proxy handler manages data coming from downstream of the proxy.
     This data comes from the client initiating the request against the
     proxy.
+
+    Requests are handled one at a time. Once a request has been read the
+    parser is paused, leaving any requests the client pipelined behind it
+    unparsed, until the response to it has been written downstream.
     """
 
-    def __init__(self, downstream, filter_pl, connect_upstream):
-        super(DownstreamHandler, self).__init__(filter_pl, HttpRequest())
-        self._accumulator = AccumulationStream()
-        self._preread_body = AccumulationStream()
+    def __init__(self, downstream, filter_pl, connect_upstream, flow=None):
+        self._output = None
+        self._aggregate = None
+        self._pending_body = None
 
         self._downstream = downstream
+        self._flow = flow if flow is not None else FlowControl(downstream)
+        self._connect_upstream = connect_upstream
+
+        super(DownstreamHandler, self).__init__(filter_pl, HttpRequest())
+        self.raw_chunks = not filter_pl.intercepts_req_body()
+
+    def _reset_message(self, http_msg):
+        super(DownstreamHandler, self)._reset_message(http_msg)
+        self._response_tuple = None
         self._upstream = None
+        self._route = None
         self._keep_alive = False
-        self._connect_upstream = connect_upstream
+        self._request_done = False
+        self._response_done = False
+
+    def _resume(self):
+        # Once the request has been read, the parser stays paused until the
+        # response has been written
+        if not self._request_done:
+            self._flow.resume()
 
     def on_req_method(self, method):
         self._http_msg.method = method
@@ -143,20 +295,52 @@ class DownstreamHandler(ProxyHandler):
     def on_req_path(self, url):
         self._http_msg.url = url
 
-    def on_headers_complete(self):
+    def on_headers_complete(self, headers=None):
+        if headers is not None:
+            self._load_headers(headers)
+
         # Execute against the pipeline
         action = self._filter_pl.on_request_head(self._http_msg)
 
+        if is_future(action):
+            # Hold the connection until the filters have decided
+            self._flow.pause()
+            tornado.ioloop.IOLoop.current().add_future(
+                action, self._on_request_action_ready)
+        else:
+            self._on_request_action(action)
+
+    def _on_request_action_ready(self, future):
+        if self._downstream.closed():
+            return
+
+        try:
+            action = future.result()
+        except Exception as ex:
+            _LOG.exception(ex)
+            self._downstream.close()
+            return
+
+        self._on_request_action(action)
+
+        # Unless we're off connecting upstream, carry on with the request
+        if self._intercepted or self._aggregate is not None:
+            self._resume()
+
+    def _on_request_action(self, action):
         # Make sure we handle 100 continue
         if self._expect is not None and self._expect == '100-continue':
             self._downstream.write(_100_CONTINUE)
 
-        # If we are intercepting the request body do some negotiation
-        if self._filter_pl.intercepts_req_body():
-            self._chunked = True
+        # If we are intercepting the request body do some negotiation.
+        # Aggregated bodies are sent with a Content-Length instead.
+        aggregating = self._filter_pl.aggregates_req_body()
 
-            # If there's a content length, negotiate the tansfer encoding
+        if self._filter_pl.intercepts_req_body() and not aggregating:
+            # If there's a content length, negotiate the tansfer encoding.
+            # Requests without a body are left as they are.
             if self._http_msg.get_header('content-length'):
+                self._chunked = True
                 self._http_msg.remove_header('content-length')
                 self._http_msg.remove_header('transfer-encoding')
 
@@ -167,10 +351,17 @@ class DownstreamHandler(ProxyHandler):
         if not action.should_connect_upstream():
             self._intercepted = True
             self._response_tuple = action.payload
+        elif aggregating:
+            # Read the whole body before going upstream so that the
+            # aggregated body filters may still reject the request
+            self._aggregate = new_aggregator()
+
+            if action.is_routing():
+                self._route = action.payload
         else:
             # Hold up on the client side until we're done negotiating
-            # connections.
-            self._downstream.handle.disable_reading()
+            # connections. Any body already read stays with the parser.
+            self._flow.pause()
 
             # We're routing to upstream; we need to know where to go
             if action.is_routing():
@@ -182,70 +373,166 @@ class DownstreamHandler(ProxyHandler):
         # Rejections simply discard the body
         if not self._intercepted:
             # Hold up on the client side until we're done with this chunk
-            self._downstream.handle.disable_reading()
-
-            # Point to the chunk for our data
-            data = chunk
+            self._flow.pause()
 
             # Run through the filter PL and see if we need to modify
             # the body
-            self._accumulator.reset()
-            self._filter_pl.on_request_body(data, self._accumulator)
-
-            # Check to see if the filter modified the body
-            if self._accumulator.size() > 0:
-                data = self._accumulator.data
+            if self._output is None:
+                self._output = buffer_pool().acquire()
+            else:
+                self._output.reset()
 
-            if self._upstream:
-                # When we write to upstream set the callback to resume
-                # reading from downstream.
-                _write_to_stream(self._upstream,
-                                 data,
-                                 is_chunked,
-                                 self._downstream.handle.resume_reading)
+            action = self._filter_pl.on_request_body(chunk, self._output)
 
+            if is_future(action):
+                # The chunk is only valid during this call
+                tornado.ioloop.IOLoop.current().add_future(
+                    action, functools.partial(
+                        self._on_request_body_ready, retain(chunk),
+                        is_chunked))
             else:
-                # If we're not connected upstream, store the fragment
-                # for later. We will resume reading once upstream
-                # connects
-                self._preread_body.write(data)
+                self._send_body(chunk, is_chunked)
 
-    def on_upstream_connect(self, upstream):
-        self._upstream = upstream
+    def _on_request_body_ready(self, chunk, is_chunked, future):
+        if not self._downstream.closed():
+            self._send_body(chunk, is_chunked)
 
-        if self._preread_body.size() > 0:
+    def _send_body(self, data, is_chunked):
+        # Check to see if the filter modified the body
+        if self._output.modified():
+            data = self._output.view()
+
+        if self._aggregate is not None:
+            self._aggregate.write(data)
+            self._resume()
+
+        else:
+            # The parser stays paused until upstream connects so no body
+            # is read before there's somewhere to send it. When we write
+            # to upstream set the callback to resume reading from
+            # downstream.
             _write_to_stream(self._upstream,
-                             self._preread_body,
+                             data,
+                             (is_chunked and not self.raw_chunks) or
                              self._chunked,
-                             self._downstream.handle.resume_reading)
+                             self._resume)
+
+    def on_upstream_connect(self, upstream):
+        self._upstream = upstream
 
-            # Empty the object
-            self._preread_body.reset()
+        if self._pending_body is not None:
+            # The aggregated body filters have been run over the request
+            writer = BodyWriter(
+                self._pending_body, upstream, self._release_aggregate)
+            self._pending_body = None
+            writer.write()
 
         else:
-            self._downstream.handle.resume_reading()
+            self._resume()
+
+    def on_upstream_unavailable(self):
+        self._reply_in_place_of_upstream(_UPSTREAM_UNAVAILABLE)
+
+    def on_upstream_error(self):
+        """
+        Called when upstream fails before any of its response has been
+        sent downstream.
+        """
+        self._reply_in_place_of_upstream(_BAD_GATEWAY_RESP)
+
+    def _reply_in_place_of_upstream(self, response):
+        # There's nowhere to send the body so discard it
+        self._pending_body = None
+        self._release_aggregate()
+        self._intercepted = True
+        self._upstream = None
+        self._downstream.write(response, self.on_response_complete)
+        self._resume()
 
     def on_message_complete(self, is_chunked, keep_alive):
         self._keep_alive = bool(keep_alive)
+        self._request_done = True
+
+        # Leave pipelined requests alone until we've replied to this one
+        self._flow.pause()
+
+        # Every body part has been written by now
+        if self._output is not None:
+            buffer_pool().release(self._output)
+            self._output = None
+
+        if self._aggregate is not None and not self._intercepted:
+            self._aggregate_body()
+
+        elif self._intercepted:
+            if self._response_tuple is not None:
+                # Commit the response to the client (aka downstream)
+                writer = ResponseWriter(
+                    self._response_tuple[0],
+                    self._response_tuple[1],
+                    self._downstream,
+                    self.on_response_complete)
+
+                writer.commit()
+
+        elif (is_chunked or self._chunked) and self._upstream is not None:
+            # Finish the body with the closing chunk for the origin server
+            self._upstream.write(self._chunk_close())
+
+        if self._response_done:
+            self._complete()
+
+    def _run_aggregate_chain(self, body, output):
+        return self._filter_pl.on_aggregated_request_body(body, output)
+
+    def _on_aggregate_action(self, action):
+        if not action.should_connect_upstream():
+            self._release_aggregate()
+            self._intercepted = True
 
-        if self._intercepted:
-            # Commit the response to the client (aka downstream)
             writer = ResponseWriter(
-                self._response_tuple[0],
-                self._response_tuple[1],
+                action.payload[0],
+                action.payload[1],
                 self._downstream,
-                self.complete)
+                self.on_response_complete)
 
             writer.commit()
+            return
 
-        elif is_chunked:
-            # Finish the body with the closing chunk for the origin server
-            self._upstream.write(_CHUNK_CLOSE, self.complete)
+        body = self._aggregated_body()
 
-    def complete(self):
+        # Requests without a body only get a Content-Length if a filter
+        # gave them one
+        if (len(body) > 0 or
+                self._http_msg.get_header('content-length') or
+                self._http_msg.get_header('transfer-encoding')):
+            self._set_body_length(len(body))
+
+        self._pending_body = body
+
+        if action.is_routing():
+            self._route = action.payload
+
+        if self._route is not None:
+            self._connect_upstream(self._http_msg, self._route)
+        else:
+            self._connect_upstream(self._http_msg)
+
+    def on_response_complete(self):
+        """
+        Called once the response to the current request has been written
+        downstream.
+        """
+        self._response_done = True
+
+        if self._request_done:
+            self._complete()
+
+    def _complete(self):
         if self._keep_alive:
-            # Clean up the message obj
-            self._http_msg = HttpRequest()
+            # Clean up and move on to the next request
+            self._reset_message(HttpRequest())
+            self._flow.resume()
 
         else:
             # We're done here - close up shop
@@ -289,6 +576,9 @@ class ResponseWriter(object):
                 raise TypeError(
                     'Unable to use {} as response body'.format(src_type))
 
+        else:
+            self._on_complete()
+
     def write_body_as_file(self):
         next_chunk = self._source.read(_MAX_CHUNK_SIZE)
 
@@ -318,6 +608,37 @@ class ResponseWriter(object):
                 self.write_body_as_array)
 
 
+class BodyWriter(object):
+    """
+    Writes a whole body to a stream and then calls on_complete. Bodies held
+    in memory are written in one go. Other bodies, such as mmaps of spilled
+    aggregated bodies, are written a slice at a time, each once the last
+    has been sent, so that they aren't read into memory all at once.
+    """
+    def __init__(self, body, stream, on_complete):
+        self._body = body
+        self._stream = stream
+        self._on_complete = on_complete
+        self._written = 0
+
+    def write(self):
+        body_len = len(self._body)
+
+        if self._written == body_len:
+            self._on_complete()
+
+        elif isinstance(self._body, memoryview):
+            self._written = body_len
+            self._stream.write(self._body, self.write)
+
+        else:
+            end = min(self._written + _MAX_CHUNK_SIZE, body_len)
+            next_slice = self._body[self._written:end]
+            self._written = end
+
+            self._stream.write(next_slice, self.write)
+
+
 class UpstreamHandler(ProxyHandler):
     """
     This proxy handler manages data coming from upstream of the proxy. This
@@ -325,21 +646,74 @@ class UpstreamHandler(ProxyHandler):
     proxy.
     """
 
-    def __init__(self, downstream, upstream, filter_pl, request):
+    def __init__(self, downstream, upstream, filter_pl, request, flow=None,
+                 on_complete=None):
         super(UpstreamHandler, self).__init__(filter_pl, HttpResponse())
         self._downstream = downstream
         self._upstream = upstream
+        self._flow = flow if flow is not None else FlowControl(upstream)
         self._request = request
+        self._on_complete = on_complete
+        self._keep_alive = False
+        self._responding = False
+        self._finished = False
+        self._output = None
+        self._aggregate = None
+        self.raw_chunks = not filter_pl.intercepts_resp_body()
+
+    def finished(self):
+        """
+        Returns True once the whole response has been read from upstream.
+        """
+        return self._finished
+
+    def responding(self):
+        """
+        Returns True once the response head has been read from upstream.
+        From then on part of the response may already be downstream.
+        """
+        return self._responding
 
     def on_status(self, status_code):
         self._http_msg.status = str(status_code)
 
-    def on_headers_complete(self):
+    def on_headers_complete(self, headers=None):
+        self._responding = True
+
+        if headers is not None:
+            self._load_headers(headers)
+
         action = self._filter_pl.on_response_head(
                     self._http_msg, self._request)
 
-        # If we are intercepting the response body do some negotiation
-        if self._filter_pl.intercepts_resp_body():
+        if is_future(action):
+            # Hold the response until the filters have decided
+            self._flow.pause()
+            tornado.ioloop.IOLoop.current().add_future(
+                action, self._on_response_action_ready)
+        else:
+            self._on_response_action(action)
+
+    def _on_response_action_ready(self, future):
+        if self._downstream.closed():
+            return
+
+        try:
+            action = future.result()
+        except Exception as ex:
+            _LOG.exception(ex)
+            self._downstream.close()
+            return
+
+        self._on_response_action(action)
+        self._flow.resume()
+
+    def _on_response_action(self, action):
+        # If we are intercepting the response body do some negotiation.
+        # Aggregated bodies are sent with a Content-Length instead.
+        aggregating = self._filter_pl.aggregates_resp_body()
+
+        if self._filter_pl.intercepts_resp_body() and not aggregating:
 
             # If there's a content length, negotiate the transfer encoding
             if self._http_msg.get_header('content-length'):
@@ -354,47 +728,123 @@ class UpstreamHandler(ProxyHandler):
             self._intercepted = True
             self._response_tuple = action.payload
 
+        elif aggregating:
+            # Hold the head back so that the aggregated body filters may
+            # still reject the response
+            self._aggregate = new_aggregator()
+
         else:
             self._downstream.write(self._http_msg.to_bytes())
 
     def on_body(self, bytes, length, is_chunked):
         # Rejections simply discard the body
         if not self._intercepted:
-            accumulator = AccumulationStream()
-            data = bytes
+            # Hold up on the upstream side until we're done sending this chunk
+            self._flow.pause()
 
-            self._filter_pl.on_response_body(data, accumulator, self._request)
+            if self._output is None:
+                self._output = buffer_pool().acquire()
+            else:
+                self._output.reset()
 
-            if accumulator.size() > 0:
-                data = accumulator.bytes
+            action = self._filter_pl.on_response_body(
+                bytes, self._output, self._request)
 
-            # Hold up on the upstream side until we're done sending this chunk
-            self._upstream.handle.disable_reading()
+            if is_future(action):
+                # The chunk is only valid during this call
+                tornado.ioloop.IOLoop.current().add_future(
+                    action, functools.partial(
+                        self._on_response_body_ready, retain(bytes),
+                        is_chunked))
+            else:
+                self._send_body(bytes, is_chunked)
 
-            # When we write to the stream set the callback to resume
-            # reading from upstream.
-            _write_to_stream(
-                self._downstream,
-                data,
-                is_chunked or self._chunked,
-                self._upstream.handle.resume_reading)
+    def _on_response_body_ready(self, data, is_chunked, future):
+        if not self._downstream.closed():
+            self._send_body(data, is_chunked)
+
+    def _send_body(self, data, is_chunked):
+        if self._output.modified():
+            data = self._output.view()
+
+        if self._aggregate is not None:
+            self._aggregate.write(data)
+            self._flow.resume()
+            return
+
+        # When we write to the stream set the callback to resume
+        # reading from upstream.
+        _write_to_stream(
+            self._downstream,
+            data,
+            (is_chunked and not self.raw_chunks) or self._chunked,
+            self._flow.resume)
 
     def on_message_complete(self, is_chunked, keep_alive):
-        callback = self._upstream.close
-        self._upstream.handle.disable_reading()
+        self._keep_alive = bool(keep_alive)
+        self._finished = True
+        self._flow.pause()
 
-        if keep_alive:
-            self._http_msg = HttpResponse()
-            callback = self._downstream.handle.resume_reading
+        if self._output is not None:
+            buffer_pool().release(self._output)
+            self._output = None
 
-        if self._intercepted:
+        if self._aggregate is not None:
+            self._aggregate_body(self._request)
+        elif self._intercepted:
             # Serialize our message to them
-            self._downstream.write(self._http_msg.to_bytes(), callback)
+            self._downstream.write(self._http_msg.to_bytes(), self._complete)
         elif is_chunked or self._chunked:
             # Finish the last chunk.
-            self._downstream.write(_CHUNK_CLOSE, callback)
+            self._downstream.write(self._chunk_close(), self._complete)
         else:
-            callback()
+            self._complete()
+
+    def _run_aggregate_chain(self, body, output, request):
+        return self._filter_pl.on_aggregated_response_body(
+            body, output, request)
+
+    def _on_aggregate_action(self, action):
+        if action.is_replying() or action.is_rejecting():
+            self._release_aggregate()
+
+            writer = ResponseWriter(
+                action.payload[0],
+                action.payload[1],
+                self._downstream,
+                self._complete)
+
+            writer.commit()
+            return
+
+        body = self._aggregated_body()
+
+        if self._may_have_body():
+            self._set_body_length(len(body))
+
+        self._downstream.write(self._http_msg.to_bytes())
+        BodyWriter(body, self._downstream, self._on_aggregate_written).write()
+
+    def _on_aggregate_written(self):
+        self._release_aggregate()
+        self._complete()
+
+    def _may_have_body(self):
+        # Responses to HEAD requests carry the headers a GET would have
+        # and some statuses never have a body
+        code = status_code(self._http_msg.status)
+
+        if code is None or code < 200 or code in (204, 304):
+            return False
+
+        return getattr(self._request, 'method', None) != 'HEAD'
+
+    def _complete(self):
+        if not self._keep_alive:
+            self._upstream.close()
+
+        if self._on_complete is not None:
+            self._on_complete()
 
 
 class ConnectionTracker(object):
@@ -472,10 +922,16 @@ class ProxyConnection(object):
     A proxy connection manages the lifecycle of the sockets opened during a
     proxied client request against Pyrox.
     """
-    def __init__(self, us_filter_pl, ds_filter_pl, downstream, router):
+    def __init__(self, us_filter_pl, ds_filter_pl, downstream, router,
+                 address=None):
         self._ds_filter_pl = ds_filter_pl
         self._us_filter_pl = us_filter_pl
         self._router = router
+        self._address = address
+        self._upstream_target = None
+        self._request_target = None
+        self._request_started = None
+        self._upstream_handler = None
         self._upstream_parser = None
         self._upstream_tracker = ConnectionTracker(
             self._on_upstream_live,
@@ -484,11 +940,18 @@ class ProxyConnection(object):
 
         # Setup all of the wiring for downstream
         self._downstream = downstream
+        self._downstream_flow = FlowControl(self._downstream)
         self._downstream_handler = DownstreamHandler(
             self._downstream,
             self._ds_filter_pl,
-            self._connect_upstream)
-        self._downstream_parser = RequestParser(self._downstream_handler)
+            self._connect_upstream,
+            self._downstream_flow)
+        self._downstream_parser = RequestParser(
+            self._downstream_handler,
+            zero_copy_body=True,
+            lazy_headers=True,
+            raw_chunks=self._downstream_handler.raw_chunks)
+        self._downstream_flow.parser = self._downstream_parser
         self._downstream.on_close(self._on_downstream_close)
         self._downstream.read(self._on_downstream_read)
 
@@ -496,21 +959,23 @@ class ProxyConnection(object):
         if route is not None:
             # This does some type checking for routes passed up via filter
             self._router.set_next(route)
-        upstream_target = self._router.get_next()
+        upstream_target = self._router.get_next(request, self._address)
 
         if upstream_target is None:
-            self._downstream.write(
-                _UPSTREAM_UNAVAILABLE.to_bytes(),
-                self._downstream.handle.resume_reading)
+            self._downstream_handler.on_upstream_unavailable()
             return
 
-        # Hold downstream reads
-        self._hold_downstream = True
+        # The last response is done with; this request is now in flight
+        self._upstream_handler = None
 
         # Update the request to proxy upstream and store it
-        request.replace_header('host').values.append(
-            '{}:{}'.format(upstream_target[0], upstream_target[1]))
+        request.set_header(
+            'Host', '{}:{}'.format(upstream_target[0], upstream_target[1]))
         self._request = request
+        self._upstream_target = upstream_target
+        self._request_target = upstream_target
+        self._request_started = clock()
+        self._router.on_request_start(upstream_target)
 
         try:
             self._upstream_tracker.connect(upstream_target)
@@ -518,15 +983,25 @@ class ProxyConnection(object):
             _LOG.exception(ex)
 
     def _on_upstream_live(self, upstream):
+        self._router.on_upstream_connect(self._upstream_target)
+
+        upstream_flow = FlowControl(upstream)
         self._upstream_handler = UpstreamHandler(
             self._downstream,
             upstream,
             self._us_filter_pl,
-            self._request)
+            self._request,
+            upstream_flow,
+            self._on_upstream_response_complete)
 
         if self._upstream_parser:
             self._upstream_parser.destroy()
-        self._upstream_parser = ResponseParser(self._upstream_handler)
+        self._upstream_parser = ResponseParser(
+            self._upstream_handler,
+            zero_copy_body=True,
+            lazy_headers=True,
+            raw_chunks=self._upstream_handler.raw_chunks)
+        upstream_flow.parser = self._upstream_parser
 
         # Set the read callback
         upstream.read(self._on_upstream_read)
@@ -540,7 +1015,27 @@ class ProxyConnection(object):
         # Set up our downstream handler
         self._downstream_handler.on_upstream_connect(upstream)
 
+    def _on_upstream_response_complete(self):
+        self._finish_request()
+        self._downstream_handler.on_response_complete()
+
+    def _finish_request(self):
+        """
+        Tells the router the request in flight upstream, if any, is done
+        with.
+        """
+        if self._request_target is not None:
+            self._router.on_request_complete(
+                self._request_target, clock() - self._request_started)
+            self._request_target = None
+
     def _on_downstream_close(self):
+        self._finish_request()
+        self._downstream_handler.destroy()
+
+        if self._upstream_handler is not None:
+            self._upstream_handler.destroy()
+
         self._upstream_tracker.destroy()
         self._downstream_parser.destroy()
         self._downstream_parser = None
@@ -553,12 +1048,35 @@ class ProxyConnection(object):
 
     def _on_upstream_error(self, error):
         _LOG.error('Upstream error: {}'.format(error))
+        self._router.on_upstream_error(self._upstream_target)
+        self._finish_request()
 
-        if not self._downstream.closed():
-            self._downstream.write(_BAD_GATEWAY_RESP.to_bytes())
+        handler = self._upstream_handler
+        if self._downstream.closed() or (
+                handler is not None and handler.finished()):
+            # Nothing was in flight
+            return
+
+        if handler is not None and handler.responding():
+            # A 502 can't follow a response that's already under way
+            self._downstream.close()
+        else:
+            self._downstream_handler.on_upstream_error()
 
     def _on_upstream_close(self):
-        if not self._downstream.closed():
+        # Upstream closing mid-response ends the response downstream too.
+        # Between requests the client connection is left alone.
+        handler = self._upstream_handler
+        in_flight = handler is None or not handler.finished()
+
+        # Closing before the connection was ever made is a connect failure
+        if handler is None and self._upstream_target is not None:
+            self._router.on_upstream_error(self._upstream_target)
+
+        if in_flight:
+            self._finish_request()
+
+        if in_flight and not self._downstream.closed():
             self._downstream.close()
 
         if self._upstream_parser is not None:
@@ -590,11 +1108,18 @@ class TornadoHttpProxy(TCPServer):
     :param pipelines: This is a tuple with the upstream filter pipeline factory
                       as the first element and the downstream filter pipeline
                       factory as the second element.
+    :param router: The RoutingHandler to pick upstream targets with. If this
+                   is not set, a RoundRobinRouter over default_us_targets is
+                   used.
     """
     def __init__(self, pipeline_factories, default_us_targets=None,
-                 ssl_options=None):
+                 ssl_options=None, router=None):
         super(TornadoHttpProxy, self).__init__(ssl_options=ssl_options)
-        self._router = RoundRobinRouter(default_us_targets)
+
+        if router is None:
+            router = RoundRobinRouter(default_us_targets)
+
+        self._router = router
         self.us_pipeline_factory = pipeline_factories[0]
         self.ds_pipeline_factory = pipeline_factories[1]
 
@@ -603,4 +1128,5 @@ class TornadoHttpProxy(TCPServer):
             self.us_pipeline_factory(),
             self.ds_pipeline_factory(),
             downstream,
-            self._router)
+            self._router,
+            address)
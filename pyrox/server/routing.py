@@ -1,4 +1,17 @@
 import sys
+import math
+import time
+import bisect
+import random
+import struct
+import hashlib
+import functools
+import collections
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import PeriodicCallback
+
+from pyrox.log import get_logger
 
 
 if sys.version_info.major == 2:
@@ -20,9 +33,57 @@ _PROTOCOL_DEFAULT_PORTS = {
     PROTOCOL_HTTPS: 443
 }
 
+_PROTOCOL_NAMES = dict(
+    (protocol, name) for name, protocol in _PROTOCOLS_BY_NAME.items())
+
 _DEFAULT_PROTOCOL = PROTOCOL_HTTP
 _DEFAULT_PROTOCOL_PORT = _PROTOCOL_DEFAULT_PORTS[_DEFAULT_PROTOCOL]
 
+_LOG = get_logger(__name__)
+
+"""
+Default health tracking settings. See UpstreamHealth and HealthChecker.
+"""
+DEFAULT_FAILURE_BACKOFF = 1.0
+DEFAULT_MAX_FAILURE_BACKOFF = 30.0
+DEFAULT_CHECK_INTERVAL = 5.0
+DEFAULT_CHECK_TIMEOUT = 2.0
+
+"""
+Default number of seconds over which PeakEwmaRouter forgets a latency. See
+PeakEwmaRouter.
+"""
+DEFAULT_EWMA_DECAY = 10.0
+
+"""
+Cost PeakEwmaRouter gives a route that has requests in flight but no
+latency measured yet, so that a new route isn't sent every request until
+its first one completes.
+"""
+_UNMEASURED_PENALTY = 1e9
+
+"""
+Default number of points each route is given on a ConsistentHashRouter's
+ring. More points spread keys more evenly at the cost of a larger ring.
+"""
+DEFAULT_HASH_REPLICAS = 160
+
+"""
+Clock used for failure backoffs.
+"""
+clock = time.time
+
+"""
+The most route URLs resolve_route keeps parsed.
+"""
+DEFAULT_RESOLVED_ROUTES = 1024
+
+"""
+Route URLs mapped to their parsed route in the order they were first seen.
+See resolve_route.
+"""
+_resolved_routes = collections.OrderedDict()
+
 
 def parse_route_url(url):
     parsed_url = urlparse(url)
@@ -58,6 +119,48 @@ def parse_route_url(url):
     return (host, port, protocol)
 
 
+def resolve_route(url):
+    """
+    Returns the route a URL string describes, parsing it only the first time
+    it is seen. Once DEFAULT_RESOLVED_ROUTES URLs have been seen, the one
+    seen first is forgotten to make room for the next. Lookups do not
+    reorder the table so this is first in, first out rather than least
+    recently used. Routes are immutable tuples and may be shared freely.
+
+    Filters that route to a fixed set of targets may resolve them once and
+    return the route itself from filtering.route to skip even this lookup.
+    ::
+        _BACKEND = resolve_route('http://backend:8080')
+
+        ...
+            return filtering.route(_BACKEND)
+    """
+    route = _resolved_routes.get(url)
+
+    if route is None:
+        route = parse_route_url(url)
+
+        if len(_resolved_routes) >= DEFAULT_RESOLVED_ROUTES:
+            _resolved_routes.popitem(last=False)
+        _resolved_routes[url] = route
+
+    return route
+
+
+def _check_route(route):
+    host, port, protocol = route
+
+    if not isinstance(host, str) or len(host) == 0:
+        raise ValueError('Route host must be a non-empty string.')
+
+    if (not isinstance(port, int) or isinstance(port, bool) or
+            not 0 < port < 65536):
+        raise ValueError('Route port must be an integer from 1 to 65535.')
+
+    if protocol not in _PROTOCOL_NAMES:
+        raise ValueError('Unsupported route protocol: {}'.format(protocol))
+
+
 class InvalidRouteError(Exception):
     pass
 
@@ -66,10 +169,131 @@ class NoRoutesAvailableError(Exception):
     pass
 
 
-class RoutingHandler(object):
+class UpstreamHealth(object):
+    """
+    Tracks which upstream targets are fit to be sent requests. A target that
+    fails is marked down for a backoff period that doubles with each
+    failure in a row, up to max_backoff. Once the period is up the target
+    is tried again and a success marks it healthy.
+
+    Failures reported while a target is already down, such as those of
+    requests that were in flight when it went down, are ignored.
+
+    :param backoff: Seconds a target is first marked down for.
+    :param max_backoff: The most seconds a target is marked down for.
+    """
+    def __init__(self, backoff=DEFAULT_FAILURE_BACKOFF,
+                 max_backoff=DEFAULT_MAX_FAILURE_BACKOFF):
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+        # Targets that have failed, mapped to the number of failures in a
+        # row and the time they may next be tried
+        self._failures = dict()
+
+    def is_healthy(self, target):
+        failure = self._failures.get(target)
+        return failure is None or failure[1] <= clock()
+
+    def down(self):
+        """
+        Returns the targets currently marked down.
+        """
+        now = clock()
+        return [target for target, (count, retry_at)
+                in self._failures.items() if retry_at > now]
+
+    def mark_failure(self, target):
+        if not self.is_healthy(target):
+            return
+
+        count = self._failures.get(target, (0, 0))[0] + 1
+        backoff = min(self._backoff * 2 ** (count - 1), self._max_backoff)
+        self._failures[target] = (count, clock() + backoff)
+
+        _LOG.warning('Upstream {}:{} marked down for {}s'.format(
+            target[0], target[1], backoff))
+
+    def mark_success(self, target):
+        if self._failures.pop(target, None) is not None:
+            _LOG.info('Upstream {}:{} is back up'.format(
+                target[0], target[1]))
+
+
+class HealthChecker(object):
+    """
+    Actively checks the health of a router's routes by sending each an HTTP
+    GET every interval seconds on the IOLoop. A 2xx or 3xx reply marks the
+    route healthy and anything else, including no reply within timeout
+    seconds, counts as a failure.
+
+    :param router: The RoutingHandler whose routes are checked.
+    :param path: The path requested from each route.
+    :param interval: Seconds between checks.
+    :param timeout: Seconds to wait for a route to reply.
+    """
+    def __init__(self, router, path='/', interval=DEFAULT_CHECK_INTERVAL,
+                 timeout=DEFAULT_CHECK_TIMEOUT):
+        self._router = router
+        self._path = path if path.startswith('/') else '/' + path
+        self._timeout = timeout
+        self._checking = set()
+        self._periodic = PeriodicCallback(self.check, interval * 1000)
+
+    def start(self):
+        self._periodic.start()
+
+    def stop(self):
+        self._periodic.stop()
+
+    def check(self):
+        for route in self._router.routes:
+            # Routes slower to reply than the interval are checked once
+            if route in self._checking:
+                continue
+
+            self._checking.add(route)
+            host, port, protocol = route
+            url = '{}://{}:{}{}'.format(
+                _PROTOCOL_NAMES[protocol], host, port, self._path)
+
+            probe = AsyncHTTPClient().fetch(
+                url,
+                raise_error=False,
+                validate_cert=False,
+                connect_timeout=self._timeout,
+                request_timeout=self._timeout)
+            probe.add_done_callback(functools.partial(self._on_probe, route))
+
+    def _on_probe(self, route, probe):
+        self._checking.discard(route)
+
+        try:
+            healthy = 200 <= probe.result().code < 400
+        except Exception as ex:
+            _LOG.debug('Health check of {}:{} failed: {}'.format(
+                route[0], route[1], ex))
+            healthy = False
+
+        if healthy:
+            self._router.on_upstream_connect(route)
+        else:
+            self._router.on_upstream_error(route)
+
 
-    def __init__(self, routes=None):
+class RoutingHandler(object):
+    """
+    Hands out the upstream routes requests are sent to. The proxy reports
+    connections to and errors from each route it uses so that a router may
+    pass over routes that are down.
+
+    :param routes: A list of route URL strings.
+    :param health: The UpstreamHealth used to track routes. A new one is
+                   created if this is not set.
+    """
+    def __init__(self, routes=None, health=None):
         self.routes = list()
+        self.health = health if health is not None else UpstreamHealth()
         self._next_route = None
 
         if routes is not None:
@@ -81,38 +305,479 @@ class RoutingHandler(object):
                         'A route must be either a valid URL string.')
 
     def set_next(self, next_route):
-        if next_route is not None and isinstance(next_route, str):
-            self._next_route = parse_route_url(next_route)
+        """
+        Sets the route the next request is sent to, whatever the router
+        would have picked. This may be a URL string or a route already
+        resolved with resolve_route. Routes given as a tuple have their
+        parts checked and a ValueError is raised if any are not valid.
+        """
+        if isinstance(next_route, tuple) and len(next_route) == 3:
+            _check_route(next_route)
+            self._next_route = next_route
+        elif next_route is not None and isinstance(next_route, str):
+            self._next_route = resolve_route(next_route)
         else:
-            raise TypeError('A route must be either a valid URL string.')
-
-    def get_next(self):
+            raise TypeError(
+                'A route must be either a valid URL string or a resolved '
+                'route.')
+
+    def get_next(self, request=None, address=None):
+        """
+        Returns the route to send a request to or None if no route is fit
+        to be sent one.
+
+        :param request: The HttpRequest being routed.
+        :param address: The address of the client that sent the request.
+        """
         next = None
 
         if self._next_route is not None:
             next = self._next_route
             self._next_route = None
         else:
-            next = self._get_next()
+            next = self._get_next(request, address)
 
         return next
 
-    def _get_next(self):
+    def on_upstream_connect(self, route):
+        """
+        Called when a connection to a route has been made.
+        """
+        self.health.mark_success(route)
+
+    def on_upstream_error(self, route):
+        """
+        Called when connecting to a route fails or the connection to it
+        fails mid-request.
+        """
+        self.health.mark_failure(route)
+
+    def on_request_start(self, route):
+        """
+        Called when a request is sent to a route.
+        """
+        pass
+
+    def on_request_complete(self, route, latency):
+        """
+        Called when a request sent to a route is done with, whether its
+        response was received or not.
+
+        :param latency: Seconds since the request was started.
+        """
+        pass
+
+    def _get_next(self, request, address):
         raise NoRoutesAvailableError('No routes available.')
 
 
 class RoundRobinRouter(RoutingHandler):
 
-    def __init__(self, routes):
-        super(RoundRobinRouter, self).__init__(routes)
+    def __init__(self, routes, health=None):
+        super(RoundRobinRouter, self).__init__(routes, health)
         self._last_default = 0
 
-    def _get_next(self):
-        next_route = None
-
-        if len(self.routes) > 0:
+    def _get_next(self, request, address):
+        # Routes that are down are passed over. None is returned if they
+        # all are.
+        for attempt in range(len(self.routes)):
             self._last_default += 1
             idx = self._last_default % len(self.routes)
             next_route = self.routes[idx]
 
-        return next_route
+            if self.health.is_healthy(next_route):
+                return next_route
+
+        return None
+
+
+class LeastOutstandingRouter(RoutingHandler):
+    """
+    Sends each request to the healthy route with the fewest requests in
+    flight. Routes with equally few are taken in turn.
+
+    Requests are only counted by the worker process that sent them.
+    """
+    def __init__(self, routes, health=None):
+        super(LeastOutstandingRouter, self).__init__(routes, health)
+        self._outstanding = dict()
+        self._offset = 0
+
+    def outstanding(self, route):
+        return self._outstanding.get(route, 0)
+
+    def on_request_start(self, route):
+        self._outstanding[route] = self._outstanding.get(route, 0) + 1
+
+    def on_request_complete(self, route, latency):
+        remaining = self._outstanding.get(route, 0) - 1
+
+        if remaining > 0:
+            self._outstanding[route] = remaining
+        else:
+            self._outstanding.pop(route, None)
+
+    def _get_next(self, request, address):
+        best = None
+        best_load = None
+        count = len(self.routes)
+        self._offset += 1
+
+        for step in range(count):
+            route = self.routes[(self._offset + step) % count]
+
+            if not self.health.is_healthy(route):
+                continue
+
+            load = self.outstanding(route)
+            if best is None or load < best_load:
+                best = route
+                best_load = load
+
+        return best
+
+
+class PeakEwmaRouter(LeastOutstandingRouter):
+    """
+    Picks two healthy routes at random and sends the request to the one
+    with the lower cost, the power of two choices. A route's cost is its
+    latency estimate multiplied by one more than its requests in flight.
+
+    The latency estimate is a moving average that jumps straight up to any
+    slower latency seen and decays back down over about decay seconds,
+    so a route that slows down is avoided at once and tried again once it
+    has had time to recover.
+
+    :param decay: Seconds over which a latency is forgotten.
+    """
+    def __init__(self, routes, health=None, decay=DEFAULT_EWMA_DECAY):
+        super(PeakEwmaRouter, self).__init__(routes, health)
+        self._decay = decay
+        self._random = random.Random()
+
+        # Routes mapped to their latency estimate and when it was made
+        self._latencies = dict()
+
+    def latency(self, route):
+        """
+        Returns the current latency estimate of a route in seconds.
+        """
+        estimate = self._latencies.get(route)
+
+        if estimate is None:
+            return 0.0
+
+        latency, measured_at = estimate
+        return latency * self._weight(clock() - measured_at)
+
+    def cost(self, route):
+        outstanding = self.outstanding(route)
+        latency = self.latency(route)
+
+        if latency == 0 and outstanding > 0:
+            return _UNMEASURED_PENALTY + outstanding
+        return latency * (outstanding + 1)
+
+    def on_request_complete(self, route, latency):
+        super(PeakEwmaRouter, self).on_request_complete(route, latency)
+
+        now = clock()
+        estimate = self._latencies.get(route)
+
+        if estimate is not None and latency < estimate[0]:
+            weight = self._weight(now - estimate[1])
+            latency = estimate[0] * weight + latency * (1 - weight)
+
+        self._latencies[route] = (latency, now)
+
+    def _weight(self, elapsed):
+        return math.exp(-max(elapsed, 0) / self._decay)
+
+    def _get_next(self, request, address):
+        healthy = [route for route in self.routes
+                   if self.health.is_healthy(route)]
+
+        if len(healthy) < 2:
+            return healthy[0] if healthy else None
+
+        first, second = self._random.sample(healthy, 2)
+        return first if self.cost(first) <= self.cost(second) else second
+
+
+def _hash(key):
+    if not isinstance(key, (bytes, bytearray)):
+        key = key.encode('utf-8')
+    return struct.unpack_from('<Q', hashlib.md5(bytes(key)).digest())[0]
+
+
+def hash_by_path(request, address):
+    """
+    Hash key function that keys on the request's URL path, leaving out the
+    query and fragment so that cache busting or tracking parameters don't
+    spread one object over several hosts.
+    """
+    if request is None or request.url is None:
+        return None
+
+    url = request.url
+    end = len(url)
+
+    for separator in ('?', '#'):
+        found = url.find(separator)
+
+        if found != -1 and found < end:
+            end = found
+
+    return url[:end]
+
+
+def hash_by_url(request, address):
+    """
+    Hash key function that keys on the request's URL, query included.
+    """
+    return request.url if request is not None else None
+
+
+def hash_by_client(request, address):
+    """
+    Hash key function that keys on the client's IP address.
+    """
+    if isinstance(address, tuple) and len(address) > 0:
+        return address[0]
+    return None
+
+
+def hash_by_header(name):
+    """
+    Returns a hash key function that keys on the first value of the named
+    request header.
+    """
+    def key(request, address):
+        header = request.get_header(name) if request is not None else None
+
+        if header is not None and len(header.values) > 0:
+            return header.values[0]
+        return None
+
+    return key
+
+
+def parse_hash_key(spec):
+    """
+    Returns the hash key function named by spec, which may be path,
+    url_with_query, client or header:<name>.
+    """
+    if spec == 'path':
+        return hash_by_path
+
+    if spec == 'url_with_query':
+        return hash_by_url
+
+    if spec == 'client':
+        return hash_by_client
+
+    if spec.startswith('header:') and len(spec) > len('header:'):
+        return hash_by_header(spec[len('header:'):].strip())
+
+    raise ValueError('Unknown hash key: {}'.format(spec))
+
+
+class ConsistentHashRouter(RoundRobinRouter):
+    """
+    Sends requests with the same key to the same route so that caches kept
+    by the upstream hosts stay warm. Each route is given replicas points on
+    a hash ring and a request goes to the route owning the first point at
+    or after its key's hash. Finding it is a binary search of the ring.
+
+    A route that is down is skipped in favour of the next route along the
+    ring, so only its keys are moved while it's down. Adding or removing a
+    route likewise only moves the keys of the points it gains or loses.
+    Requests without a key are sent round robin.
+
+    :param key: A function that takes the request and client address and
+                returns the key to hash or None. Defaults to hash_by_path.
+    :param replicas: The number of points each route is given.
+    """
+    def __init__(self, routes, health=None, key=hash_by_path,
+                 replicas=DEFAULT_HASH_REPLICAS):
+        super(ConsistentHashRouter, self).__init__(routes, health)
+        self._key = key
+        self._replicas = replicas
+        self._build_ring()
+
+    def add_route(self, route):
+        parsed = parse_route_url(route)
+
+        if parsed not in self.routes:
+            self.routes.append(parsed)
+            self._build_ring()
+
+    def remove_route(self, route):
+        parsed = parse_route_url(route)
+
+        if parsed in self.routes:
+            self.routes.remove(parsed)
+            self._build_ring()
+
+    def _build_ring(self):
+        points = list()
+
+        for route in self.routes:
+            name = '{}:{}:{}'.format(*route)
+
+            for replica in range(self._replicas):
+                points.append((_hash('{}-{}'.format(name, replica)), route))
+
+        points.sort()
+        self._points = [point for point, route in points]
+        self._owners = [route for point, route in points]
+
+    def _get_next(self, request, address):
+        key = self._key(request, address)
+
+        if key is None or len(self._points) == 0:
+            return super(ConsistentHashRouter, self)._get_next(
+                request, address)
+
+        count = len(self._points)
+        start = bisect.bisect_left(self._points, _hash(key))
+
+        # Walk on around the ring past the points of routes that are down
+        for step in range(count):
+            route = self._owners[(start + step) % count]
+
+            if self.health.is_healthy(route):
+                return route
+
+        return None
+
+
+class WeightedRoundRobinRouter(RoutingHandler):
+    """
+    Takes healthy routes in turn in proportion to their weights, spreading
+    each route's turns evenly rather than sending it a run of requests in a
+    row. Weights of 5, 1 and 1 give a, a, b, a, c, a, a rather than
+    a, a, a, a, a, b, c. This is the smooth weighted round robin of nginx.
+
+    A route's weight may be changed while requests are being routed. Given
+    a slow start period, the route's weight is raised to the new weight
+    over that many seconds so that a newly added host isn't sent its full
+    share of requests while its caches are cold.
+
+    :param weights: A dict of route URL strings to weights. Routes not in
+                    it have a weight of 1.
+    """
+    def __init__(self, routes, health=None, weights=None):
+        super(WeightedRoundRobinRouter, self).__init__(routes, health)
+
+        # Routes mapped to their weight, the weight they are ramping from
+        # and the time and period of the ramp
+        self._weights = dict()
+        self._current = dict()
+
+        for route in self.routes:
+            self._weights[route] = (1, 1, 0, 0)
+
+        if weights is not None:
+            for url, weight in weights.items():
+                self.set_weight(url, weight)
+
+    def add_route(self, route, weight=1, slow_start=0):
+        """
+        Adds a route to the router with the given weight. If slow_start is
+        set, the route starts with no weight and is brought up to it over
+        that many seconds.
+        """
+        parsed = parse_route_url(route)
+
+        if parsed not in self.routes:
+            self.routes.append(parsed)
+            self._weights[parsed] = (0, 0, 0, 0)
+
+        self.set_weight(route, weight, slow_start)
+
+    def remove_route(self, route):
+        parsed = parse_route_url(route)
+
+        if parsed in self.routes:
+            self.routes.remove(parsed)
+            self._weights.pop(parsed, None)
+            self._current.pop(parsed, None)
+
+    def set_weight(self, route, weight, slow_start=0):
+        """
+        Sets the weight of a route. If slow_start is set, the route's weight
+        is moved from what it is now to the new weight over that many
+        seconds.
+        """
+        parsed = parse_route_url(route)
+
+        if parsed not in self._weights:
+            raise InvalidRouteError('Unknown route: {}'.format(route))
+
+        if weight < 0:
+            raise ValueError('A weight may not be negative.')
+
+        if slow_start > 0:
+            self._weights[parsed] = (
+                weight, self.weight(parsed), clock(), slow_start)
+        else:
+            self._weights[parsed] = (weight, weight, 0, 0)
+
+    def weight(self, route):
+        """
+        Returns the weight a route currently has, taking any slow start
+        into account.
+        """
+        weight, start_weight, started, period = self._weights[route]
+
+        if period == 0:
+            return weight
+
+        progress = (clock() - started) / float(period)
+
+        if progress >= 1:
+            # Done ramping; skip the arithmetic from here on
+            self._weights[route] = (weight, weight, 0, 0)
+            return weight
+
+        return start_weight + (weight - start_weight) * max(progress, 0)
+
+    def _get_next(self, request, address):
+        best = None
+        best_current = None
+        total = 0
+
+        for route in self.routes:
+            if not self.health.is_healthy(route):
+                continue
+
+            weight = self.weight(route)
+            if weight <= 0:
+                continue
+
+            current = self._current.get(route, 0) + weight
+            self._current[route] = current
+            total += weight
+
+            if best is None or current > best_current:
+                best = route
+                best_current = current
+
+        if best is not None:
+            self._current[best] = best_current - total
+
+        return best
+
+
+"""
+Routers that may be chosen with the balancer option in the routing section
+of the configuration.
+"""
+BALANCERS = {
+    'round_robin': RoundRobinRouter,
+    'least_outstanding': LeastOutstandingRouter,
+    'peak_ewma': PeakEwmaRouter,
+    'consistent_hash': ConsistentHashRouter,
+    'weighted_round_robin': WeightedRoundRobinRouter
+}
@@ -0,0 +1,219 @@
+import json
+import urllib
+import calendar
+import datetime
+import functools
+
+import pyrox.filtering as filtering
+
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from pyrox.http import HttpResponse
+from pyrox.about import VERSION
+from pyrox.filtering import cache
+from pyrox.log import get_logger
+
+_LOG = get_logger(__name__)
+
+
+_VERSION_STR = 'pyrox/{}'.format(VERSION)
+
+"""
+Headers set on requests with a valid token. Any sent by the client are
+removed first.
+"""
+TENANT_ID_HEADER = 'X-Tenant-Id'
+USER_ID_HEADER = 'X-User-Id'
+
+_MISSING = object()
+
+
+def _frozen_response(status):
+    response = HttpResponse()
+    response.version = b'1.1'
+    response.status = status
+    response.header('Server').values.append(_VERSION_STR)
+    response.header('Content-Length').values.append('0')
+    return response
+
+
+_UNAUTHORIZED = _frozen_response('401 Unauthorized')
+_IDENTITY_UNAVAILABLE = _frozen_response('503 Service Unavailable')
+
+
+def _parse_expiry(expires):
+    # Keystone v2 writes times as UTC such as 2013-02-27T18:30:59.999999Z.
+    # Fractions of a second and the zone suffix are dropped.
+    parsed = datetime.datetime.strptime(expires[:19], '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(parsed.timetuple())
+
+
+class Identity(object):
+    """
+    What a token validation says about the token's holder.
+    """
+    def __init__(self, tenant_id, user_id, expires):
+        self.tenant_id = tenant_id
+        self.user_id = user_id
+        self.expires = expires
+
+
+def parse_identity(body):
+    """
+    Returns the Identity described by a Keystone v2 token validation
+    response body.
+    """
+    access = json.loads(body)['access']
+    token = access['token']
+    tenant = token.get('tenant') or dict()
+    user = access.get('user') or dict()
+
+    return Identity(
+        tenant.get('id'), user.get('id'), _parse_expiry(token['expires']))
+
+
+@filtering.stateless
+class KeystoneTokenFilter(filtering.HttpFilter):
+    """
+    Validates the X-Auth-Token of each request against a Keystone v2
+    identity service. Requests with a valid token have the tenant and user
+    the token belongs to set as the X-Tenant-Id and X-User-Id headers and
+    are passed on. Requests without one are replied to with a 401 and if
+    the identity service can't be reached, with a 503.
+
+    Validations are made with a non-blocking HTTP client. Valid tokens are
+    cached until they expire, or for max_ttl seconds if that's sooner, and
+    invalid ones for negative_ttl seconds. Requests for a token that is
+    already being validated wait on that validation rather than starting
+    another. The filter is stateless so that a single cache is shared by
+    every connection in the worker.
+
+    Each option may be set as a filter attribute in the pipeline section.
+    ::
+        keystone = pyrox.stock_filters.keystone.KeystoneTokenFilter
+        keystone.identity_url = http://localhost:35357
+        keystone.admin_token = ADMIN
+
+    :param identity_url: The root URL of the identity service.
+    :param admin_token: A token allowed to validate other tokens.
+    :param timeout: Seconds to wait on the identity service.
+    :param cache_size: The most tokens kept in the cache.
+    :param max_ttl: The most seconds a valid token is cached for.
+    :param negative_ttl: Seconds an invalid token is cached for.
+    """
+    def __init__(self, identity_url, admin_token=None, timeout=5,
+                 cache_size=cache.DEFAULT_MAX_SIZE, max_ttl=300,
+                 negative_ttl=10):
+        self._validate_url = '{}/v2.0/tokens/'.format(
+            identity_url.rstrip('/'))
+        self._admin_token = admin_token
+        self._timeout = float(timeout)
+        self._max_ttl = float(max_ttl)
+        self._negative_ttl = float(negative_ttl)
+        self._cache = cache.DecisionCache(int(cache_size))
+        self._pending = dict()
+
+    @filtering.handles_request_head
+    def on_request_head(self, request_head):
+        header = request_head.get_header('X-Auth-Token')
+
+        if header is None or len(header.values) == 0:
+            return filtering.reply(_UNAUTHORIZED)
+
+        token = header.values[0]
+
+        identity = self._cache.get(token, _MISSING)
+        if identity is not _MISSING:
+            return self._decide(request_head, identity)
+
+        validation = self._pending.get(token)
+
+        if validation is None:
+            validation = self._validate(token)
+            self._pending[token] = validation
+            validation.add_done_callback(
+                functools.partial(self._on_validated, token))
+
+        decision = Future()
+        validation.add_done_callback(
+            functools.partial(self._on_decided, request_head, decision))
+        return decision
+
+    def _validate(self, token):
+        """
+        Returns a Future that resolves to the Identity for a token or to None
+        if the token is not valid.
+        """
+        headers = dict(Accept='application/json')
+
+        if self._admin_token is not None:
+            headers['X-Auth-Token'] = self._admin_token
+
+        request = HTTPRequest(
+            self._validate_url + urllib.quote(token, safe=''),
+            headers=headers,
+            connect_timeout=self._timeout,
+            request_timeout=self._timeout)
+
+        validation = Future()
+
+        def on_response(fetched):
+            try:
+                response = fetched.result()
+
+                if response.code in (401, 403, 404):
+                    validation.set_result(None)
+                elif response.code == 200:
+                    validation.set_result(parse_identity(response.body))
+                else:
+                    raise IOError(
+                        'Identity service replied with {}'.format(
+                            response.code))
+            except Exception as ex:
+                validation.set_exception(ex)
+
+        AsyncHTTPClient().fetch(
+            request, raise_error=False).add_done_callback(on_response)
+        return validation
+
+    def _on_validated(self, token, validation):
+        del self._pending[token]
+
+        if validation.exception() is not None:
+            # Failures are not cached so the next request tries again
+            return
+
+        identity = validation.result()
+
+        if identity is None:
+            self._cache.put(token, None, self._negative_ttl)
+        else:
+            ttl = min(identity.expires - cache.clock(), self._max_ttl)
+            self._cache.put(token, identity, ttl)
+
+    def _on_decided(self, request_head, decision, validation):
+        if validation.exception() is not None:
+            _LOG.error('Unable to validate token: {}'.format(
+                validation.exception()))
+            decision.set_result(filtering.reply(_IDENTITY_UNAVAILABLE))
+        else:
+            decision.set_result(
+                self._decide(request_head, validation.result()))
+
+    def _decide(self, request_head, identity):
+        if identity is None or identity.expires <= cache.clock():
+            return filtering.reply(_UNAUTHORIZED)
+
+        request_head.remove_header(TENANT_ID_HEADER)
+        request_head.remove_header(USER_ID_HEADER)
+
+        if identity.tenant_id is not None:
+            request_head.header(TENANT_ID_HEADER).values.append(
+                str(identity.tenant_id))
+
+        if identity.user_id is not None:
+            request_head.header(USER_ID_HEADER).values.append(
+                str(identity.user_id))
+
+        return filtering.next()
@@ -222,6 +222,10 @@ class SocketIOHandler(IOHandler):
         self._recv_chunk_size = recv_chunk_size
         self._recv_buffer = bytearray(self._recv_chunk_size)
 
+        # Reads are handed to the read callback as slices of this view so
+        # that the received bytes are not copied out of the recv buffer
+        self._recv_view = memoryview(self._recv_buffer)
+
     def on_done_writing(self, callback=None):
         """
         Sets a callback for completed send events and then sets the send
@@ -261,7 +265,9 @@ class SocketIOHandler(IOHandler):
     def read(self, callback):
         """
         Sets a callback for read events and then sets the read interest on
-        the event handler.
+        the event handler. The callback is passed a memoryview of the bytes
+        read. The view points into the stream's recv buffer and is only
+        valid until the next read.
         """
         self._assert_not_closed()
 
@@ -272,8 +278,9 @@ class SocketIOHandler(IOHandler):
     def write(self, msg, callback=None):
         self._assert_not_closed()
 
-        if not isinstance(msg, basestring) and not isinstance(msg, bytearray):
-            raise TypeError("bytes/bytearray/unicode/str objects only")
+        if not isinstance(msg, (basestring, bytearray, memoryview)):
+            raise TypeError(
+                "bytes/bytearray/memoryview/unicode/str objects only")
 
         # Append the data for writing - this should not copy the data
         self._write_queue.append(msg)
@@ -373,7 +380,7 @@ class SocketIOHandler(IOHandler):
 
             if read is not None:
                 if read > 0 and self._read_cb:
-                    self._run_callback(self._read_cb, self._recv_buffer[:read])
+                    self._run_callback(self._read_cb, self._recv_view[:read])
                 elif read == 0:
                     self.close()
         except (socket.error, IOError, OSError) as ex:
@@ -383,16 +390,21 @@ class SocketIOHandler(IOHandler):
     def handle_write(self):
         if self._write_queue.has_next():
             try:
-                msg = None
-
                 while self._write_queue.has_next():
                     msg, offset = self._write_queue.next()
-                    sent = self._do_write(msg[offset:])
+
+                    if offset > 0 and not isinstance(msg, unicode):
+                        # Send the rest through a view so it isn't copied
+                        msg = memoryview(msg)[offset:]
+                    elif offset > 0:
+                        msg = msg[offset:]
+
+                    sent = self._do_write(msg)
                     self._write_queue.advance(sent)
             except (socket.error, IOError, OSError) as ex:
-                if ex.args[0] in _ERRNO_WOULDBLOCK:
-                    self._write_queue.appendleft(msg)
-                else:
+                # The queue is only advanced past what was sent so a write
+                # that would block is simply tried again later
+                if ex.args[0] not in _ERRNO_WOULDBLOCK:
                     self._write_queue.clear()
                     self.handle_error(ex.args[0])
         else:
@@ -404,6 +416,16 @@ class SocketIOHandler(IOHandler):
                 self._run_callback(callback)
 
     def handle_connect(self):
+        # A failed connect is also reported as writable. Its error must be
+        # checked before the connect callback is run.
+        error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error != 0:
+            self._connecting = False
+            self._on_connect_cb = None
+            self.handle_error(error)
+            return
+
         if self._on_connect_cb is not None:
             callback = self._on_connect_cb
             self._on_connect_cb = None
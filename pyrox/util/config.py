@@ -103,3 +103,9 @@ class ConfigurationPart(object):
             return self._cfg.getint(self._name, option)
         else:
             return self._get_default(option)
+
+    def getfloat(self, option):
+        if self.has_option(option):
+            return self._cfg.getfloat(self._name, option)
+        else:
+            return self._get_default(option)
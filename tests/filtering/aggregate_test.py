@@ -0,0 +1,56 @@
+import mmap
+import unittest
+
+from pyrox.filtering.aggregate import MemoryBudget, BodyAggregator
+
+
+class WhenAggregatingBodies(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = MemoryBudget(16)
+
+    def test_small_bodies_stay_in_memory(self):
+        aggregator = BodyAggregator(self.budget, message_budget=8)
+        aggregator.write(memoryview(b'abc'))
+        aggregator.write(b'def')
+
+        self.assertFalse(aggregator.spilled())
+        self.assertEqual(6, self.budget.in_use())
+        self.assertEqual(b'abcdef', aggregator.view().tobytes())
+
+        aggregator.close()
+        self.assertEqual(0, self.budget.in_use())
+
+    def test_bodies_over_the_message_budget_spill(self):
+        aggregator = BodyAggregator(self.budget, message_budget=8)
+        aggregator.write(b'abcdef')
+        aggregator.write(memoryview(b'ghijkl'))
+
+        self.assertTrue(aggregator.spilled())
+        self.assertEqual(0, self.budget.in_use())
+
+        body = aggregator.view()
+        self.assertIsInstance(body, mmap.mmap)
+        self.assertEqual(12, len(body))
+        self.assertEqual(b'abcdefghijkl', body[:])
+
+        aggregator.close()
+
+    def test_bodies_spill_once_the_worker_budget_is_spent(self):
+        first = BodyAggregator(self.budget, message_budget=16)
+        second = BodyAggregator(self.budget, message_budget=16)
+
+        first.write(b'a' * 12)
+        second.write(b'b' * 6)
+
+        self.assertFalse(first.spilled())
+        self.assertTrue(second.spilled())
+        self.assertEqual(12, self.budget.in_use())
+
+        first.close()
+        second.close()
+        self.assertEqual(0, self.budget.in_use())
+
+
+if __name__ == '__main__':
+    unittest.main()
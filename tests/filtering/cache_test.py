@@ -0,0 +1,243 @@
+import os
+import mock
+import unittest
+
+from tornado.concurrent import Future
+
+import pyrox.filtering as filtering
+from pyrox.http import HttpRequest, HttpResponse
+from pyrox.filtering import cache
+from pyrox.filtering.cache import DecisionCache, SharedDecisionStore
+
+
+class WhenCachingDecisions(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.clock = mock.patch.object(cache, 'clock', lambda: self.now)
+        self.clock.start()
+
+    def tearDown(self):
+        self.clock.stop()
+
+    def test_entries_expire(self):
+        decisions = DecisionCache(ttl=10)
+        decisions.put('key', filtering.next())
+
+        self.assertIsNotNone(decisions.get('key'))
+
+        self.now += 10
+        self.assertIsNone(decisions.get('key'))
+        self.assertEqual(1, decisions.expirations)
+        self.assertEqual(0, len(decisions))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        decisions = DecisionCache(max_size=2)
+        decisions.put('a', filtering.next())
+        decisions.put('b', filtering.next())
+        decisions.get('a')
+        decisions.put('c', filtering.next())
+
+        self.assertIsNotNone(decisions.get('a'))
+        self.assertIsNone(decisions.get('b'))
+        self.assertEqual(1, decisions.evictions)
+
+    def test_negative_decisions_use_their_own_ttl(self):
+        decisions = DecisionCache(ttl=10, negative_ttl=1)
+        decisions.put('bad', filtering.reject())
+        decisions.put('good', filtering.next())
+
+        self.now += 5
+        self.assertIsNone(decisions.get('bad'))
+        self.assertIsNotNone(decisions.get('good'))
+
+    def test_negative_caching_may_be_disabled(self):
+        decisions = DecisionCache(negative_ttl=0)
+        decisions.put('bad', filtering.reject())
+
+        self.assertEqual(0, len(decisions))
+
+    def test_stats(self):
+        decisions = DecisionCache()
+        decisions.put('key', filtering.next())
+        decisions.get('key')
+        decisions.get('other')
+
+        stats = decisions.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['size'])
+
+
+class TokenFilter(filtering.HttpFilter):
+
+    allowed_tokens = ('good',)
+
+    def __init__(self):
+        self.calls = 0
+        self.future = None
+
+    @filtering.handles_request_head
+    @filtering.memoize(filtering.header_key('X-Auth-Token'))
+    def on_request_head(self, request_head):
+        self.calls += 1
+        header = request_head.get_header('X-Auth-Token')
+        token = header.values[0] if header is not None else None
+
+        if token == 'later':
+            self.future = Future()
+            return self.future
+
+        if token == 'page':
+            return filtering.reply(HttpResponse(), b'Sign in')
+
+        if token in self.allowed_tokens:
+            return filtering.next()
+        return filtering.reject()
+
+
+class LockedTokenFilter(TokenFilter):
+
+    allowed_tokens = ()
+
+
+def request_with(token=None):
+    request = HttpRequest()
+
+    if token is not None:
+        request.header('X-Auth-Token').values.append(token)
+
+    return request
+
+
+class WhenMemoizingHooks(unittest.TestCase):
+
+    def setUp(self):
+        TokenFilter.on_request_head.cache.clear()
+        self.http_filter = TokenFilter()
+        self.pipeline = filtering.HttpFilterPipeline()
+        self.pipeline.add_filter(self.http_filter)
+
+    def test_decisions_are_reused(self):
+        self.pipeline.on_request_head(request_with('good'))
+        action = self.pipeline.on_request_head(request_with('good'))
+
+        self.assertEqual(1, self.http_filter.calls)
+        self.assertFalse(action.breaks_pipeline())
+
+        action = self.pipeline.on_request_head(request_with('bad'))
+        self.assertTrue(action.is_replying())
+
+    def test_subclasses_keep_their_own_decisions(self):
+        self.pipeline.on_request_head(request_with('good'))
+        action = LockedTokenFilter().on_request_head(request_with('good'))
+
+        self.assertTrue(action.is_replying())
+
+    def test_requests_without_a_key_are_not_cached(self):
+        self.pipeline.on_request_head(request_with())
+        self.pipeline.on_request_head(request_with())
+
+        self.assertEqual(2, self.http_filter.calls)
+        self.assertEqual(0, len(TokenFilter.on_request_head.cache))
+
+    def test_replies_with_a_body_are_not_cached(self):
+        first = self.pipeline.on_request_head(request_with('page'))
+        second = self.pipeline.on_request_head(request_with('page'))
+
+        self.assertEqual(2, self.http_filter.calls)
+        self.assertIsNot(first, second)
+        self.assertEqual(0, len(TokenFilter.on_request_head.cache))
+
+    def test_pending_decisions_are_shared(self):
+        first = self.pipeline.on_request_head(request_with('later'))
+        second = self.pipeline.on_request_head(request_with('later'))
+
+        self.http_filter.future.set_result(filtering.next())
+        third = self.pipeline.on_request_head(request_with('later'))
+
+        self.assertEqual(1, self.http_filter.calls)
+        self.assertTrue(first.done() and second.done())
+        self.assertFalse(third.breaks_pipeline())
+
+
+class AllowingFilter(filtering.HttpFilter):
+
+    @filtering.handles_request_head
+    @filtering.memoize(filtering.header_key('X-Auth-Token'), shared=True)
+    def on_request_head(self, request_head):
+        return filtering.next()
+
+
+class DenyingFilter(filtering.HttpFilter):
+
+    @filtering.handles_request_head
+    @filtering.memoize(filtering.header_key('X-Auth-Token'), shared=True)
+    def on_request_head(self, request_head):
+        return filtering.reject()
+
+
+class WhenMemoizingWithASharedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.store = SharedDecisionStore(slots=64, slot_size=512)
+        self.patches = [
+            mock.patch.object(cache, 'clock', lambda: self.now),
+            mock.patch.object(cache, '_shared_store', self.store)]
+
+        for patch in self.patches:
+            patch.start()
+
+        for http_filter in (AllowingFilter, DenyingFilter):
+            http_filter.on_request_head.cache.clear()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_filters_in_one_module_do_not_share_keys(self):
+        allowed = AllowingFilter().on_request_head(request_with('token'))
+        denied = DenyingFilter().on_request_head(request_with('token'))
+
+        self.assertFalse(allowed.breaks_pipeline())
+        self.assertTrue(denied.is_replying())
+
+    def test_shared_decisions_keep_their_expiry(self):
+        AllowingFilter().on_request_head(request_with('token'))
+        local = AllowingFilter.on_request_head.cache
+        local.clear()
+
+        # Another worker picks the decision up shortly before it expires
+        self.now += cache.DEFAULT_TTL - 1
+        AllowingFilter().on_request_head(request_with('token'))
+        self.assertEqual(1, len(local))
+
+        self.now += 1
+        self.assertIsNone(local.get(
+            ('{}.AllowingFilter.on_request_head'.format(__name__), 'token')))
+
+
+class WhenSharingDecisionsBetweenWorkers(unittest.TestCase):
+
+    def test_decisions_written_by_a_child_are_seen(self):
+        store = SharedDecisionStore(slots=8, slot_size=512)
+        pid = os.fork()
+
+        if pid == 0:
+            store.put('key', filtering.reject(), 60)
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        self.assertTrue(store.get('key').is_replying())
+        self.assertIsNone(store.get('other'))
+
+    def test_decisions_too_large_are_not_shared(self):
+        store = SharedDecisionStore(slots=8, slot_size=64)
+
+        self.assertFalse(store.put('key', filtering.reject(), 60))
+        self.assertIsNone(store.get('key'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+import pyrox.filtering as filtering
+from pyrox.filtering.offload import OffloadPool, offload_pool
+
+
+class ScrubbingFilter(filtering.HttpFilter):
+
+    def __init__(self):
+        self.threads = list()
+
+    @filtering.handles_request_body
+    @filtering.offload
+    def on_req_body(self, body_part, output):
+        self.threads.append(threading.current_thread())
+        output.write(bytes(body_part).replace('secret', '******'))
+        return filtering.next()
+
+
+class WhenOffloadingHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def test_hook_runs_off_the_ioloop(self):
+        http_filter = ScrubbingFilter()
+        pipeline = filtering.HttpFilterPipeline()
+        pipeline.add_filter(http_filter)
+        output = bytearray()
+
+        class Output(object):
+            write = output.extend
+
+        result = pipeline.on_request_body(
+            memoryview(b'a secret'), Output())
+        action = self.io_loop.run_sync(lambda: result)
+
+        self.assertFalse(action.breaks_pipeline())
+        self.assertEqual(b'a ******', bytes(output))
+        self.assertIsNot(threading.current_thread(), http_filter.threads[0])
+
+    def test_calls_over_the_limit_wait(self):
+        release = threading.Event()
+        pool = OffloadPool(ThreadPoolExecutor(2), max_pending=1)
+
+        first = pool.submit(release.wait)
+        second = pool.submit(lambda: 'second')
+
+        self.assertEqual(1, pool.pending())
+        self.assertEqual(1, pool.waiting())
+
+        release.set()
+        self.assertEqual('second', self.io_loop.run_sync(lambda: second))
+        self.assertTrue(first.done())
+        self.assertEqual(0, pool.waiting())
+        pool.shutdown()
+
+    def test_hook_exceptions_are_passed_back(self):
+        def fail():
+            raise ValueError()
+
+        result = offload_pool().submit(fail)
+
+        with self.assertRaises(ValueError):
+            self.io_loop.run_sync(lambda: result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+from pyrox.filtering.output import BodyBuffer, BufferPool
+
+
+class WhenWritingBodyBuffers(unittest.TestCase):
+
+    def test_unwritten_buffers_pass_through(self):
+        body_buffer = BodyBuffer(8)
+
+        self.assertFalse(body_buffer.modified())
+
+        body_buffer.write(b'abc')
+        body_buffer.pass_through()
+
+        self.assertFalse(body_buffer.modified())
+        self.assertEqual(0, body_buffer.size())
+
+    def test_writing_nothing_replaces_the_body_part(self):
+        body_buffer = BodyBuffer(8)
+        body_buffer.write(b'')
+
+        self.assertTrue(body_buffer.modified())
+        self.assertEqual(b'', body_buffer.view().tobytes())
+
+    def test_writes_are_copied_into_the_buffer(self):
+        body_buffer = BodyBuffer(8)
+        body_buffer.write(memoryview(b'abc'))
+        body_buffer.write(bytearray(b'def'))
+
+        self.assertEqual(b'abcdef', body_buffer.view().tobytes())
+        self.assertEqual(8, body_buffer.capacity())
+
+    def test_growing_keeps_earlier_views_valid(self):
+        body_buffer = BodyBuffer(4)
+        body_buffer.write(b'abcd')
+        view = body_buffer.view()
+
+        body_buffer.write(b'efgh')
+
+        self.assertEqual(b'abcd', view.tobytes())
+        self.assertEqual(b'abcdefgh', body_buffer.view().tobytes())
+        self.assertEqual(8, body_buffer.capacity())
+
+
+class WhenPoolingBodyBuffers(unittest.TestCase):
+
+    def test_released_buffers_are_reused(self):
+        pool = BufferPool(buffer_size=8)
+
+        body_buffer = pool.acquire()
+        body_buffer.write(b'abc')
+        pool.release(body_buffer)
+
+        reused = pool.acquire()
+        self.assertIs(body_buffer, reused)
+        self.assertFalse(reused.modified())
+        self.assertEqual(0, pool.pooled())
+
+    def test_grown_buffers_are_dropped(self):
+        pool = BufferPool(buffer_size=4, max_pooled_size=4)
+
+        body_buffer = pool.acquire()
+        body_buffer.write(b'abcdef')
+        pool.release(body_buffer)
+
+        self.assertEqual(0, pool.pooled())
+
+    def test_pool_size_is_bounded(self):
+        pool = BufferPool(max_pooled=1)
+
+        pool.release(pool.acquire())
+        pool.release(BodyBuffer())
+
+        self.assertEqual(1, pool.pooled())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 import mock
 import unittest
+import functools
+
+from tornado.concurrent import Future
 
 import pyrox.filtering as filtering
 
@@ -51,6 +54,193 @@ class WhenBuildingPipelines(unittest.TestCase):
 
         self.assertTrue(http_filter.were_expected_calls_made())
 
+    def test_dispatch_plans_are_built_once_per_class(self):
+        filtering.HttpFilterPipeline().add_filter(
+            TestFilterWithAllDecorators())
+
+        with mock.patch('inspect.getmembers') as getmembers:
+            with mock.patch('inspect.getargspec') as getargspec:
+                pipeline = filtering.HttpFilterPipeline()
+                http_filter = TestFilterWithAllDecorators()
+                pipeline.add_filter(http_filter)
+
+                pipeline.on_request_head(mock.MagicMock())
+                pipeline.on_request_body(mock.MagicMock(), mock.MagicMock())
+
+        self.assertFalse(getmembers.called)
+        self.assertFalse(getargspec.called)
+        self.assertTrue(http_filter.on_req_head_called)
+        self.assertTrue(http_filter.on_req_body_called)
+
+
+@filtering.stateless
+class StatelessFilter(filtering.HttpFilter):
+
+    @filtering.handles_request_head
+    def on_req_head(self, request_head):
+        request_head.seen.append(self)
+
+
+class StatefulFilter(filtering.HttpFilter):
+
+    @filtering.handles_request_head
+    def on_req_head(self, request_head):
+        request_head.seen.append(self)
+
+
+class CountedFilter(StatefulFilter):
+
+    created = 0
+
+    def __init__(self):
+        CountedFilter.created += 1
+
+
+@filtering.stateless
+class CountedStatelessFilter(CountedFilter):
+    pass
+
+
+class WhenBuildingPipelinesFromTemplates(unittest.TestCase):
+
+    def setUp(self):
+        CountedFilter.created = 0
+
+    def filters_seen(self, pipeline):
+        request_head = mock.MagicMock()
+        request_head.seen = list()
+        pipeline.on_request_head(request_head)
+        return request_head.seen
+
+    def test_stateless_filters_are_shared(self):
+        factory = functools.partial(CountedStatelessFilter)
+        template = filtering.PipelineTemplate([factory])
+
+        first = self.filters_seen(template.build())
+        second = self.filters_seen(template.build())
+
+        self.assertEqual(1, CountedFilter.created)
+        self.assertEqual(1, len(first))
+        self.assertIs(first[0], second[0])
+
+    def test_stateful_filters_are_not_created_by_the_template(self):
+        template = filtering.PipelineTemplate(
+            [functools.partial(CountedFilter)])
+        self.assertEqual(0, CountedFilter.created)
+
+        template.build()
+        self.assertEqual(1, CountedFilter.created)
+
+    def test_stateful_filters_are_created_per_pipeline(self):
+        template = filtering.PipelineTemplate(
+            [StatelessFilter, StatefulFilter, StatelessFilter])
+
+        first = self.filters_seen(template.build())
+        second = self.filters_seen(template.build())
+
+        self.assertEqual(
+            [StatelessFilter, StatefulFilter, StatelessFilter],
+            [f.__class__ for f in first])
+        self.assertIs(first[0], second[0])
+        self.assertIsNot(first[1], second[1])
+
+    def test_adding_filters_does_not_change_the_template(self):
+        template = filtering.PipelineTemplate([StatelessFilter])
+
+        pipeline = template.build()
+        pipeline.add_filter(StatefulFilter())
+
+        self.assertEqual(2, len(self.filters_seen(pipeline)))
+        self.assertEqual(1, len(self.filters_seen(template.build())))
+
+    def test_sharing_all_filters(self):
+        template = filtering.PipelineTemplate(
+            [StatefulFilter], share_all=True)
+
+        self.assertIs(self.filters_seen(template.build())[0],
+                      self.filters_seen(template.build())[0])
+
+
+class DeferredFilter(filtering.HttpFilter):
+
+    def __init__(self):
+        self.future = Future()
+
+    @filtering.handles_request_head
+    def on_req_head(self, request_head):
+        return self.future
+
+
+class WhenFiltersReturnFutures(unittest.TestCase):
+
+    def setUp(self):
+        self.deferred = DeferredFilter()
+        self.after = TestFilterWithAllDecorators()
+
+        self.pipeline = filtering.HttpFilterPipeline()
+        self.pipeline.add_filter(self.deferred)
+        self.pipeline.add_filter(self.after)
+
+    def test_rest_of_chain_runs_once_resolved(self):
+        result = self.pipeline.on_request_head(mock.MagicMock())
+
+        self.assertFalse(result.done())
+        self.assertFalse(self.after.on_req_head_called)
+
+        self.deferred.future.set_result(filtering.next())
+
+        self.assertTrue(self.after.on_req_head_called)
+        self.assertFalse(result.result().breaks_pipeline())
+
+    def test_breaking_action_stops_the_chain(self):
+        result = self.pipeline.on_request_head(mock.MagicMock())
+        self.deferred.future.set_result(filtering.consume())
+
+        self.assertTrue(result.result().is_consuming())
+        self.assertFalse(self.after.on_req_head_called)
+
+    def test_failed_future_rejects(self):
+        result = self.pipeline.on_request_head(mock.MagicMock())
+        self.deferred.future.set_exception(ValueError())
+
+        self.assertTrue(result.result().is_replying())
+
+
+@filtering.selects(path_prefix='/v1/', interested_methods=('POST',))
+class SelectiveFilter(TestFilterWithAllDecorators):
+    pass
+
+
+class WhenFiltersSelectMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.selective = SelectiveFilter()
+        self.everything = TestFilterWithAllDecorators()
+
+        self.pipeline = filtering.HttpFilterPipeline()
+        self.pipeline.add_filter(self.selective)
+        self.pipeline.add_filter(self.everything)
+
+    def run_request(self, method, url):
+        request = mock.MagicMock(method=method, url=url)
+        response = mock.MagicMock(status='200 OK')
+
+        self.pipeline.on_request_head(request)
+        self.pipeline.on_request_body(mock.MagicMock(), mock.MagicMock())
+        self.pipeline.on_response_head(response, request)
+        self.pipeline.on_response_body(
+            mock.MagicMock(), mock.MagicMock(), request)
+
+    def test_only_selected_messages_are_filtered(self):
+        self.run_request('GET', '/v1/resource')
+
+        self.assertFalse(self.selective.on_req_head_called)
+        self.assertFalse(self.selective.on_resp_body_called)
+        self.assertTrue(self.everything.were_expected_calls_made())
+
+        self.run_request('POST', '/v1/resource')
+        self.assertTrue(self.selective.were_expected_calls_made())
+
 
 class TestHttpFilterPipeline(unittest.TestCase):
     def test_response_methods_pass_optional_request(self):
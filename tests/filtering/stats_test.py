@@ -0,0 +1,82 @@
+import mock
+import unittest
+
+from tornado.concurrent import Future
+
+import pyrox.filtering as filtering
+from pyrox.filtering import stats
+
+
+class CountedFilter(filtering.HttpFilter):
+
+    def __init__(self):
+        self.future = Future()
+
+    @filtering.handles_request_head
+    def on_req_head(self, request_head):
+        return filtering.reject()
+
+    @filtering.handles_request_body
+    def on_req_body(self, body_part, output):
+        raise ValueError()
+
+    @filtering.handles_response_head
+    def on_resp_head(self, response_head):
+        return self.future
+
+
+KEY = '{}.CountedFilter.{{}}'.format(__name__)
+
+
+class WhenCollectingFilterStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = filtering.FilterStats()
+        self.http_filter = CountedFilter()
+
+        template = filtering.PipelineTemplate(
+            [lambda: self.http_filter], stats=self.stats)
+        self.pipeline = template.build()
+
+    def test_calls_and_actions_are_counted(self):
+        self.pipeline.on_request_head(mock.MagicMock())
+        self.pipeline.on_request_head(mock.MagicMock())
+
+        hook_stats = self.stats.get(KEY.format('on_req_head'))
+        self.assertEqual(2, hook_stats.calls)
+        self.assertEqual({'REPLY': 2}, hook_stats.actions)
+        self.assertEqual(2, sum(hook_stats.histogram))
+        self.assertEqual(0, hook_stats.exceptions)
+
+    def test_exceptions_are_counted(self):
+        self.pipeline.on_request_body(mock.MagicMock(), mock.MagicMock())
+
+        hook_stats = self.stats.get(KEY.format('on_req_body'))
+        self.assertEqual(1, hook_stats.exceptions)
+        self.assertEqual({'REPLY': 1}, hook_stats.actions)
+
+    def test_futures_are_timed_until_resolved(self):
+        with mock.patch.object(stats, 'clock', side_effect=[1.0, 1.5]):
+            self.pipeline.on_response_head(mock.MagicMock())
+            self.assertIsNone(self.stats.get(KEY.format('on_resp_head')))
+
+            self.http_filter.future.set_result(filtering.next())
+
+        hook_stats = self.stats.get(KEY.format('on_resp_head'))
+        self.assertEqual(0.5, hook_stats.total_time)
+        self.assertEqual({'NEXT_FILTER': 1}, hook_stats.actions)
+        self.assertIn(KEY.format('on_resp_head'), self.stats.format())
+
+    def test_pipelines_without_stats_do_not_collect(self):
+        pipeline = filtering.HttpFilterPipeline()
+        pipeline.add_filter(self.http_filter)
+
+        with mock.patch.object(stats, 'clock') as clock:
+            pipeline.on_request_head(mock.MagicMock())
+
+        self.assertFalse(clock.called)
+        self.assertEqual({}, self.stats.snapshot())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,37 @@
 import unittest
 
-from pyrox.http import HttpHeader, HttpMessage, HttpRequest, HttpResponse
+from pyrox.http import (HttpHeader, HttpMessage, HttpRequest, HttpResponse,
+                        RequestParser, ParserDelegate)
+
+
+class RawHeadDelegate(ParserDelegate):
+
+    def __init__(self):
+        self.head = None
+
+    def on_headers_complete(self, headers=None):
+        self.head = headers
+
+
+def request_head(headers):
+    return 'GET / HTTP/1.1\r\n{}\r\n'.format(
+        ''.join('{}: {}\r\n'.format(*h) for h in headers))
+
+
+def raw_head(headers):
+    delegate = RawHeadDelegate()
+    parser = RequestParser(delegate, lazy_headers=True)
+    parser.execute(request_head(headers))
+    return delegate.head
+
+
+def raw_request(headers):
+    http_msg = HttpRequest()
+    http_msg.method = 'GET'
+    http_msg.url = '/'
+    http_msg.version = '1.1'
+    http_msg.load_raw_head(raw_head(headers))
+    return http_msg
 
 
 class WhenManipulatingHeaders(unittest.TestCase):
@@ -32,6 +63,148 @@ class WhenManipulatingHeaders(unittest.TestCase):
         http_msg = HttpMessage()
         self.assertIsNone(http_msg.get_header('test'))
 
+    def test_adding_headers_in_bulk(self):
+        http_msg = HttpMessage()
+        http_msg.add_headers([
+            ('Accept', 'text/plain'),
+            ('Host', 'localhost'),
+            ('accept', 'text/html')])
+
+        self.assertEqual(['text/plain', 'text/html'],
+                         http_msg.get_header('accept').values)
+        self.assertEqual('Accept', http_msg.get_header('accept').name)
+        self.assertEqual(['localhost'], http_msg.get_header('host').values)
+
+
+class WhenUsingRawHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.http_msg = HttpMessage()
+        self.http_msg.load_raw_head(raw_head([
+            ('Accept', 'text/plain'),
+            ('Host', 'localhost'),
+            ('accept', 'text/html')]))
+
+    def test_get_header_materializes_on_lookup(self):
+        header = self.http_msg.get_header('ACCEPT')
+
+        self.assertEqual('Accept', header.name)
+        self.assertEqual(['text/plain', 'text/html'], header.values)
+        self.assertIs(header, self.http_msg.get_header('accept'))
+        self.assertIsNone(self.http_msg.get_header('missing'))
+
+    def test_modifying_a_raw_header(self):
+        self.http_msg.header('host').values[0] = 'example.com'
+        self.assertEqual(['example.com'],
+                         self.http_msg.headers['host'].values)
+
+    def test_removing_a_raw_header(self):
+        self.assertTrue(self.http_msg.remove_header('accept'))
+        self.assertFalse(self.http_msg.remove_header('accept'))
+        self.assertIsNone(self.http_msg.get_header('accept'))
+        self.assertEqual(['host'], list(self.http_msg.headers))
+
+    def test_headers_materializes_everything(self):
+        self.http_msg.add_headers([('Accept', 'text/xml')])
+        headers = self.http_msg.headers
+
+        self.assertEqual(['text/plain', 'text/html', 'text/xml'],
+                         headers['accept'].values)
+        self.assertEqual(['localhost'], headers['host'].values)
+
+
+class WhenSerializingMessages(unittest.TestCase):
+
+    def test_serializing_request(self):
+        http_msg = HttpRequest()
+        http_msg.method = 'GET'
+        http_msg.url = '/test'
+        http_msg.version = '1.1'
+        http_msg.header('Accept').values.extend(['text/plain', u'text/html'])
+
+        self.assertEqual(
+            'GET /test HTTP/1.1\r\n'
+            'Accept: text/plain, text/html\r\n'
+            'Content-Length: 0\r\n\r\n', http_msg.to_bytes())
+
+    def test_serializing_response(self):
+        http_msg = HttpResponse()
+        http_msg.version = '1.1'
+        http_msg.status = '200 OK'
+        http_msg.header(u'Transfer-Encoding').values.append('chunked')
+
+        self.assertEqual(
+            'HTTP/1.1 200 OK\r\n'
+            'Transfer-Encoding: chunked\r\n\r\n', http_msg.to_bytes())
+
+
+class WhenSerializingRawMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.headers = [('Accept', 'text/plain'), ('Host', 'localhost')]
+        self.http_msg = raw_request(self.headers)
+
+    def test_unmodified_message_is_forwarded_verbatim(self):
+        self.http_msg.get_header('accept')
+
+        self.assertFalse(self.http_msg.is_modified())
+        self.assertEqual(request_head(self.headers), self.http_msg.to_bytes())
+
+    def test_message_without_raw_head_is_modified(self):
+        self.assertTrue(HttpRequest().is_modified())
+
+    def test_changing_header_values_modifies_message(self):
+        self.http_msg.header('accept').values.append('text/html')
+
+        self.assertTrue(self.http_msg.is_modified())
+        self.assertIn('Accept: text/plain, text/html\r\n',
+                      self.http_msg.to_bytes())
+
+    def test_adding_or_removing_headers_modifies_message(self):
+        self.http_msg.remove_header('accept')
+        self.assertTrue(self.http_msg.is_modified())
+
+        http_msg = raw_request(self.headers)
+        http_msg.header('X-New')
+        self.assertTrue(http_msg.is_modified())
+
+    def test_changing_start_line_modifies_message(self):
+        self.http_msg.url = '/other'
+
+        self.assertTrue(self.http_msg.is_modified())
+        self.assertTrue(self.http_msg.to_bytes().startswith(
+            'GET /other HTTP/1.1\r\n'))
+
+    def test_set_header_splices_existing_header(self):
+        self.http_msg.get_header('host')
+        self.http_msg.set_header('host', 'example.com:80')
+
+        self.assertFalse(self.http_msg.is_modified())
+        self.assertEqual(['example.com:80'],
+                         self.http_msg.get_header('host').values)
+        self.assertEqual(request_head([
+            ('Accept', 'text/plain'),
+            ('Host', 'example.com:80')]), self.http_msg.to_bytes())
+
+    def test_set_header_splices_missing_header(self):
+        self.http_msg.set_header('X-Proxy', 'pyrox')
+        self.http_msg.set_header('accept', '*/*')
+
+        self.assertFalse(self.http_msg.is_modified())
+        self.assertEqual(['*/*'], self.http_msg.get_header('accept').values)
+        self.assertEqual(request_head([
+            ('X-Proxy', 'pyrox'),
+            ('Accept', '*/*'),
+            ('Host', 'localhost')]), self.http_msg.to_bytes())
+
+    def test_set_header_on_modified_message(self):
+        self.http_msg.remove_header('accept')
+        self.http_msg.set_header('host', 'example.com:80')
+
+        self.assertEqual(['example.com:80'],
+                         self.http_msg.get_header('host').values)
+        self.assertNotIn('Accept', self.http_msg.to_bytes())
+
 
 if __name__ == '__main__':
     unittest.main()
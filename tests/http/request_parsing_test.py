@@ -1,6 +1,6 @@
 import unittest
 
-from pyrox.http import RequestParser, ParserDelegate
+from pyrox.http import RequestParser, ParserDelegate, RawHead, retain
 
 UNEXPECTED_HEADER_REQUEST = (
     'GET /test/12345?field=f1&field2=f2#fragment HTTP/1.1\r\n'
@@ -131,6 +131,75 @@ class NonChunkedValidatingDelegate(ValidatingDelegate):
         self.test.assertEqual(is_chunked, 0)
 
 
+class BodyRetainingDelegate(ParserDelegate):
+
+    def __init__(self):
+        self.body_types = list()
+        self.body = bytearray()
+
+    def on_body(self, data, length, is_chunked):
+        self.body_types.append(type(data))
+        self.body.extend(retain(data))
+
+
+class HeaderBatchDelegate(ParserDelegate):
+
+    def __init__(self):
+        self.header_calls = 0
+        self.headers = None
+
+    def on_header_field(self, field):
+        self.header_calls += 1
+
+    def on_header_value(self, value):
+        self.header_calls += 1
+
+    def on_headers_complete(self, headers=None):
+        self.headers = headers
+
+
+class LongTokenDelegate(ParserDelegate):
+
+    def __init__(self):
+        self.url = None
+        self.fields = list()
+        self.values = list()
+
+    def on_req_path(self, url):
+        self.url = url
+
+    def on_header_field(self, field):
+        self.fields.append(field)
+
+    def on_header_value(self, value):
+        self.values.append(value)
+
+
+class PausingDelegate(ParserDelegate):
+
+    def __init__(self, pause_on):
+        self.parser = None
+        self.pause_on = pause_on
+        self.events = list()
+
+    def _event(self, name, *args):
+        self.events.append((name,) + args)
+        if name in self.pause_on:
+            self.parser.pause()
+
+    def on_req_path(self, url):
+        self._event('path', url)
+
+    def on_headers_complete(self, headers=None):
+        self._event('headers')
+
+    def on_body(self, data, length, is_chunked):
+        self._event('body', retain(data))
+
+    def on_message_complete(self, is_chunked, keep_alive):
+        self._event('complete')
+
+
 class WhenParsingRequests(unittest.TestCase):
 
     def test_reading_request_with_content_length(self):
@@ -170,6 +239,207 @@ class WhenParsingRequests(unittest.TestCase):
             BODY_SLOT: 4,
             BODY_COMPLETE_SLOT: 1}, self)
 
+    def test_zero_copy_body_delivers_views(self):
+        delegate = BodyRetainingDelegate()
+        parser = RequestParser(delegate, zero_copy_body=True)
+
+        chunk_message(bytearray(NORMAL_REQUEST), parser)
+
+        self.assertEqual(b'This is test', bytes(delegate.body))
+        self.assertEqual([memoryview, memoryview], delegate.body_types)
+
+    def test_zero_copy_body_from_memoryview(self):
+        delegate = BodyRetainingDelegate()
+        parser = RequestParser(delegate, zero_copy_body=True)
+
+        parser.execute(memoryview(bytearray(CHUNKED_REQUEST)))
+
+        self.assertEqual(b'all your base are belong to us',
+                         bytes(delegate.body))
+
+    def test_batched_headers(self):
+        delegate = HeaderBatchDelegate()
+        parser = RequestParser(delegate, batch_headers=True)
+
+        chunk_message(
+            'GET /test HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'X-Empty:\r\n'
+            'X-Padded: \t padded value\r\n'
+            'Content-Length: 0\r\n\r\n', parser, chunk_size=3)
+
+        self.assertEqual(0, delegate.header_calls)
+        self.assertEqual([
+            ('Host', 'localhost'),
+            ('X-Empty', ''),
+            ('X-Padded', 'padded value'),
+            ('Content-Length', '0')], delegate.headers)
+
+    def test_batched_headers_reset_between_messages(self):
+        delegate = HeaderBatchDelegate()
+        parser = RequestParser(delegate, batch_headers=True)
+
+        parser.execute(NORMAL_REQUEST)
+        parser.execute(CHUNKED_REQUEST)
+
+        self.assertEqual([
+            ('Connection', 'keep-alive'),
+            ('Transfer-Encoding', 'chunked')], delegate.headers)
+
+    def test_lazy_headers(self):
+        delegate = HeaderBatchDelegate()
+        parser = RequestParser(delegate, lazy_headers=True)
+
+        chunk_message(
+            'GET /test HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Accept: text/plain\r\n'
+            'accept: text/html\r\n'
+            'Content-Length: 0\r\n\r\n', parser, chunk_size=3)
+
+        head = delegate.headers
+        self.assertEqual(0, delegate.header_calls)
+        self.assertIsInstance(head, RawHead)
+        self.assertEqual(4, len(head))
+        self.assertTrue('HOST' in head)
+        self.assertFalse('X-Missing' in head)
+        self.assertEqual(('Accept', ['text/plain', 'text/html']),
+                         head.get('accept'))
+        self.assertIsNone(head.get('X-Missing'))
+        self.assertEqual([
+            ('Host', 'localhost'),
+            ('Accept', 'text/plain'),
+            ('accept', 'text/html'),
+            ('Content-Length', '0')], head.items())
+
+        # Splicing a value into a repeated header is ambiguous
+        self.assertIsNone(head.replace_value('accept', '*/*'))
+        self.assertEqual(('Host', ['example.com']),
+                         head.replace_value('host', 'example.com').get('host'))
+
+    def test_pausing_holds_remaining_data(self):
+        delegate = PausingDelegate(('headers', 'body'))
+        parser = RequestParser(delegate, zero_copy_body=True)
+        delegate.parser = parser
+
+        parser.execute(bytearray(CHUNKED_REQUEST))
+        self.assertTrue(parser.is_paused())
+        self.assertEqual('headers', delegate.events[-1][0])
+
+        parser.resume()
+        self.assertEqual(
+            ('body', 'all your base are belong to us'), delegate.events[-1])
+
+        # Data read while paused is held behind what's already waiting
+        parser.execute('\r\n')
+        parser.resume()
+        self.assertEqual(('complete',), delegate.events[-1])
+        self.assertFalse(parser.is_paused())
+
+    def test_message_ending_while_paused_completes_on_resume(self):
+        delegate = PausingDelegate(('headers',))
+        parser = RequestParser(delegate)
+        delegate.parser = parser
+
+        parser.execute('GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual('headers', delegate.events[-1][0])
+
+        parser.resume()
+        self.assertEqual(('complete',), delegate.events[-1])
+
+    def test_destroying_parser_from_callback(self):
+        delegate = PausingDelegate(())
+        parser = RequestParser(delegate)
+        delegate.on_headers_complete = lambda headers=None: parser.destroy()
+
+        parser.execute(NORMAL_REQUEST + NORMAL_REQUEST)
+
+        self.assertNotIn(('complete',), delegate.events)
+        self.assertFalse(parser.is_paused())
+
+    def test_pipelined_requests_in_one_read(self):
+        delegate = PausingDelegate(())
+        parser = RequestParser(delegate)
+
+        parser.execute(NORMAL_REQUEST + NORMAL_REQUEST)
+
+        self.assertEqual(2, delegate.events.count(('complete',)))
+        self.assertEqual(2, delegate.events.count(
+            ('path', '/test/12345?field=f1&field2=f2#fragment')))
+
+    def test_body_callback_exception_propagation(self):
+        delegate = PausingDelegate(())
+        delegate.on_body = lambda *args: 1 / 0
+        parser = RequestParser(delegate)
+
+        with self.assertRaises(ZeroDivisionError):
+            parser.execute(NORMAL_REQUEST)
+
+    def test_raw_chunks_are_passed_through(self):
+        for chunk_size in (1, 7, len(CHUNKED_REQUEST)):
+            delegate = PausingDelegate(())
+            parser = RequestParser(delegate, raw_chunks=True)
+
+            chunk_message(CHUNKED_REQUEST + NORMAL_REQUEST, parser,
+                          chunk_size=chunk_size)
+
+            body = ''.join(e[1] for e in delegate.events if e[0] == 'body')
+            self.assertEqual(
+                '1e\r\nall your base are belong to us\r\n0\r\n'
+                'This is test', body)
+            self.assertEqual(2, delegate.events.count(('complete',)))
+
+    def test_known_methods_and_header_names_are_shared(self):
+        first = LongTokenDelegate()
+        second = LongTokenDelegate()
+
+        for delegate in (first, second):
+            delegate.on_req_method = delegate.fields.append
+            RequestParser(delegate).execute(
+                'GET / HTTP/1.1\r\n'
+                'Host: localhost\r\n'
+                'content-length: 0\r\n'
+                'X-Unknown: value\r\n\r\n')
+
+        self.assertEqual(
+            ['GET', 'Host', 'content-length', 'X-Unknown'], first.fields)
+        for known in range(3):
+            self.assertIs(first.fields[known], second.fields[known])
+        self.assertIsNot(first.fields[3], second.fields[3])
+
+    def test_long_tokens_split_across_reads(self):
+        path = '/' + '/'.join('segment{}'.format(i) for i in range(50))
+        value = ' '.join('value{}'.format(i) for i in range(50))
+        request = (
+            'GET {} HTTP/1.1\r\n'
+            'X-Long: {}\r\n'
+            'Transfer-Encoding: chunked\r\n\r\n'
+            '0\r\n').format(path, value)
+
+        for chunk_size in (1, 7, 64, len(request)):
+            delegate = LongTokenDelegate()
+            parser = RequestParser(delegate)
+
+            chunk_message(request, parser, chunk_size=chunk_size)
+
+            self.assertEqual(path, delegate.url)
+            self.assertEqual(['X-Long', 'Transfer-Encoding'], delegate.fields)
+            self.assertEqual([value, 'chunked'], delegate.values)
+
+    def test_bad_path_character_after_long_path(self):
+        parser = RequestParser(ParserDelegate())
+
+        with self.assertRaises(Exception):
+            parser.execute('GET /{}\x01 HTTP/1.1\r\n\r\n'.format('a' * 64))
+
+    def test_retain_returns_owned_bytes(self):
+        data = bytearray(b'test')
+        retained = retain(memoryview(data)[1:3])
+        data[1:3] = b'xx'
+
+        self.assertEqual(b'es', retained)
+        self.assertEqual(b'test', retain(b'test'))
+
 
 if __name__ == '__main__':
     unittest.main()
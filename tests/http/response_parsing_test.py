@@ -135,6 +135,19 @@ class WhenParsingResponses(unittest.TestCase):
             BODY_SLOT: 4,
             BODY_COMPLETE_SLOT: 1}, self)
 
+    def test_reading_long_reason_phrase(self):
+        tracker = TrackingDelegate(ValidatingDelegate(self))
+        parser = ResponseParser(tracker)
+
+        chunk_message(NORMAL_RESPONSE.replace(
+            '200 OK', '200 {}'.format('Everything Is Fine ' * 20)), parser)
+
+        tracker.validate_hits({
+            RESPONSE_CODE_SLOT: 1,
+            HEADER_FIELD_SLOT: 1,
+            HEADER_VALUE_SLOT: 1,
+            BODY_COMPLETE_SLOT: 1}, self)
+
 
 if __name__ == '__main__':
     unittest.main()
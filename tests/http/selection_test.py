@@ -0,0 +1,64 @@
+import unittest
+
+from pyrox.http import HttpMessageSelector, SelectorIndex
+
+
+class WhenSelectingMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = HttpMessageSelector(path_prefix='/v1/')
+        self.regex = HttpMessageSelector(
+            path_re=r'/v\d+/users', interested_methods=('get',))
+        self.status = HttpMessageSelector(interested_codes=(404,))
+        self.both = HttpMessageSelector(
+            path_re=r'/a(b)?', path_prefix='/ab')
+
+        self.index = SelectorIndex(
+            (self.prefix, self.regex, self.status, self.both))
+
+    def test_selecting_requests(self):
+        self.assertEqual(
+            set([self.prefix, self.regex, self.status]),
+            self.index.select('GET', '/v1/users'))
+        self.assertEqual(
+            set([self.prefix, self.status]),
+            self.index.select('POST', '/v1/users'))
+        self.assertEqual(
+            set([self.status, self.both]),
+            self.index.select('get', '/abc'))
+
+    def test_selecting_responses(self):
+        self.assertEqual(
+            set([self.regex]), self.index.select('GET', '/v2/users', 200))
+        self.assertEqual(
+            set([self.regex, self.status]),
+            self.index.select('GET', '/v2/users', 404))
+
+    def test_index_agrees_with_selectors(self):
+        for method, path in (('GET', '/v1/users/1'), ('PUT', '/ab'),
+                             ('GET', '/other'), ('DELETE', '/v12/users')):
+            expected = set(
+                selector for selector in self.index.selectors
+                if selector.wants_method(method) and
+                selector.wants_path(path))
+            self.assertEqual(expected, self.index.select(method, path))
+
+    def test_expressions_that_can_not_be_combined(self):
+        selectors = [HttpMessageSelector(path_re='(?P<id>/{})'.format(n))
+                     for n in range(3)]
+        index = SelectorIndex(selectors)
+
+        self.assertEqual(set([selectors[1]]), index.select(path='/1/x'))
+
+    def test_expressions_with_backreferences(self):
+        plain = HttpMessageSelector(path_re='/x')
+        repeated = HttpMessageSelector(path_re=r'/(\w+)/\1$')
+        index = SelectorIndex((plain, repeated))
+
+        self.assertEqual(set([repeated]), index.select(path='/ab/ab'))
+        self.assertEqual(set(), index.select(path='/ab/cd'))
+        self.assertEqual(set([plain]), index.select(path='/x/x/y'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ import unittest
 from pyrox.server.config import load_pyrox_config
 from pyrox.server.config import _split_and_strip as split_and_strip
 from pyrox.server.config import _host_tuple as host_tuple
+from pyrox.server.config import _weighted_host as weighted_host
 from pyrox.util.config import ConfigurationError
 
 
@@ -58,5 +59,19 @@ class WhenManipulatingHeaders(unittest.TestCase):
     def test_host_tuple_should_raise_configuration_error(self):
         self.assertRaises(ConfigurationError, host_tuple, 'a.b.c:1:2:3')
 
+    def test_weighted_host(self):
+        self.assertEqual(weighted_host('http://localhost:80'),
+                         ('http://localhost:80', 1))
+        self.assertEqual(weighted_host('http://localhost:80 weight=3'),
+                         ('http://localhost:80', 3))
+
+    def test_weighted_host_should_raise_configuration_error(self):
+        self.assertRaises(ConfigurationError, weighted_host,
+                          'http://localhost:80 weight=a')
+        self.assertRaises(ConfigurationError, weighted_host,
+                          'http://localhost:80 weight=-1')
+        self.assertRaises(ConfigurationError, weighted_host,
+                          'http://localhost:80 3')
+
 if __name__ == '__main__':
     unittest.main()
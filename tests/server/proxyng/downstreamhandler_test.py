@@ -0,0 +1,239 @@
+import unittest
+import mock
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import pyrox.filtering as filtering
+from pyrox.filtering import HttpFilterPipeline
+from pyrox.filtering.output import buffer_pool
+from pyrox.http import RequestParser
+from pyrox.server.proxyng import DownstreamHandler, FlowControl
+
+
+PIPELINED_REQUESTS = (
+    'POST /first HTTP/1.1\r\n'
+    'Content-Length: 4\r\n\r\n'
+    'test'
+    'GET /second HTTP/1.1\r\n\r\n')
+
+
+class DeferredFilter(filtering.HttpFilter):
+
+    def __init__(self):
+        self.future = Future()
+
+    @filtering.handles_request_head
+    def on_req_head(self, request_head):
+        return self.future
+
+
+class DownstreamHandlerTestCase(unittest.TestCase):
+
+    def build_handler(self, pipeline):
+        self.downstream = mock.MagicMock()
+        self.downstream.closed.return_value = False
+        self.upstream = mock.MagicMock()
+        self.requests = list()
+
+        self.flow = FlowControl(self.downstream)
+        self.handler = DownstreamHandler(
+            self.downstream,
+            pipeline,
+            self.connect_upstream,
+            self.flow)
+        self.parser = RequestParser(self.handler)
+        self.flow.parser = self.parser
+
+    def connect_upstream(self, request, route=None):
+        self.requests.append(request.url)
+        self.handler.on_upstream_connect(self.upstream)
+
+
+class TestDownstreamHandler(DownstreamHandlerTestCase):
+
+    def setUp(self):
+        self.build_handler(HttpFilterPipeline())
+
+    def test_pipelined_requests_are_handled_in_order(self):
+        self.parser.execute(PIPELINED_REQUESTS)
+
+        # The body write holds the parser until upstream takes it
+        self.assertEqual(['/first'], self.requests)
+        self.upstream.write.assert_called_once_with(
+            'test', self.handler._resume)
+        self.handler._resume()
+
+        # The second request waits for the response to the first
+        self.assertEqual(['/first'], self.requests)
+        self.assertTrue(self.parser.is_paused())
+
+        self.handler.on_response_complete()
+        self.assertEqual(['/first', '/second'], self.requests)
+
+    def test_closing_downstream_without_keep_alive(self):
+        self.parser.execute('GET / HTTP/1.0\r\n\r\n')
+        self.handler.on_response_complete()
+
+        self.downstream.close.assert_called_once_with()
+
+    def test_next_request_is_handled_after_an_upstream_error(self):
+        self.parser.execute(PIPELINED_REQUESTS)
+        self.handler.on_upstream_error()
+
+        # The 502 completes the response once it has been written
+        response, on_written = self.downstream.write.call_args[0]
+        self.assertTrue(response.startswith('HTTP/1.1 502 Bad Gateway'))
+        self.assertEqual(['/first'], self.requests)
+
+        on_written()
+        self.assertEqual(['/first', '/second'], self.requests)
+
+
+class BodyFilter(filtering.HttpFilter):
+
+    @filtering.handles_request_body
+    def on_req_body(self, body_part, output):
+        output.write(body_part)
+
+
+class TestDownstreamHandlerWithBodyFilters(DownstreamHandlerTestCase):
+
+    def setUp(self):
+        pipeline = HttpFilterPipeline()
+        pipeline.add_filter(BodyFilter())
+        self.build_handler(pipeline)
+
+    def test_requests_without_a_body_are_sent_as_they_are(self):
+        self.parser.execute('GET /first HTTP/1.1\r\n\r\n')
+
+        self.assertEqual(['/first'], self.requests)
+        self.assertFalse(self.upstream.write.called)
+
+    def test_bodies_with_a_length_are_rechunked(self):
+        self.parser.execute(
+            'POST /first HTTP/1.1\r\n'
+            'Content-Length: 4\r\n\r\n'
+            'test')
+
+        self.assertEqual(
+            '4\r\ntest\r\n', bytes(self.upstream.write.call_args[0][0]))
+
+        # Upstream takes the body part and the parser moves on
+        self.handler._resume()
+        self.upstream.write.assert_called_with('0\r\n\r\n')
+        self.assertEqual(
+            ['chunked'],
+            self.handler._http_msg.get_header('transfer-encoding').values)
+
+
+class TestDownstreamHandlerWithAsyncFilters(DownstreamHandlerTestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+        self.deferred = DeferredFilter()
+        pipeline = HttpFilterPipeline()
+        pipeline.add_filter(self.deferred)
+        self.build_handler(pipeline)
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def resolve(self, action):
+        self.deferred.future.set_result(action)
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_request_waits_for_filter(self):
+        self.parser.execute(PIPELINED_REQUESTS)
+
+        self.assertEqual([], self.requests)
+        self.assertTrue(self.parser.is_paused())
+
+        self.resolve(filtering.next())
+        self.assertEqual(['/first'], self.requests)
+
+    def test_rejection_from_filter(self):
+        response = mock.MagicMock()
+        response.to_bytes.return_value = 'rejected'
+
+        self.parser.execute('GET / HTTP/1.0\r\n\r\n')
+        self.resolve(filtering.reply(response))
+
+        self.assertEqual([], self.requests)
+        self.downstream.write.assert_called_once_with('rejected', mock.ANY)
+
+
+class ValidatingFilter(filtering.HttpFilter):
+
+    def __init__(self):
+        self.bodies = list()
+
+    @filtering.handles_aggregated_request_body
+    def on_whole_body(self, body, output):
+        self.bodies.append(body.tobytes())
+
+        if body.tobytes() == 'invalid':
+            return filtering.reject()
+
+        output.write(body.tobytes().upper())
+
+
+class TestDownstreamHandlerWithAggregatedBodies(DownstreamHandlerTestCase):
+
+    def setUp(self):
+        self.validator = ValidatingFilter()
+        pipeline = HttpFilterPipeline()
+        pipeline.add_filter(self.validator)
+        self.build_handler(pipeline)
+
+    def connect_upstream(self, request, route=None):
+        self.request = request
+        super(TestDownstreamHandlerWithAggregatedBodies,
+              self).connect_upstream(request, route)
+
+    def test_upstream_waits_for_the_whole_body(self):
+        self.parser.execute(
+            'POST /first HTTP/1.1\r\n'
+            'Transfer-Encoding: chunked\r\n\r\n'
+            '3\r\nabc\r\n')
+
+        self.assertEqual([], self.requests)
+
+        self.parser.execute('3\r\ndef\r\n0\r\n\r\n')
+
+        self.assertEqual(['abcdef'], self.validator.bodies)
+        self.assertEqual(['/first'], self.requests)
+        self.assertEqual(
+            ['6'], self.request.get_header('content-length').values)
+        self.assertIsNone(self.request.get_header('transfer-encoding'))
+
+        written = self.upstream.write.call_args[0][0]
+        self.assertEqual('ABCDEF', written.tobytes())
+
+    def test_destroy_does_not_pool_output_still_being_written(self):
+        self.parser.execute(
+            'POST /first HTTP/1.1\r\n'
+            'Content-Length: 6\r\n\r\n'
+            'abcdef')
+
+        # Upstream hasn't finished writing the body when the client leaves
+        written = self.upstream.write.call_args[0][0]
+        pooled = buffer_pool().pooled()
+        self.handler.destroy()
+
+        self.assertEqual(pooled, buffer_pool().pooled())
+        self.assertEqual('ABCDEF', written.tobytes())
+
+    def test_rejected_bodies_never_go_upstream(self):
+        self.parser.execute(
+            'POST /first HTTP/1.1\r\n'
+            'Content-Length: 7\r\n\r\n'
+            'invalid')
+
+        self.assertEqual([], self.requests)
+        self.downstream.write.assert_called_once_with(mock.ANY, mock.ANY)
+        self.assertIn('400 Bad Request', self.downstream.write.call_args[0][0])
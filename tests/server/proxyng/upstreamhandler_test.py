@@ -33,7 +33,14 @@ class ResponseFilterDoesNotUseRequest(filtering.HttpFilter):
     @filtering.handles_response_body
     def on_response_body_no_request(self, msg_part, body):
         return filtering.next()
-    
+
+
+class UpperCasingFilter(filtering.HttpFilter):
+    @filtering.handles_response_body
+    def on_response_body(self, msg_part, output):
+        if msg_part != b'skip':
+            output.write(bytes(msg_part).upper())
+
 
 class TestUpstreamHandler(unittest.TestCase):
     def test_on_headers_complete_passes_request(self):
@@ -56,3 +63,67 @@ class TestUpstreamHandler(unittest.TestCase):
 
         self.assertTrue(on_head_got_request)
         self.assertTrue(on_body_got_request)
+
+    def test_on_headers_complete_loads_batched_headers(self):
+        downstream = mock.MagicMock()
+        upstream = mock.MagicMock()
+
+        handler = UpstreamHandler(
+            downstream, upstream, HttpFilterPipeline(), mock.Mock())
+        handler.on_status(200)
+        handler.on_http_version(1, 1)
+        handler.on_headers_complete([
+            ('Content-Length', '12'),
+            ('X-Test', 'value')])
+
+        written = downstream.write.call_args[0][0]
+        self.assertIn('X-Test: value\r\n', written)
+        self.assertIn('Content-Length: 12\r\n', written)
+
+    def test_rewritten_body_parts_are_written_from_the_buffer(self):
+        pipeline = HttpFilterPipeline()
+        pipeline.add_filter(UpperCasingFilter())
+
+        downstream = mock.MagicMock()
+        handler = UpstreamHandler(
+            downstream, mock.MagicMock(), pipeline, mock.Mock())
+        handler.on_status(200)
+        handler.on_headers_complete()
+
+        handler.on_body(bytes=b'body', length=4, is_chunked=False)
+        written = downstream.write.call_args[0][0]
+        self.assertIsInstance(written, memoryview)
+        self.assertEqual(b'BODY', written.tobytes())
+
+        # Body parts that aren't written for go through untouched
+        unchanged = b'skip'
+        handler.on_body(bytes=unchanged, length=4, is_chunked=False)
+        self.assertIs(unchanged, downstream.write.call_args[0][0])
+
+    def test_aggregated_responses_are_sent_whole(self):
+        class SigningFilter(filtering.HttpFilter):
+            @filtering.handles_aggregated_response_body
+            def on_whole_body(self, body, output):
+                output.write(body.tobytes() + '-signed')
+
+        pipeline = HttpFilterPipeline()
+        pipeline.add_filter(SigningFilter())
+
+        downstream = mock.MagicMock()
+        handler = UpstreamHandler(
+            downstream, mock.MagicMock(), pipeline, mock.Mock(method='GET'))
+        handler.on_status(200)
+        handler.on_http_version(1, 1)
+        handler.on_headers_complete([('Transfer-Encoding', 'chunked')])
+        handler.on_body(bytes=b'part', length=4, is_chunked=True)
+
+        # Nothing goes downstream until the whole body has been read
+        self.assertFalse(downstream.write.called)
+
+        handler.on_message_complete(is_chunked=True, keep_alive=True)
+
+        head = downstream.write.call_args_list[0][0][0]
+        body = downstream.write.call_args_list[1][0][0]
+        self.assertIn('content-length: 11\r\n', head.lower())
+        self.assertNotIn('transfer-encoding', head.lower())
+        self.assertEqual(b'part-signed', body.tobytes())
@@ -0,0 +1,546 @@
+import math
+import unittest
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application, RequestHandler
+
+import pyrox.server.routing as routing
+
+from pyrox.http import HttpRequest
+from pyrox.server.routing import (RoundRobinRouter, LeastOutstandingRouter,
+                                  PeakEwmaRouter, ConsistentHashRouter,
+                                  WeightedRoundRobinRouter,
+                                  UpstreamHealth, HealthChecker,
+                                  hash_by_client, hash_by_header,
+                                  parse_hash_key, resolve_route)
+
+
+FIRST = ('localhost', 8080, routing.PROTOCOL_HTTP)
+SECOND = ('localhost', 8081, routing.PROTOCOL_HTTP)
+THIRD = ('localhost', 8082, routing.PROTOCOL_HTTP)
+
+ROUTES = [
+    'http://localhost:8080',
+    'http://localhost:8081',
+    'http://localhost:8082'
+]
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._real_clock = routing.clock
+        routing.clock = self.clock
+
+    def tearDown(self):
+        routing.clock = self._real_clock
+
+
+class WhenTrackingUpstreamHealth(RoutingTestCase):
+
+    def setUp(self):
+        super(WhenTrackingUpstreamHealth, self).setUp()
+        self.health = UpstreamHealth(backoff=1, max_backoff=4)
+
+    def test_failure_marks_target_down_until_backoff_passes(self):
+        self.health.mark_failure(FIRST)
+
+        self.assertFalse(self.health.is_healthy(FIRST))
+        self.assertEqual(self.health.down(), [FIRST])
+
+        self.clock.now += 1
+        self.assertTrue(self.health.is_healthy(FIRST))
+
+    def test_backoff_doubles_and_is_capped(self):
+        backoffs = list()
+
+        for failure in range(4):
+            self.health.mark_failure(FIRST)
+            start = self.clock.now
+
+            while not self.health.is_healthy(FIRST):
+                self.clock.now += 0.5
+
+            backoffs.append(self.clock.now - start)
+
+        self.assertEqual(backoffs, [1, 2, 4, 4])
+
+    def test_failures_while_down_are_ignored(self):
+        self.health.mark_failure(FIRST)
+        self.health.mark_failure(FIRST)
+
+        self.clock.now += 1
+        self.assertTrue(self.health.is_healthy(FIRST))
+
+    def test_success_resets_backoff(self):
+        self.health.mark_failure(FIRST)
+        self.clock.now += 1
+        self.health.mark_failure(FIRST)
+        self.clock.now += 2
+        self.health.mark_success(FIRST)
+
+        self.health.mark_failure(FIRST)
+        self.clock.now += 1
+        self.assertTrue(self.health.is_healthy(FIRST))
+
+
+class WhenRoutingRoundRobin(RoutingTestCase):
+
+    def setUp(self):
+        super(WhenRoutingRoundRobin, self).setUp()
+        self.router = RoundRobinRouter(
+            ['http://localhost:8080', 'http://localhost:8081'])
+
+    def test_routes_alternate(self):
+        routes = [self.router.get_next() for i in range(4)]
+        self.assertEqual(routes, [SECOND, FIRST, SECOND, FIRST])
+
+    def test_down_routes_are_skipped(self):
+        self.router.on_upstream_error(SECOND)
+
+        routes = [self.router.get_next() for i in range(3)]
+        self.assertEqual(routes, [FIRST, FIRST, FIRST])
+
+    def test_route_is_used_again_after_recovering(self):
+        self.router.on_upstream_error(SECOND)
+        self.clock.now += routing.DEFAULT_FAILURE_BACKOFF
+        self.router.on_upstream_connect(SECOND)
+
+        routes = set(self.router.get_next() for i in range(2))
+        self.assertEqual(routes, set([FIRST, SECOND]))
+
+    def test_none_is_returned_when_all_routes_are_down(self):
+        self.router.on_upstream_error(FIRST)
+        self.router.on_upstream_error(SECOND)
+
+        self.assertIsNone(self.router.get_next())
+
+    def test_set_next_overrides_health(self):
+        self.router.on_upstream_error(FIRST)
+        self.router.set_next('http://localhost:8080')
+
+        self.assertIn(self.router.get_next(), (FIRST, SECOND, THIRD))
+
+
+class WhenResolvingRoutes(unittest.TestCase):
+
+    def setUp(self):
+        routing._resolved_routes.clear()
+        self.router = RoundRobinRouter(ROUTES)
+
+    def tearDown(self):
+        routing._resolved_routes.clear()
+
+    def test_resolved_route_is_reused(self):
+        route = resolve_route('http://localhost:8080')
+
+        self.assertEqual(route, FIRST)
+        self.assertIs(resolve_route('http://localhost:8080'), route)
+
+    def test_oldest_route_is_forgotten(self):
+        for port in range(routing.DEFAULT_RESOLVED_ROUTES + 1):
+            resolve_route('http://localhost:{}'.format(port))
+
+        self.assertEqual(
+            len(routing._resolved_routes), routing.DEFAULT_RESOLVED_ROUTES)
+        self.assertNotIn('http://localhost:0', routing._resolved_routes)
+
+    def test_set_next_takes_url(self):
+        self.router.set_next('http://localhost:8082')
+
+        self.assertEqual(self.router.get_next(), THIRD)
+        self.assertIn('http://localhost:8082', routing._resolved_routes)
+
+    def test_set_next_takes_resolved_route(self):
+        route = resolve_route('http://localhost:8082')
+        self.router.set_next(route)
+
+        self.assertIs(self.router.get_next(), route)
+
+    def test_set_next_rejects_other_types(self):
+        self.assertRaises(TypeError, self.router.set_next, None)
+        self.assertRaises(TypeError, self.router.set_next, ('localhost', 80))
+
+    def test_set_next_rejects_invalid_routes(self):
+        for route in (('', 80, routing.PROTOCOL_HTTP),
+                      (None, 80, routing.PROTOCOL_HTTP),
+                      ('localhost', '80', routing.PROTOCOL_HTTP),
+                      ('localhost', 0, routing.PROTOCOL_HTTP),
+                      ('localhost', 65536, routing.PROTOCOL_HTTP),
+                      ('localhost', 80, 'http')):
+            self.assertRaises(ValueError, self.router.set_next, route)
+
+        self.assertIn(self.router.get_next(), (FIRST, SECOND, THIRD))
+
+
+class WhenRoutingByLeastOutstanding(RoutingTestCase):
+
+    def setUp(self):
+        super(WhenRoutingByLeastOutstanding, self).setUp()
+        self.router = LeastOutstandingRouter(ROUTES)
+
+    def start(self):
+        route = self.router.get_next()
+        self.router.on_request_start(route)
+        return route
+
+    def test_idle_routes_are_taken_in_turn(self):
+        routes = set(self.start() for i in range(3))
+        self.assertEqual(routes, set([FIRST, SECOND, THIRD]))
+
+    def test_busiest_route_is_avoided(self):
+        for i in range(3):
+            self.router.on_request_start(SECOND)
+        self.router.on_request_start(THIRD)
+
+        self.assertEqual(self.start(), FIRST)
+        self.assertEqual(
+            set([self.start(), self.start()]), set([FIRST, THIRD]))
+
+    def test_completed_requests_are_not_counted(self):
+        self.router.on_request_start(FIRST)
+        self.router.on_request_complete(FIRST, 0.1)
+
+        self.assertEqual(self.router.outstanding(FIRST), 0)
+
+    def test_down_routes_are_skipped(self):
+        self.router.on_upstream_error(FIRST)
+        self.router.on_upstream_error(SECOND)
+
+        routes = set(self.start() for i in range(3))
+        self.assertEqual(routes, set([THIRD]))
+
+
+class WhenRoutingByPeakEwma(RoutingTestCase):
+
+    def setUp(self):
+        super(WhenRoutingByPeakEwma, self).setUp()
+        self.router = PeakEwmaRouter(ROUTES[:2], decay=10)
+
+    def test_faster_route_is_chosen(self):
+        self.router.on_request_complete(FIRST, 0.5)
+        self.router.on_request_complete(SECOND, 0.1)
+
+        routes = set(self.router.get_next() for i in range(5))
+        self.assertEqual(routes, set([SECOND]))
+
+    def test_latency_peaks_immediately(self):
+        self.router.on_request_complete(FIRST, 0.1)
+        self.router.on_request_complete(FIRST, 2.0)
+
+        self.assertEqual(self.router.latency(FIRST), 2.0)
+
+    def test_latency_decays_over_time(self):
+        self.router.on_request_complete(FIRST, 2.0)
+        self.clock.now += 10
+
+        self.assertAlmostEqual(self.router.latency(FIRST), 2.0 / math.e)
+
+    def test_faster_latencies_are_averaged_in(self):
+        self.router.on_request_complete(FIRST, 2.0)
+        self.router.on_request_complete(FIRST, 0.1)
+
+        self.assertEqual(self.router.latency(FIRST), 2.0)
+
+        self.clock.now += 10
+        self.router.on_request_complete(FIRST, 0.1)
+
+        expected = 2.0 / math.e + 0.1 * (1 - 1 / math.e)
+        self.assertAlmostEqual(self.router.latency(FIRST), expected)
+
+    def test_requests_in_flight_add_to_cost(self):
+        self.router.on_request_complete(FIRST, 0.1)
+        self.router.on_request_complete(SECOND, 0.3)
+
+        for i in range(3):
+            self.router.on_request_start(FIRST)
+
+        self.assertEqual(self.router.get_next(), SECOND)
+
+    def test_unmeasured_busy_route_is_avoided(self):
+        self.router.on_request_start(FIRST)
+        self.router.on_request_complete(SECOND, 5.0)
+
+        self.assertEqual(self.router.get_next(), SECOND)
+
+    def test_single_healthy_route_is_chosen(self):
+        self.router.on_upstream_error(FIRST)
+        self.assertEqual(self.router.get_next(), SECOND)
+
+        self.router.on_upstream_error(SECOND)
+        self.assertIsNone(self.router.get_next())
+
+
+def request_for(url, tenant=None):
+    request = HttpRequest()
+    request.method = 'GET'
+    request.url = url
+
+    if tenant is not None:
+        request.header('X-Tenant-Id').values.append(tenant)
+
+    return request
+
+
+URLS = ['/objects/{}'.format(number) for number in range(1000)]
+
+
+class WhenRoutingByConsistentHash(RoutingTestCase):
+
+    def setUp(self):
+        super(WhenRoutingByConsistentHash, self).setUp()
+        self.router = ConsistentHashRouter(ROUTES)
+
+    def placement(self):
+        return dict(
+            (url, self.router.get_next(request_for(url))) for url in URLS)
+
+    def test_same_key_gets_same_route(self):
+        first = self.placement()
+        self.assertEqual(self.placement(), first)
+
+    def test_query_does_not_change_route(self):
+        for url in URLS[:10]:
+            self.assertEqual(
+                self.router.get_next(request_for(url)),
+                self.router.get_next(request_for(url + '?cache=bust')))
+
+    def test_keys_are_spread_over_routes(self):
+        counts = dict()
+
+        for route in self.placement().values():
+            counts[route] = counts.get(route, 0) + 1
+
+        self.assertEqual(set(counts), set([FIRST, SECOND, THIRD]))
+
+        for count in counts.values():
+            self.assertGreater(count, len(URLS) / 6)
+
+    def test_only_keys_of_down_route_move(self):
+        before = self.placement()
+        self.router.on_upstream_error(SECOND)
+        after = self.placement()
+
+        for url in URLS:
+            if before[url] == SECOND:
+                self.assertNotEqual(after[url], SECOND)
+            else:
+                self.assertEqual(after[url], before[url])
+
+    def test_keys_return_once_route_recovers(self):
+        before = self.placement()
+        self.router.on_upstream_error(SECOND)
+        self.clock.now += routing.DEFAULT_FAILURE_BACKOFF
+
+        self.assertEqual(self.placement(), before)
+
+    def test_only_keys_of_added_route_move(self):
+        before = self.placement()
+        self.router.add_route('http://localhost:8083')
+        after = self.placement()
+        added = ('localhost', 8083, routing.PROTOCOL_HTTP)
+
+        moved = [url for url in URLS if after[url] != before[url]]
+        self.assertGreater(len(moved), 0)
+
+        for url in moved:
+            self.assertEqual(after[url], added)
+
+    def test_removed_route_is_not_used(self):
+        self.router.remove_route('http://localhost:8081')
+        self.assertNotIn(SECOND, self.placement().values())
+
+    def test_none_is_returned_when_all_routes_are_down(self):
+        for route in (FIRST, SECOND, THIRD):
+            self.router.on_upstream_error(route)
+
+        self.assertIsNone(self.router.get_next(request_for('/')))
+
+    def test_requests_without_key_are_sent_round_robin(self):
+        self.router = ConsistentHashRouter(
+            ROUTES, key=hash_by_header('X-Tenant-Id'))
+
+        routes = set(self.router.get_next(request_for('/')) for i in range(3))
+        self.assertEqual(routes, set([FIRST, SECOND, THIRD]))
+
+    def test_header_key(self):
+        self.router = ConsistentHashRouter(
+            ROUTES, key=hash_by_header('X-Tenant-Id'))
+
+        routes = set(
+            self.router.get_next(request_for(url, 'tenant'))
+            for url in URLS[:10])
+        self.assertEqual(len(routes), 1)
+
+    def test_client_key(self):
+        self.router = ConsistentHashRouter(ROUTES, key=hash_by_client)
+
+        routes = set(
+            self.router.get_next(request_for(url), ('10.0.0.1', port))
+            for port, url in enumerate(URLS[:10]))
+        self.assertEqual(len(routes), 1)
+
+
+class WhenParsingHashKeys(unittest.TestCase):
+
+    def test_path(self):
+        key = parse_hash_key('path')
+
+        self.assertEqual(key(request_for('/a?b=c#d'), None), '/a')
+        self.assertEqual(key(request_for('/a#d?b'), None), '/a')
+        self.assertEqual(key(request_for('/a'), None), '/a')
+
+    def test_url_with_query(self):
+        key = parse_hash_key('url_with_query')
+        self.assertEqual(key(request_for('/a?b=c'), None), '/a?b=c')
+
+    def test_client(self):
+        key = parse_hash_key('client')
+        self.assertEqual(key(None, ('10.0.0.1', 1234)), '10.0.0.1')
+
+    def test_header(self):
+        key = parse_hash_key('header: X-Tenant-Id')
+        self.assertEqual(key(request_for('/', 'tenant'), None), 'tenant')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, parse_hash_key, 'cookie')
+        self.assertRaises(ValueError, parse_hash_key, 'url')
+        self.assertRaises(ValueError, parse_hash_key, 'header:')
+
+
+class WhenRoutingByWeight(RoutingTestCase):
+
+    def setUp(self):
+        super(WhenRoutingByWeight, self).setUp()
+        self.router = WeightedRoundRobinRouter(
+            ROUTES, weights={'http://localhost:8080': 5})
+
+    def picks(self, count):
+        return [self.router.get_next() for i in range(count)]
+
+    def test_picks_are_spread_smoothly(self):
+        self.assertEqual(
+            self.picks(7),
+            [FIRST, FIRST, SECOND, FIRST, THIRD, FIRST, FIRST])
+
+    def test_picks_follow_weights(self):
+        picks = self.picks(70)
+
+        self.assertEqual(picks.count(FIRST), 50)
+        self.assertEqual(picks.count(SECOND), 10)
+        self.assertEqual(picks.count(THIRD), 10)
+
+    def test_down_routes_are_skipped(self):
+        self.router.on_upstream_error(FIRST)
+        self.assertEqual(set(self.picks(4)), set([SECOND, THIRD]))
+
+        self.router.on_upstream_error(SECOND)
+        self.router.on_upstream_error(THIRD)
+        self.assertIsNone(self.router.get_next())
+
+    def test_weight_may_be_changed(self):
+        self.router.set_weight('http://localhost:8080', 1)
+        self.assertEqual(self.picks(3).count(FIRST), 1)
+
+    def test_zero_weight_route_is_not_used(self):
+        self.router.set_weight('http://localhost:8080', 0)
+        self.assertNotIn(FIRST, self.picks(10))
+
+    def test_slow_start_ramps_weight(self):
+        self.router.add_route('http://localhost:8083', 4, slow_start=10)
+        added = ('localhost', 8083, routing.PROTOCOL_HTTP)
+
+        self.assertEqual(self.router.weight(added), 0)
+        self.assertNotIn(added, self.picks(7))
+
+        self.clock.now += 5
+        self.assertEqual(self.router.weight(added), 2)
+
+        self.clock.now += 5
+        self.assertEqual(self.router.weight(added), 4)
+        self.assertEqual(self.picks(11).count(added), 4)
+
+    def test_removed_route_is_not_used(self):
+        self.router.remove_route('http://localhost:8080')
+        self.assertEqual(set(self.picks(4)), set([SECOND, THIRD]))
+
+    def test_unknown_route_weight_is_rejected(self):
+        self.assertRaises(
+            routing.InvalidRouteError,
+            self.router.set_weight, 'http://localhost:9000', 2)
+
+
+class HealthStandIn(RequestHandler):
+
+    def get(self):
+        self.set_status(self.application.settings['status'])
+
+
+class WhenActivelyCheckingHealth(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.app = Application([(r'/health', HealthStandIn)], status=200)
+        return self.app
+
+    def setUp(self):
+        super(WhenActivelyCheckingHealth, self).setUp()
+        self.route = (
+            '127.0.0.1', self.get_http_port(), routing.PROTOCOL_HTTP)
+        self.router = RoundRobinRouter(
+            ['http://127.0.0.1:{}'.format(self.get_http_port())])
+        self.checker = HealthChecker(self.router, 'health', timeout=1)
+
+    def check(self):
+        health = self.router.health
+        reported = list()
+
+        def reporting(mark):
+            def report(route):
+                mark(route)
+                reported.append(route)
+
+                if len(reported) == len(self.router.routes):
+                    self.stop()
+            return report
+
+        # Wait for every route's probe to be reported on
+        health.mark_success = reporting(health.mark_success)
+        health.mark_failure = reporting(health.mark_failure)
+        self.checker.check()
+        self.wait()
+
+    def test_failing_check_marks_route_down(self):
+        self.app.settings['status'] = 503
+        self.check()
+
+        self.assertFalse(self.router.health.is_healthy(self.route))
+        self.assertIsNone(self.router.get_next())
+
+    def test_passing_check_marks_route_up(self):
+        self.router.on_upstream_error(self.route)
+        self.app.settings['status'] = 204
+        self.check()
+
+        self.assertTrue(self.router.health.is_healthy(self.route))
+        self.assertEqual(self.router.get_next(), self.route)
+
+    def test_unreachable_route_is_marked_down(self):
+        self.router.routes = [('127.0.0.1', 1, routing.PROTOCOL_HTTP)]
+        self.check()
+
+        self.assertFalse(
+            self.router.health.is_healthy(self.router.routes[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import json
+import time
+import unittest
+
+from tornado.concurrent import is_future
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application, RequestHandler
+
+from pyrox.http import HttpRequest
+from pyrox.stock_filters.keystone import KeystoneTokenFilter
+
+
+def _expires_in(seconds):
+    return time.strftime(
+        '%Y-%m-%dT%H:%M:%S.000000Z', time.gmtime(time.time() + seconds))
+
+
+class IdentityStandIn(RequestHandler):
+    """
+    Answers Keystone v2 token validations for the tokens in the
+    application's settings.
+    """
+    def get(self, token):
+        self.application.settings['calls'].append(token)
+
+        if self.request.headers.get('X-Auth-Token') != 'admin':
+            self.set_status(401)
+            return
+
+        if token == 'broken':
+            self.set_status(500)
+            return
+
+        expires_in = self.application.settings['tokens'].get(token)
+
+        if expires_in is None:
+            self.set_status(404)
+            return
+
+        self.write(json.dumps({
+            'access': {
+                'token': {
+                    'id': token,
+                    'expires': _expires_in(expires_in),
+                    'tenant': {'id': 'tenant-1', 'name': 'tenant'}
+                },
+                'user': {'id': 'user-1', 'name': 'user'}
+            }
+        }))
+
+
+class WhenValidatingTokens(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.calls = list()
+        return Application(
+            [(r'/v2.0/tokens/(.*)', IdentityStandIn)],
+            calls=self.calls,
+            tokens={'good': 3600, 'short': 1})
+
+    def setUp(self):
+        super(WhenValidatingTokens, self).setUp()
+        self.token_filter = KeystoneTokenFilter(
+            self.get_url(''), admin_token='admin', max_ttl='60')
+
+    def request_with(self, token):
+        request = HttpRequest()
+        request.header('X-Auth-Token').values.append(token)
+        request.header('X-Tenant-Id').values.append('spoofed')
+        return request
+
+    def decide(self, request):
+        action = self.token_filter.on_request_head(request)
+
+        if is_future(action):
+            action = self.io_loop.run_sync(lambda: action)
+
+        return action
+
+    def test_valid_tokens_pass_with_identity_headers(self):
+        request = self.request_with('good')
+        action = self.decide(request)
+
+        self.assertFalse(action.breaks_pipeline())
+        self.assertEqual(
+            ['tenant-1'], request.get_header('X-Tenant-Id').values)
+        self.assertEqual(['user-1'], request.get_header('X-User-Id').values)
+
+    def test_valid_tokens_are_cached(self):
+        self.decide(self.request_with('good'))
+        action = self.token_filter.on_request_head(self.request_with('good'))
+
+        self.assertFalse(is_future(action))
+        self.assertEqual(['good'], self.calls)
+
+    def test_invalid_tokens_are_rejected_and_cached(self):
+        action = self.decide(self.request_with('bad'))
+        self.assertIn('401', action.payload[0].status)
+
+        action = self.token_filter.on_request_head(self.request_with('bad'))
+        self.assertIn('401', action.payload[0].status)
+        self.assertEqual(['bad'], self.calls)
+
+    def test_concurrent_validations_are_coalesced(self):
+        first = self.token_filter.on_request_head(self.request_with('good'))
+        second = self.token_filter.on_request_head(self.request_with('good'))
+
+        self.io_loop.run_sync(lambda: second)
+
+        self.assertTrue(first.done())
+        self.assertFalse(first.result().breaks_pipeline())
+        self.assertEqual(['good'], self.calls)
+
+    def test_failed_validations_are_not_cached(self):
+        action = self.decide(self.request_with('broken'))
+        self.assertIn('503', action.payload[0].status)
+
+        self.decide(self.request_with('broken'))
+        self.assertEqual(['broken', 'broken'], self.calls)
+
+    def test_requests_without_tokens_are_rejected(self):
+        action = self.token_filter.on_request_head(HttpRequest())
+
+        self.assertIn('401', action.payload[0].status)
+        self.assertEqual([], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()